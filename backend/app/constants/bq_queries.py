@@ -1,3 +1,8 @@
+# Remote embedding model SIMILARITY_QUERY embeds user queries with. The query passes no task_type,
+# so the embeddings come from the model's default task type, recorded as MODEL_DEFAULT in their identity
+EMBEDDING_MODEL = "coursecompass.mlopsdataset.embeddings_model"
+EMBEDDING_TASK_TYPE = "MODEL_DEFAULT"
+
 SIMILARITY_QUERY = """
     WITH query_embedding AS (
         SELECT ml_generate_embedding_result 
@@ -9,6 +14,7 @@ SIMILARITY_QUERY = """
     vector_search_results AS (
         SELECT 
             base.*,
+            query.ml_generate_embedding_result AS query_embedding,
             distance as search_distance
         FROM VECTOR_SEARCH(
             (
@@ -35,7 +41,7 @@ SIMILARITY_QUERY = """
         SELECT * EXCEPT(review_id)
         FROM `coursecompass.mlopsdataset.review_data_table`
     )
-    SELECT DISTINCT
+    SELECT
         cm.course_crn AS crn,
         cm.content,
         STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; ') AS concatenated_review_info,
@@ -46,7 +52,8 @@ SIMILARITY_QUERY = """
             '\\nReview Information:\\n',
             STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; '),
             '\\n'
-        ) AS full_info
+        ) AS full_info,
+        ANY_VALUE(cm.query_embedding) AS query_embedding
     FROM course_matches cm
     JOIN review_data AS review
         ON cm.course_crn = review.crn
@@ -57,16 +64,50 @@ SIMILARITY_QUERY = """
     """
 
 SESSION_QUERY = """
-    SELECT *
+    SELECT session_id, crns, context_hash
     FROM @table_name
     WHERE session_id = @session_id
     ORDER BY timestamp DESC
     LIMIT 1
 """
 
+CONTEXT_DOCUMENT_QUERY = """
+    SELECT content
+    FROM @table_name
+    WHERE context_hash = @context_hash
+    LIMIT 1
+"""
+
+INSERT_CONTEXT_DOCUMENT_QUERY = """
+    MERGE @table_name T
+    USING (SELECT @context_hash AS context_hash) S
+    ON T.context_hash = S.context_hash
+    WHEN NOT MATCHED THEN
+        INSERT (context_hash, content, timestamp)
+        VALUES (@context_hash, @content, @timestamp)
+"""
+
 UPDATE_FEEDBACK_QUERY = """
     UPDATE @table_name
     SET feedback = @feedback
     WHERE session_id = @session_id
     AND query_id = @query_id
-"""
\ No newline at end of file
+"""
+
+POPULAR_QUERIES_QUERY = """
+    SELECT
+        normalized_query,
+        APPROX_TOP_COUNT(query, 1)[OFFSET(0)].value AS query,
+        COUNT(*) AS query_count
+    FROM (
+        SELECT
+            query,
+            TRIM(REGEXP_REPLACE(REGEXP_REPLACE(LOWER(query), r'[[:punct:]]', ''), r'\\s+', ' ')) AS normalized_query
+        FROM @table_name
+        WHERE query IS NOT NULL
+    )
+    WHERE normalized_query != ''
+    GROUP BY normalized_query
+    ORDER BY query_count DESC
+    LIMIT @top_n
+"""
@@ -1,7 +1,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.routers import health, llm_router, feedback
+from app.routers import health, llm_router, feedback, drift
+from app.services.prewarm_service import load_prewarm_snapshot
+from app.services.drift_monitor_service import load_drift_summary
+from app.middleware.session_affinity import SessionAffinityMiddleware, session_affinity_enabled, close_forwarding_clients
 
 app = FastAPI()
 app.add_middleware(
@@ -11,9 +14,24 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if session_affinity_enabled():
+    app.add_middleware(SessionAffinityMiddleware)
 
 app.include_router(health.router, prefix="/health", tags=["Health"])
 app.include_router(llm_router.router, prefix="/llm", tags=["LLM"])
 app.include_router(feedback.router, prefix="/feedback", tags=["Feedback"])   
+app.include_router(drift.router, prefix="/drift", tags=["Drift"])
+
+@app.on_event("startup")
+def prewarm_answers():
+    load_prewarm_snapshot()
+
+@app.on_event("startup")
+def load_drift_monitor():
+    load_drift_summary()
+
+@app.on_event("shutdown")
+async def close_session_affinity():
+    await close_forwarding_clients()
 
 # testing deploy 12
\ No newline at end of file
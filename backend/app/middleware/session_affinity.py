@@ -0,0 +1,127 @@
+import os
+import json
+import logging
+from collections import defaultdict
+import httpx
+from app.utils.hash_ring import ConsistentHashRing
+
+SESSION_AFFINITY_PEERS = [peer.strip().rstrip("/") for peer in os.getenv("SESSION_AFFINITY_PEERS", "").split(",") if peer.strip()]
+SESSION_AFFINITY_SELF_URL = os.getenv("SESSION_AFFINITY_SELF_URL", "").rstrip("/")
+SESSION_AFFINITY_PATHS = [path.strip() for path in os.getenv("SESSION_AFFINITY_PATHS", "/llm/predict").split(",") if path.strip()]
+SESSION_AFFINITY_LOAD_FACTOR = float(os.getenv("SESSION_AFFINITY_LOAD_FACTOR", "1.25"))
+SESSION_AFFINITY_TIMEOUT = float(os.getenv("SESSION_AFFINITY_TIMEOUT", "120"))
+
+FORWARDED_HEADER = b"x-session-affinity-forwarded"
+HOP_BY_HOP_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding", "upgrade"}
+
+# forwarding clients of the middleware instances, closed on shutdown
+_clients = []
+
+
+def session_affinity_enabled() -> bool:
+    return bool(SESSION_AFFINITY_SELF_URL) and len(SESSION_AFFINITY_PEERS) > 1
+
+
+async def close_forwarding_clients():
+    """
+    Closes the HTTP clients the middleware forwards requests with, and their pooled connections.
+    """
+    while _clients:
+        await _clients.pop().aclose()
+
+
+class SessionAffinityMiddleware:
+    """
+    ASGI middleware that routes every request of a session to the same replica.
+
+    The owner of a session is chosen on a consistent hash ring of the peer URLs with bounded
+    loads, where the load of a peer is the number of requests this replica currently has in
+    flight to it. Requests owned by another peer are forwarded to it once, marked with the
+    X-Session-Affinity-Forwarded header so the peer serves them locally. If forwarding fails the
+    request is served locally.
+
+    Args:
+        app: The ASGI application to wrap.
+        peers: URLs of all replicas, including this one.
+        self_url: URL of this replica as it appears in peers.
+        paths: Request paths whose JSON body carries a session_id to route on.
+        load_factor: Allowed load of a peer relative to the average load.
+    """
+
+    def __init__(self, app, peers=SESSION_AFFINITY_PEERS, self_url=SESSION_AFFINITY_SELF_URL,
+                 paths=SESSION_AFFINITY_PATHS, load_factor=SESSION_AFFINITY_LOAD_FACTOR):
+        self.app = app
+        self.self_url = self_url
+        self.paths = set(paths)
+        self.ring = ConsistentHashRing(peers, load_factor=load_factor)
+        self.in_flight = defaultdict(int)
+        self.client = httpx.AsyncClient(timeout=SESSION_AFFINITY_TIMEOUT)
+        _clients.append(self.client)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths
+                or dict(scope["headers"]).get(FORWARDED_HEADER)):
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        try:
+            session_id = json.loads(body).get("session_id")
+        except Exception:
+            session_id = None
+
+        owner = self.ring.get_node(session_id, self.in_flight) if session_id else self.self_url
+        if owner != self.self_url:
+            forwarded = await self._forward(owner, scope, body, send)
+            if forwarded:
+                return
+
+        self.in_flight[self.self_url] += 1
+        try:
+            await self.app(scope, self._replay(body, receive), send)
+        finally:
+            self.in_flight[self.self_url] -= 1
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    def _replay(self, body, receive):
+        sent = False
+
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        return replay_receive
+
+    async def _forward(self, peer, scope, body, send) -> bool:
+        headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]
+                   if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS]
+        headers.append((FORWARDED_HEADER.decode(), self.self_url))
+        url = f"{peer}{scope['path']}"
+        if scope.get("query_string"):
+            url = f"{url}?{scope['query_string'].decode('latin-1')}"
+
+        self.in_flight[peer] += 1
+        try:
+            response = await self.client.post(url, content=body, headers=headers)
+        except Exception as e:
+            logging.error(f"Error forwarding request to {peer}, serving locally: {e}")
+            return False
+        finally:
+            self.in_flight[peer] -= 1
+
+        response_headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()
+                            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "content-encoding"]
+        response_headers.append((b"content-length", str(len(response.content)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": response.status_code, "headers": response_headers})
+        await send({"type": "http.response.body", "body": response.content})
+        return True
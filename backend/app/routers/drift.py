@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from app.services.drift_monitor_service import drift_monitor, load_drift_summary
+
+router = APIRouter()
+
+@router.get("/")
+async def drift_status():
+    return drift_monitor.status()
+
+@router.post("/reload")
+async def reload_drift_summary():
+    return {"loaded": load_drift_summary(), **drift_monitor.status()}
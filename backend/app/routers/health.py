@@ -1,7 +1,17 @@
 from fastapi import APIRouter
+from app.utils.cache_utils import cache_stats
+from app.utils.llm_quota import llm_quota
 
 router = APIRouter()
 
 @router.get("/")
 async def health_check():
     return {"message": "Hello World! The service is up and running."}
+
+@router.get("/cache")
+async def cache_health():
+    return cache_stats()
+
+@router.get("/quota")
+async def quota_health():
+    return llm_quota.status()
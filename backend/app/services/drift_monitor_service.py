@@ -0,0 +1,230 @@
+import os
+import io
+import time
+import logging
+import threading
+import httpx
+import numpy as np
+from app.utils.bq_utils import get_embedding_model_identity
+
+logging.basicConfig(level=logging.INFO)
+
+# drift_monitor_summary.npz exported by the drift DAG, a local path or gs:// URI
+DRIFT_SUMMARY_PATH = os.getenv("DRIFT_SUMMARY_PATH")
+PROJECT_ID = os.getenv("PROJECT_ID", "coursecompass")
+DRIFT_WINDOW_SIZE = int(os.getenv("DRIFT_WINDOW_SIZE", "500"))
+DRIFT_MIN_QUERIES = int(os.getenv("DRIFT_MIN_QUERIES", "100"))
+DRIFT_TRIGGER_RATE = float(os.getenv("DRIFT_TRIGGER_RATE", "0.2"))
+DRIFT_TRIGGER_COOLDOWN = int(os.getenv("DRIFT_TRIGGER_COOLDOWN", "86400"))
+AIRFLOW_API_URL = os.getenv("AIRFLOW_API_URL")
+AIRFLOW_DAG_ID = os.getenv("AIRFLOW_DAG_ID", "data_drift_detection_dag")
+AIRFLOW_API_USER = os.getenv("AIRFLOW_API_USER")
+AIRFLOW_API_PASSWORD = os.getenv("AIRFLOW_API_PASSWORD")
+
+
+def _read_summary_file(path):
+    if path.startswith("gs://"):
+        from google.cloud import storage
+        bucket, _, blob_name = path[len("gs://"):].partition("/")
+        data = storage.Client().bucket(bucket).blob(blob_name).download_as_bytes()
+        return np.load(io.BytesIO(data))
+    return np.load(path)
+
+
+class DriftMonitor:
+    """
+    Rolling drift score of the live queries against a compact summary of the train queries.
+
+    The summary holds the boundary points of the train clusters and the thresholds of the last
+    drift DAG run. Each query embedding is scored against the boundary points, O(k) work, and
+    flagged when its lowest similarity to them lies between the lower and upper thresholds, like
+    the DAG's centroid scoring method. That similarity estimates the lowest similarity to the train
+    set from above, so the flags approximate the DAG's exact method; the DAG measures their
+    agreement, precision and recall on its test queries and stores them with the summary. The
+    flags of the last window_size queries are kept in a ring buffer with running sums, so the
+    drift rate is updated in constant time.
+
+    When the drift rate over at least min_queries reaches trigger_rate, a run of the drift DAG is
+    requested through the Airflow REST API, at most once per cooldown seconds.
+
+    Args:
+        window_size: Number of recent queries the drift rate is computed over.
+        min_queries: Number of scored queries needed before the DAG can be triggered.
+        trigger_rate: Drift rate at which the DAG is triggered.
+        cooldown: Minimum number of seconds between two DAG triggers.
+    """
+
+    def __init__(self, window_size=DRIFT_WINDOW_SIZE, min_queries=DRIFT_MIN_QUERIES,
+                 trigger_rate=DRIFT_TRIGGER_RATE, cooldown=DRIFT_TRIGGER_COOLDOWN):
+        self.window_size = window_size
+        self.min_queries = min_queries
+        self.trigger_rate = trigger_rate
+        self.cooldown = cooldown
+        self.boundary = None
+        self.upper_threshold = None
+        self.lower_threshold = None
+        self.summary_info = {}
+        self._flags = np.zeros(window_size, dtype=bool)
+        self._similarities = np.zeros(window_size, dtype=np.float64)
+        self._position = 0
+        self._filled = 0
+        self._flag_sum = 0
+        self._similarity_sum = 0.0
+        self._observed = 0
+        self._last_trigger = None
+        self._trigger_in_flight = False
+        self._lock = threading.Lock()
+
+    def load(self, arrays):
+        """
+        Replaces the train summary and resets the rolling window.
+
+        Args:
+            arrays: Mapping with the arrays of drift_monitor_summary.npz.
+
+        Returns:
+            True if the summary was loaded, False if it was built with another embedding model than
+            the one the query embeddings come from, or that model could not be identified.
+        """
+        model = str(arrays["embedding_model"])
+        serving_model = get_embedding_model_identity(PROJECT_ID)
+        if model != serving_model:
+            logging.warning(f"Drift summary was built with {model}, query embeddings come from {serving_model}, ignoring")
+            return False
+
+        boundary = np.asarray(arrays["boundary"], dtype=np.float32)
+        # agreement of the flags with the DAG's exact method, None where it was not measured
+        audit = {}
+        for name in ("queries", "agreement", "precision", "recall"):
+            value = float(arrays[f"audit_{name}"]) if f"audit_{name}" in arrays else float("nan")
+            audit[name] = None if np.isnan(value) else value
+        with self._lock:
+            self.boundary = np.ascontiguousarray(boundary)
+            self.upper_threshold = float(arrays["upper_threshold"])
+            self.lower_threshold = float(arrays["lower_threshold"])
+            self.summary_info = {
+                "embedding_model": model,
+                "boundary_points": int(boundary.shape[0]),
+                "n_train": int(arrays["n_train"]),
+                "created_at": float(arrays["created_at"]),
+                "audit": audit,
+            }
+            self._flags[:] = False
+            self._similarities[:] = 0
+            self._position = self._filled = self._flag_sum = 0
+            self._similarity_sum = 0.0
+        logging.info(f"Loaded drift summary of {boundary.shape[0]} boundary points")
+        return True
+
+    def observe(self, embedding):
+        """
+        Scores one query embedding and updates the rolling drift rate.
+
+        Args:
+            embedding: The query embedding, or None when retrieval did not return one.
+
+        Returns:
+            Whether the query was flagged as drifted, or None if it was not scored.
+        """
+        if self.boundary is None or not embedding:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[0] != self.boundary.shape[1]:
+            return None
+        norm = float(np.linalg.norm(query))
+        if norm == 0:
+            return None
+        min_similarity = float((self.boundary @ query).min()) / norm
+        flagged = self.lower_threshold < min_similarity < self.upper_threshold
+
+        with self._lock:
+            position = self._position
+            if self._filled == self.window_size:
+                self._flag_sum -= int(self._flags[position])
+                self._similarity_sum -= float(self._similarities[position])
+            else:
+                self._filled += 1
+            self._flags[position] = flagged
+            self._similarities[position] = min_similarity
+            self._flag_sum += flagged
+            self._similarity_sum += min_similarity
+            self._position = (position + 1) % self.window_size
+            self._observed += 1
+            should_trigger = self._should_trigger()
+            if should_trigger:
+                self._trigger_in_flight = True
+
+        if should_trigger:
+            threading.Thread(target=self._trigger_dag, daemon=True).start()
+        return flagged
+
+    def drift_rate(self):
+        return self._flag_sum / self._filled if self._filled else 0.0
+
+    def _should_trigger(self):
+        if not AIRFLOW_API_URL or self._trigger_in_flight:
+            return False
+        if self._filled < self.min_queries or self.drift_rate() < self.trigger_rate:
+            return False
+        return self._last_trigger is None or time.time() - self._last_trigger >= self.cooldown
+
+    def _trigger_dag(self):
+        """
+        Requests a run of the drift DAG, outside the request path.
+        """
+        url = f"{AIRFLOW_API_URL.rstrip('/')}/api/v1/dags/{AIRFLOW_DAG_ID}/dagRuns"
+        auth = (AIRFLOW_API_USER, AIRFLOW_API_PASSWORD) if AIRFLOW_API_USER else None
+        payload = {"conf": {"triggered_by": "drift_monitor", "drift_rate": self.drift_rate(), "window": self._filled}}
+        try:
+            response = httpx.post(url, json=payload, auth=auth, timeout=10)
+            response.raise_for_status()
+            logging.info(f"Triggered {AIRFLOW_DAG_ID} at drift rate {payload['conf']['drift_rate']:.3f}")
+            with self._lock:
+                self._last_trigger = time.time()
+        except Exception as e:
+            logging.error(f"Error triggering {AIRFLOW_DAG_ID}: {e}")
+        finally:
+            with self._lock:
+                self._trigger_in_flight = False
+
+    def status(self):
+        """
+        Returns the rolling drift score and the state of the monitor.
+        """
+        with self._lock:
+            return {
+                "enabled": self.boundary is not None,
+                "summary": self.summary_info,
+                "upper_threshold": self.upper_threshold,
+                "lower_threshold": self.lower_threshold,
+                "observed_queries": self._observed,
+                "window_queries": self._filled,
+                "drift_rate": self.drift_rate(),
+                "mean_min_similarity": self._similarity_sum / self._filled if self._filled else None,
+                "trigger_rate": self.trigger_rate,
+                "last_trigger": self._last_trigger,
+            }
+
+
+drift_monitor = DriftMonitor()
+
+
+def load_drift_summary(path: str = DRIFT_SUMMARY_PATH) -> bool:
+    """
+    Loads the train summary exported by the drift DAG into the drift monitor.
+
+    Args:
+        path: Local path or gs:// URI of drift_monitor_summary.npz.
+
+    Returns:
+        True if the summary was loaded.
+    """
+    if not path:
+        logging.info("DRIFT_SUMMARY_PATH is not set, drift monitoring is disabled")
+        return False
+    try:
+        with _read_summary_file(path) as arrays:
+            return drift_monitor.load(arrays)
+    except Exception as e:
+        logging.error(f"Error loading drift summary from {path}: {e}")
+        return False
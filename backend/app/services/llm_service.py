@@ -3,8 +3,14 @@ import logging
 import time
 import vertexai
 from vertexai.generative_models import GenerativeModel
-from app.utils.bq_utils import fetch_context, check_existing_session, insert_data_into_bigquery
+from app.utils.bq_utils import fetch_context, check_existing_session, insert_data_into_bigquery, fetch_context_document, insert_context_document, get_embedding_model_identity
+from app.utils.context_store import put_context_document, get_context_document, discard_context_document
+from app.utils.cache_utils import session_cache, retrieval_cache, response_cache
+from app.utils.data_utils import normalize_query, prompt_context
+from app.utils.tracing import traced, set_trace_attribute
 from app.utils.llm_utils import get_llm_response, exponential_backoff
+from app.services.prewarm_service import get_prewarmed_answer
+from app.services.drift_monitor_service import drift_monitor
 from app.constants.prompts import DEFAULT_RESPONSE, QUERY_PROMPT
 import uuid
 
@@ -16,9 +22,35 @@ LOCATION = os.getenv("LOCATION")
 ENDPOINT_ID = os.getenv("ENDPOINT_ID")
 DATASET_ID = os.getenv("DATASET_ID")
 USER_TABLE_NAME = os.getenv("USER_TABLE_NAME")
+CONTEXT_TABLE_NAME = os.getenv("CONTEXT_TABLE_NAME")
 
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
+def restore_session_context(session_data):
+    """
+    Rebuilds the context of a previous interaction from its CRN list and context hash.
+
+    The context content is looked up in the local document store first and only fetched from the
+    context table when this instance has not seen the document yet.
+
+    :param session_data: The latest interaction row of the session, with crns and context_hash.
+    :return: The context dictionary, or None if it could not be restored.
+    """
+    context_hash = session_data.get("context_hash")
+    if not context_hash:
+        return None
+
+    content = get_context_document(context_hash)
+    if content is None:
+        content = fetch_context_document(PROJECT_ID, DATASET_ID, CONTEXT_TABLE_NAME, context_hash)
+        if content is None:
+            logging.warning(f"Context document {context_hash} not found")
+            return None
+        put_context_document(content)
+
+    return {'crns': list(session_data.get("crns") or []), 'content': content}
+
+@traced
 def process_llm_request(request) -> str:
     """
     Processes a language model request and returns a generated response along with a unique query ID.
@@ -34,51 +66,83 @@ def process_llm_request(request) -> str:
     
     # generating a unique query_id
     query_id = str(uuid.uuid4())
+    set_trace_attribute("query_id", query_id)
     
     query, session_id = request.query, request.session_id    
     
-    cached_session_data = check_existing_session(PROJECT_ID, DATASET_ID, USER_TABLE_NAME, session_id)
+    cached_session_data = session_cache.get_or_load(
+        session_id, lambda: check_existing_session(PROJECT_ID, DATASET_ID, USER_TABLE_NAME, session_id) or {}
+    )
     
+    context = None
+    response = None
     if cached_session_data:
         logging.info(f"Using cached session data for session_id: {session_id}")
-        context = cached_session_data["context"]
+        context = restore_session_context(cached_session_data)
     else:
+        prewarmed = get_prewarmed_answer(query)
+        if prewarmed:
+            logging.info(f"Using prewarmed answer for query_id: {query_id}")
+            context, response = prewarmed["context"], prewarmed["response"]
+
+    if not context:
         logging.info(f"Fetching context for session_id: {session_id}")
-        context = fetch_context(query, PROJECT_ID)
+        context = retrieval_cache.get_or_load(query, lambda: fetch_context(query, PROJECT_ID))
     
     if not context:
         logging.info(f"No context found for query_id: {query_id}")
         return DEFAULT_RESPONSE, query_id
 
-    
-    full_prompt = QUERY_PROMPT.format(context=context, query=query)
+    query_embedding = context.get("query_embedding")
+    drift_monitor.observe(query_embedding)
+
+    # store the context once by content hash instead of in every row
+    context_hash, is_new_document = put_context_document(context["content"])
+    if is_new_document and not insert_context_document(
+        PROJECT_ID, DATASET_ID, CONTEXT_TABLE_NAME, context_hash, context["content"], timestamp
+    ):
+        # only documents known to be in the context table count as stored; the document is content
+        # addressed, so rows written meanwhile resolve once a later request inserts it
+        discard_context_document(context_hash)
+
+    response_key = f"{context_hash}:{normalize_query(query)}"
+    if response is None:
+        response = response_cache.get(response_key)
+        if response is not None:
+            logging.info(f"Using cached response for query_id: {query_id}")
+
+    if response is None:
+        full_prompt = QUERY_PROMPT.format(context=prompt_context(context), query=query)
+
+        try:
+            model = GenerativeModel(model_name=ENDPOINT_ID)
+        except Exception as e:
+            logging.error(f"Error initializing model: {e}")
+            return DEFAULT_RESPONSE, query_id
         
-    try:
-        model = GenerativeModel(model_name=ENDPOINT_ID)
-    except Exception as e:
-        logging.error(f"Error initializing model: {e}")
-        return DEFAULT_RESPONSE, query_id
-    
-    # Generate response
-    logging.info(f"Generating response using endpoint: {ENDPOINT_ID}")
-    response = get_llm_response(full_prompt, model)
-    
-    #convert context to string
-    context = str(context)
+        # Generate response
+        logging.info(f"Generating response using endpoint: {ENDPOINT_ID}")
+        response = get_llm_response(full_prompt, model)
+        response_cache.set(response_key, response)
     
     user_data_row = [
         {
             "timestamp": timestamp,
             "session_id": session_id,
             "query": query,
-            "context": context,
+            "crns": context["crns"],
+            "context_hash": context_hash,
             "response": response,
             "feedback": None,
-            "query_id": query_id
+            "query_id": query_id,
+            # reused by the drift pipeline instead of embedding the query again
+            "query_embedding": query_embedding or [],
+            "embedding_model": get_embedding_model_identity(PROJECT_ID) if query_embedding else None
         }
     ]
     
     # Insert data into BigQuery
     insert_data_into_bigquery(PROJECT_ID, DATASET_ID, USER_TABLE_NAME, user_data_row) 
+    session_cache.set(session_id, {"session_id": session_id, "crns": context["crns"], "context_hash": context_hash})
     
     return response, query_id
\ No newline at end of file
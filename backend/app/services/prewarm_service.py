@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import logging
+import argparse
+import vertexai
+from vertexai.generative_models import GenerativeModel
+from app.utils.bq_utils import fetch_context, fetch_popular_queries
+from app.utils.llm_utils import get_llm_response
+from app.utils.quota_scheduler import BATCH
+from app.utils.data_utils import normalize_query, prompt_context
+from app.constants.prompts import QUERY_PROMPT
+
+logging.basicConfig(level=logging.INFO)
+
+PROJECT_ID = os.getenv("PROJECT_ID", "coursecompass")
+LOCATION = os.getenv("LOCATION")
+ENDPOINT_ID = os.getenv("ENDPOINT_ID")
+DATASET_ID = os.getenv("DATASET_ID")
+HISTORIC_USER_TABLE_NAME = os.getenv("HISTORIC_USER_TABLE_NAME")
+PREWARM_SNAPSHOT_PATH = os.getenv("PREWARM_SNAPSHOT_PATH", "prewarm_snapshot.json")
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", "300"))
+
+# normalized query -> {"query", "context", "response"}
+_prewarmed_answers = {}
+
+
+def build_prewarm_snapshot(top_n: int = PREWARM_TOP_N, path: str = PREWARM_SNAPSHOT_PATH) -> int:
+    """
+    Precomputes contexts and answers for the most popular historic queries and writes them to a snapshot.
+
+    The historic user table is grouped by normalized query, and for each of the top_n clusters the
+    context is fetched and an answer is generated with the currently deployed model. Only the prompt
+    context is stored, without the embedding of the query it was fetched for. Clusters for which no
+    context or answer could be produced are left out of the snapshot.
+
+    Args:
+        top_n: Number of query clusters to precompute.
+        path: Local path the JSON snapshot is written to.
+
+    Returns:
+        The number of entries written to the snapshot.
+    """
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    model = GenerativeModel(model_name=ENDPOINT_ID)
+
+    popular_queries = fetch_popular_queries(PROJECT_ID, DATASET_ID, HISTORIC_USER_TABLE_NAME, top_n)
+    logging.info(f"Precomputing answers for {len(popular_queries)} query clusters")
+
+    entries = {}
+    for row in popular_queries:
+        query = row["query"]
+        context = fetch_context(query, PROJECT_ID)
+        if not context:
+            logging.info(f"No context found for query: {query}, skipping")
+            continue
+        try:
+            response = get_llm_response(QUERY_PROMPT.format(context=prompt_context(context), query=query), model, BATCH)
+        except Exception as e:
+            logging.error(f"Error generating response for query: {query}: {e}")
+            continue
+        # the query embedding belongs to this query only, and would be recorded on other users' rows
+        entries[normalize_query(query)] = {
+            "query": query,
+            "query_count": row["query_count"],
+            "context": prompt_context(context),
+            "response": response,
+        }
+
+    snapshot = {
+        "model": ENDPOINT_ID,
+        "created_at": int(time.time()),
+        "entries": entries,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+    logging.info(f"Wrote {len(entries)} prewarmed answers to {path}")
+    return len(entries)
+
+
+def load_prewarm_snapshot(path: str = PREWARM_SNAPSHOT_PATH) -> int:
+    """
+    Loads a prewarm snapshot into memory.
+
+    Snapshots generated with a different model than the one currently served are ignored so that
+    stale answers are never returned after a model rollout.
+
+    Args:
+        path: Local path of the JSON snapshot.
+
+    Returns:
+        The number of prewarmed answers loaded.
+    """
+    if not os.path.exists(path):
+        logging.info(f"No prewarm snapshot found at {path}")
+        return 0
+
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        logging.error(f"Error loading prewarm snapshot: {e}")
+        return 0
+
+    if snapshot.get("model") != ENDPOINT_ID:
+        logging.warning(f"Prewarm snapshot was built for model {snapshot.get('model')}, not {ENDPOINT_ID}, ignoring")
+        return 0
+
+    entries = snapshot.get("entries", {})
+    # snapshots written before the query embedding was left out still carry it
+    for entry in entries.values():
+        entry["context"] = prompt_context(entry["context"])
+    _prewarmed_answers.clear()
+    _prewarmed_answers.update(entries)
+    logging.info(f"Loaded {len(_prewarmed_answers)} prewarmed answers from {path}")
+    return len(_prewarmed_answers)
+
+
+def get_prewarmed_answer(query: str):
+    """
+    Looks up a prewarmed answer for the given query.
+
+    Args:
+        query: The user query.
+
+    Returns:
+        A dictionary with the context and response if the query is in the snapshot, otherwise None.
+    """
+    if not _prewarmed_answers:
+        return None
+    return _prewarmed_answers.get(normalize_query(query))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the prewarmed answer snapshot from historic queries")
+    parser.add_argument("--top-n", type=int, default=PREWARM_TOP_N)
+    parser.add_argument("--output", default=PREWARM_SNAPSHOT_PATH)
+    args = parser.parse_args()
+
+    build_prewarm_snapshot(args.top_n, args.output)
@@ -1,8 +1,45 @@
 from google.cloud import bigquery
-from app.constants.bq_queries import SIMILARITY_QUERY, SESSION_QUERY, UPDATE_FEEDBACK_QUERY
+from app.constants.bq_queries import SIMILARITY_QUERY, SESSION_QUERY, UPDATE_FEEDBACK_QUERY, POPULAR_QUERIES_QUERY, CONTEXT_DOCUMENT_QUERY, INSERT_CONTEXT_DOCUMENT_QUERY, EMBEDDING_MODEL, EMBEDDING_TASK_TYPE
 from app.utils.data_utils import remove_punctuation
+from app.utils.tracing import traced
 import logging
 
+# identity of the query embeddings, resolved once from the model metadata
+_embedding_model_identity = None
+
+def get_embedding_model_identity(project_id: str):
+    """
+    Returns the identity of the query embeddings SIMILARITY_QUERY computes, as "<model>/<task type>".
+
+    The model is the endpoint of the remote embedding model, read from its BigQuery metadata, so the
+    identity changes when the remote model is pointed at another endpoint. It matches the identity the
+    drift DAG stamps on its embeddings when both come from the same model and task type. SIMILARITY_QUERY
+    passes no task type, so the task part is EMBEDDING_TASK_TYPE, MODEL_DEFAULT: it only matches embeddings
+    the DAG also computes with the model's default task type.
+
+    Args:
+        project_id (str): The ID of the GCP project to query.
+
+    Returns:
+        str: The identity, or None if the model metadata could not be read.
+    """
+    global _embedding_model_identity
+    if _embedding_model_identity is None:
+        try:
+            model = bigquery.Client(project=project_id).get_model(EMBEDDING_MODEL)
+            endpoint = model.to_api_repr().get("remoteModelInfo", {}).get("endpoint")
+        except Exception as e:
+            logging.error(f"Error reading the metadata of {EMBEDDING_MODEL}: {e}")
+            return None
+        if not endpoint:
+            logging.error(f"{EMBEDDING_MODEL} is not a remote model with an endpoint")
+            return None
+        # endpoints are a model name or a URL ending in .../publishers/google/models/<model>
+        _embedding_model_identity = f"{endpoint.rstrip('/').rsplit('/', 1)[-1]}/{EMBEDDING_TASK_TYPE}"
+        logging.info(f"Query embeddings come from {_embedding_model_identity}")
+    return _embedding_model_identity
+
+@traced
 def fetch_context(user_query: str, project_id: str):
     """
     Fetches the relevant context for a given user query from the BigQuery database.
@@ -12,7 +49,8 @@ def fetch_context(user_query: str, project_id: str):
         project_id (str): The ID of the GCP project to query.
 
     Returns:
-        A dictionary containing the relevant context for the user query.
+        A dictionary containing the relevant context for the user query, an empty dictionary if
+        nothing matched, or None if the query failed.
     """
     context = {}
     client = bigquery.Client(project=project_id)
@@ -30,25 +68,31 @@ def fetch_context(user_query: str, project_id: str):
         results = query_job.result()
     except Exception as e:
         logging.error(f"Error fetching context: {e}")
-        return context
+        return None
 
     logging.info(f"Context fetched successfully")
     
     result_crns = []
     result_content = []
+    query_embedding = None
     
     for row in results:
         result_crns.append(row.crn)
         result_content.append(remove_punctuation(row.full_info))
+        if query_embedding is None and row.query_embedding:
+            query_embedding = list(row.query_embedding)
     
     final_content = "\n\n".join(result_content)
     if len(final_content) >= 100000:
         final_content = final_content[:100000]
     context['crns'] = result_crns
     context['content'] = final_content
+    # embedding of the user query, used by the online drift monitor
+    context['query_embedding'] = query_embedding
     
     return context
 
+@traced
 def insert_data_into_bigquery(project_id, dataset_id, table_id, rows_to_insert):
     """
     Inserts rows into a BigQuery table.
@@ -78,6 +122,7 @@ def insert_data_into_bigquery(project_id, dataset_id, table_id, rows_to_insert):
     except Exception as e:
         logging.error(f"Error during batch insert: {e}")
         
+@traced
 def check_existing_session(project_id, dataset_id, table_id, session_id):
     """
     Checks if a session with the specified session_id exists in the given BigQuery table.
@@ -118,6 +163,83 @@ def check_existing_session(project_id, dataset_id, table_id, session_id):
     for row in results:
         return dict(row)
 
+@traced
+def fetch_context_document(project_id, dataset_id, table_id, context_hash):
+    """
+    Fetches a context document by its content hash from the given BigQuery table.
+
+    Args:
+        project_id (str): The ID of the Google Cloud project.
+        dataset_id (str): The ID of the BigQuery dataset.
+        table_id (str): The ID of the BigQuery table holding the context documents.
+        context_hash (str): The content hash of the document.
+
+    Returns:
+        str: The context content if the document exists, otherwise None.
+    """
+    client = bigquery.Client(project=project_id)
+    
+    table_name = f"{project_id}.{dataset_id}.{table_id}"
+    final_query = CONTEXT_DOCUMENT_QUERY.replace("@table_name", f"`{table_name}`")
+    
+    query_params = [
+        bigquery.ScalarQueryParameter("context_hash", "STRING", context_hash),
+    ]
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params
+    )
+
+    logging.info(f"Fetching context document {context_hash} from table: {table_name}")
+    try:
+        query_job = client.query(final_query, job_config=job_config)
+        results = query_job.result()
+    except Exception as e:
+        logging.error(f"Error fetching context document: {e}")
+        return None
+
+    for row in results:
+        return row.content
+
+@traced
+def insert_context_document(project_id, dataset_id, table_id, context_hash, content, timestamp):
+    """
+    Inserts a context document into the given BigQuery table unless a document with the same hash exists.
+
+    Args:
+        project_id (str): The ID of the Google Cloud project.
+        dataset_id (str): The ID of the BigQuery dataset.
+        table_id (str): The ID of the BigQuery table holding the context documents.
+        context_hash (str): The content hash of the document.
+        content (str): The context content.
+        timestamp (int): The time the document was first seen.
+
+    Returns:
+        bool: Whether the request was successful or not.
+    """
+    client = bigquery.Client(project=project_id)
+    
+    table_name = f"{project_id}.{dataset_id}.{table_id}"
+    final_query = INSERT_CONTEXT_DOCUMENT_QUERY.replace("@table_name", f"`{table_name}`")
+    
+    query_params = [
+        bigquery.ScalarQueryParameter("context_hash", "STRING", context_hash),
+        bigquery.ScalarQueryParameter("content", "STRING", content),
+        bigquery.ScalarQueryParameter("timestamp", "INT64", timestamp),
+    ]
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params
+    )
+
+    logging.info(f"Inserting context document {context_hash} into table: {table_name}")
+    try:
+        query_job = client.query(final_query, job_config=job_config)
+        query_job.result()
+    except Exception as e:
+        logging.error(f"Error inserting context document: {e}")
+        return False
+
+    return True
+
 def insert_feedback_data(project_id, dataset_id, table_id, request):
     """
     Updates the feedback for a given session_id and query_id in the given table.
@@ -163,5 +285,38 @@ def insert_feedback_data(project_id, dataset_id, table_id, request):
 
     logging.info(f"Feedback updated successfully")
     return True
+
+def fetch_popular_queries(project_id, dataset_id, table_id, top_n):
+    """
+    Fetches the most frequently asked queries from the given BigQuery table.
+
+    Queries are grouped by their normalized form so that differences in case,
+    punctuation and spacing fall into the same cluster.
+
+    Args:
+        project_id (str): The ID of the Google Cloud project.
+        dataset_id (str): The ID of the BigQuery dataset.
+        table_id (str): The ID of the BigQuery table holding historic user queries.
+        top_n (int): The number of query clusters to return.
+
+    Returns:
+        list: A list of dictionaries with the normalized_query, a representative
+              query and the query_count, ordered by popularity.
+    """
+    client = bigquery.Client(project=project_id)
     
+    table_name = f"{project_id}.{dataset_id}.{table_id}"
+    final_query = POPULAR_QUERIES_QUERY.replace("@table_name", f"`{table_name}`")
     
+    query_params = [
+        bigquery.ScalarQueryParameter("top_n", "INT64", top_n),
+    ]
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params
+    )
+
+    logging.info(f"Fetching top {top_n} queries from table: {table_name}")
+    query_job = client.query(final_query, job_config=job_config)
+    results = query_job.result()
+
+    return [dict(row) for row in results]
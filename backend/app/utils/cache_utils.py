@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+CACHE_L1_MAX_ITEMS = int(os.getenv("CACHE_L1_MAX_ITEMS", "4096"))
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", "60"))
+CACHE_LOCK_TTL = int(os.getenv("CACHE_LOCK_TTL", "30"))
+CACHE_LOCK_WAIT = float(os.getenv("CACHE_LOCK_WAIT", "10"))
+# Bumped whenever the course data snapshot is reloaded so that stale entries are never read
+COURSE_DATA_VERSION = os.getenv("COURSE_DATA_VERSION", "v1")
+
+_NEGATIVE = {"__negative__": True}
+
+
+class InMemoryCacheBackend:
+    """
+    In-memory stand-in for the shared L2 store with the subset of the Redis protocol the cache uses.
+
+    A single instance shared between several TwoTierCache objects behaves like a shared server,
+    which is what local runs and tests use in place of Redis.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._data.get(key) is not None:
+                _, expires_at = self._data[key]
+                if expires_at is None or expires_at > time.monotonic():
+                    return False
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+
+class RedisCacheBackend:
+    """
+    Shared L2 store backed by any server speaking the Redis protocol, e.g. Memorystore.
+
+    Args:
+        url: The redis:// URL of the server.
+    """
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ex=None, nx=False):
+        return bool(self._client.set(key, value, ex=ex, nx=nx))
+
+    def delete(self, key):
+        return bool(self._client.delete(key))
+
+
+class LocalCache:
+    """
+    Thread-safe in-process LRU cache with per-entry expiry, used as the L1 tier.
+    """
+
+    def __init__(self, max_items=CACHE_L1_MAX_ITEMS):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class TwoTierCache:
+    """
+    Cache with an in-process L1 and an optional shared L2.
+
+    Keys are namespaced and versioned with COURSE_DATA_VERSION. Values must be JSON serializable.
+    get_or_load implements the read path:
+
+    - L1 hit, else L2 hit (which is copied into L1), else the loader is called.
+    - Only one caller per key runs the loader: concurrent callers in this process wait on a
+      per-key lock, and callers on other replicas wait for the L2 lock holder to publish.
+    - Empty results ({}, [], "") are cached for the shorter negative_ttl. None is never cached,
+      so loaders return None for transient errors.
+
+    Args:
+        namespace: Prefix of every key, e.g. "session".
+        ttl: Lifetime of positive entries in seconds.
+        negative_ttl: Lifetime of empty results in seconds.
+        l2: Shared backend, or None for an L1 only cache.
+    """
+
+    def __init__(self, namespace, ttl, negative_ttl=CACHE_NEGATIVE_TTL, l2=None, l1=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.l1 = l1 or LocalCache()
+        self.l2 = l2
+        self.stats = defaultdict(int)
+        # full key -> [lock, number of callers holding or waiting on it]
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+    def _key(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{COURSE_DATA_VERSION}:{digest}"
+
+    def _l2_get(self, full_key):
+        if self.l2 is None:
+            return None
+        try:
+            value = self.l2.get(full_key)
+        except Exception as e:
+            logging.warning(f"L2 cache get failed for {self.namespace}: {e}")
+            self.stats["l2_errors"] += 1
+            return None
+        return json.loads(value) if value is not None else None
+
+    def _l2_set(self, full_key, value, ttl):
+        if self.l2 is None:
+            return
+        try:
+            self.l2.set(full_key, json.dumps(value), ex=ttl)
+        except Exception as e:
+            logging.warning(f"L2 cache set failed for {self.namespace}: {e}")
+            self.stats["l2_errors"] += 1
+
+    def _lookup(self, full_key):
+        value = self.l1.get(full_key)
+        if value is not None:
+            self.stats["l1_hits"] += 1
+            return value
+        value = self._l2_get(full_key)
+        if value is not None:
+            self.stats["l2_hits"] += 1
+            self.l1.set(full_key, value, self.negative_ttl if value == _NEGATIVE else self.ttl)
+            return value
+        return None
+
+    def _unwrap(self, value):
+        if value == _NEGATIVE:
+            self.stats["negative_hits"] += 1
+            return None
+        return value
+
+    def get(self, key):
+        value = self._lookup(self._key(key))
+        if value is None:
+            self.stats["misses"] += 1
+            return None
+        return self._unwrap(value)
+
+    def set(self, key, value):
+        full_key = self._key(key)
+        if not value:
+            value, ttl = _NEGATIVE, self.negative_ttl
+        else:
+            ttl = self.ttl
+        self.l1.set(full_key, value, ttl)
+        self._l2_set(full_key, value, ttl)
+
+    def delete(self, key):
+        full_key = self._key(key)
+        self.l1.delete(full_key)
+        if self.l2 is not None:
+            try:
+                self.l2.delete(full_key)
+            except Exception as e:
+                logging.warning(f"L2 cache delete failed for {self.namespace}: {e}")
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() once on a miss.
+
+        Empty values come back as None when they were served from the negative cache.
+        """
+        full_key = self._key(key)
+        value = self._lookup(full_key)
+        if value is not None:
+            return self._unwrap(value)
+
+        with self._key_locks_lock:
+            key_lock = self._key_locks.setdefault(full_key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                loading = False
+                try:
+                    # another thread may have loaded the value while we waited
+                    value = self._lookup(full_key)
+                    if value is not None:
+                        return self._unwrap(value)
+
+                    value = self._wait_for_l2_lock_holder(full_key)
+                    if value is not None:
+                        return self._unwrap(value)
+
+                    loading = True
+                    self.stats["misses"] += 1
+                    value = loader()
+                    if value is not None:
+                        self.set(key, value)
+                    return value
+                finally:
+                    # also when loader() raises, so other replicas do not wait out the lock
+                    if loading:
+                        self._release_l2_lock(full_key)
+        finally:
+            # the lock is dropped with its last caller; waiters still hold it, so a new caller
+            # queues behind them instead of getting a fresh lock and loading concurrently
+            with self._key_locks_lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[full_key]
+
+    def _wait_for_l2_lock_holder(self, full_key):
+        if self.l2 is None:
+            return None
+        try:
+            if self.l2.set(f"{full_key}:lock", "1", ex=CACHE_LOCK_TTL, nx=True):
+                return None
+        except Exception as e:
+            logging.warning(f"L2 cache lock failed for {self.namespace}: {e}")
+            return None
+
+        self.stats["lock_waits"] += 1
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = self._l2_get(full_key)
+            if value is not None:
+                self.stats["l2_hits"] += 1
+                self.l1.set(full_key, value, self.negative_ttl if value == _NEGATIVE else self.ttl)
+                return value
+        return None
+
+    def _release_l2_lock(self, full_key):
+        if self.l2 is None:
+            return
+        try:
+            self.l2.delete(f"{full_key}:lock")
+        except Exception:
+            pass
+
+    def hit_ratios(self):
+        """
+        Returns the hit counts and hit ratio of each tier.
+
+        The L2 ratio is relative to the lookups that missed L1.
+        """
+        l1_hits, l2_hits, misses = self.stats["l1_hits"], self.stats["l2_hits"], self.stats["misses"]
+        lookups = l1_hits + l2_hits + misses
+        return {
+            **dict(self.stats),
+            "lookups": lookups,
+            "l1_hit_ratio": l1_hits / lookups if lookups else 0.0,
+            "l2_hit_ratio": l2_hits / (l2_hits + misses) if l2_hits + misses else 0.0,
+            "overall_hit_ratio": (l1_hits + l2_hits) / lookups if lookups else 0.0,
+        }
+
+
+def get_shared_backend():
+    """
+    Returns the shared L2 backend configured by CACHE_REDIS_URL, or None if it is not set.
+    """
+    if not CACHE_REDIS_URL:
+        return None
+    if CACHE_REDIS_URL == "memory://":
+        return InMemoryCacheBackend()
+    try:
+        return RedisCacheBackend(CACHE_REDIS_URL)
+    except Exception as e:
+        logging.error(f"Error connecting to L2 cache, using L1 only: {e}")
+        return None
+
+
+_shared_backend = get_shared_backend()
+
+session_cache = TwoTierCache("session", ttl=int(os.getenv("SESSION_CACHE_TTL", "3600")), l2=_shared_backend)
+retrieval_cache = TwoTierCache("retrieval", ttl=int(os.getenv("RETRIEVAL_CACHE_TTL", "86400")), l2=_shared_backend)
+response_cache = TwoTierCache("response", ttl=int(os.getenv("RESPONSE_CACHE_TTL", "86400")), l2=_shared_backend)
+
+
+def cache_stats():
+    """
+    Returns the hit ratios per tier of every backend cache.
+    """
+    return {cache.namespace: cache.hit_ratios() for cache in (session_cache, retrieval_cache, response_cache)}
@@ -0,0 +1,71 @@
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+
+CONTEXT_STORE_MAX_DOCUMENTS = int(os.getenv("CONTEXT_STORE_MAX_DOCUMENTS", "1024"))
+
+# context_hash -> context content, kept in least recently used order
+_documents = OrderedDict()
+
+
+def compute_context_hash(content: str) -> str:
+    """
+    Computes the content address of a context document.
+
+    Args:
+        content (str): The context text.
+
+    Returns:
+        str: The hex encoded SHA-256 digest of the content.
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def put_context_document(content: str):
+    """
+    Stores a context document in the local document store.
+
+    Args:
+        content (str): The context text.
+
+    Returns:
+        tuple: The context hash and whether the document was new to this store.
+    """
+    context_hash = compute_context_hash(content)
+    if context_hash in _documents:
+        _documents.move_to_end(context_hash)
+        return context_hash, False
+
+    _documents[context_hash] = content
+    if len(_documents) > CONTEXT_STORE_MAX_DOCUMENTS:
+        _documents.popitem(last=False)
+    logging.info(f"Stored context document {context_hash} locally")
+    return context_hash, True
+
+
+def discard_context_document(context_hash: str):
+    """
+    Removes a context document from the local document store, e.g. after its insert into the context
+    table failed, so the next request with the same context inserts it again.
+
+    Args:
+        context_hash (str): The content address of the document.
+    """
+    _documents.pop(context_hash, None)
+
+
+def get_context_document(context_hash: str):
+    """
+    Looks up a context document in the local document store.
+
+    Args:
+        context_hash (str): The content address of the document.
+
+    Returns:
+        str: The context text, or None if the document is not stored locally.
+    """
+    content = _documents.get(context_hash)
+    if content is not None:
+        _documents.move_to_end(context_hash)
+    return content
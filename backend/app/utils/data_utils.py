@@ -16,4 +16,43 @@ def remove_punctuation(text):
     """
     punts = string.punctuation
     new_text = ''.join(e for e in text if e not in punts)
-    return new_text
\ No newline at end of file
+    return new_text
+
+def normalize_query(text):
+    """
+    Normalize a user query so that trivially different phrasings of the same
+    question map to the same key.
+
+    Lower-cases the text, removes punctuation and collapses whitespace. This
+    mirrors the normalization done in POPULAR_QUERIES_QUERY.
+
+    Parameters
+    ----------
+    text : str
+        The query to normalize.
+
+    Returns
+    -------
+    str
+        The normalized query.
+    """
+    return ' '.join(remove_punctuation(text.lower()).split())
+
+def prompt_context(context):
+    """
+    The part of a retrieval context that goes into the LLM prompt.
+
+    The query embedding returned with the context is only used for drift
+    monitoring and is left out of the prompt.
+
+    Parameters
+    ----------
+    context : dict
+        The context returned by fetch_context.
+
+    Returns
+    -------
+    dict
+        The context without its query embedding.
+    """
+    return {key: value for key, value in context.items() if key != 'query_embedding'}
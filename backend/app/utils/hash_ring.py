@@ -0,0 +1,87 @@
+import bisect
+import hashlib
+import math
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    """
+    Consistent hash ring with bounded loads.
+
+    Every node is placed on the ring at `vnodes` positions. A key is owned by the first node
+    clockwise from its hash whose current load is below the capacity
+    ceil(load_factor * (total_load + 1) / number_of_nodes), so a hot node spills its overflow to
+    the next nodes on the ring instead of being overloaded. Adding or removing a node only
+    remaps the keys adjacent to its positions.
+
+    Args:
+        nodes: Initial node names.
+        vnodes: Number of ring positions per node.
+        load_factor: Allowed load relative to the average load, must be greater than 1.
+    """
+
+    def __init__(self, nodes=(), vnodes: int = 100, load_factor: float = 1.25):
+        if load_factor <= 1:
+            raise ValueError("load_factor must be greater than 1")
+        self.vnodes = vnodes
+        self.load_factor = load_factor
+        self._positions = []
+        self._owners = []
+        self.nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            position = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._positions, position)
+            self._positions.insert(index, position)
+            self._owners.insert(index, node)
+
+    def remove_node(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        keep = [i for i, owner in enumerate(self._owners) if owner != node]
+        self._positions = [self._positions[i] for i in keep]
+        self._owners = [self._owners[i] for i in keep]
+
+    def get_node(self, key: str, loads: dict = None):
+        """
+        Returns the node owning the key.
+
+        Args:
+            key: The key to place, e.g. a session_id.
+            loads: Optional mapping of node to its current load. Without it the plain
+                   consistent hashing owner is returned.
+
+        Returns:
+            The owning node, or None if the ring is empty.
+        """
+        if not self._positions:
+            return None
+
+        start = bisect.bisect(self._positions, _hash(key)) % len(self._positions)
+        if not loads:
+            return self._owners[start]
+
+        total_load = sum(loads.get(node, 0) for node in self.nodes)
+        capacity = math.ceil(self.load_factor * (total_load + 1) / len(self.nodes))
+
+        seen = set()
+        for offset in range(len(self._positions)):
+            node = self._owners[(start + offset) % len(self._positions)]
+            if node in seen:
+                continue
+            if loads.get(node, 0) < capacity:
+                return node
+            seen.add(node)
+            if len(seen) == len(self.nodes):
+                break
+        return self._owners[start]
@@ -0,0 +1,17 @@
+import os
+from app.utils.quota_scheduler import QuotaScheduler, FileQuotaStore
+
+QUOTA_STORE_PATH = os.getenv("QUOTA_STORE_PATH")
+LLM_QUOTA_RPS = float(os.getenv("LLM_QUOTA_RPS", "5"))
+LLM_QUOTA_BATCH_SHARE = float(os.getenv("LLM_QUOTA_BATCH_SHARE", "0.5"))
+LLM_QUOTA_WAIT = float(os.getenv("LLM_QUOTA_WAIT", "10"))
+# The model every GenerativeModel of the backend is created with, so the bucket is keyed by the model actually called
+ENDPOINT_ID = os.getenv("ENDPOINT_ID", "")
+
+llm_quota = QuotaScheduler(
+    os.getenv("PROJECT_ID", "coursecompass"),
+    ENDPOINT_ID,
+    LLM_QUOTA_RPS,
+    batch_share=LLM_QUOTA_BATCH_SHARE,
+    store=FileQuotaStore(QUOTA_STORE_PATH) if QUOTA_STORE_PATH else None,
+)
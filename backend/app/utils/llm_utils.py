@@ -4,6 +4,9 @@ from random import uniform
 from functools import wraps
 from typing import Callable, Any
 from vertexai.generative_models import GenerationConfig, GenerativeModel, HarmCategory, HarmBlockThreshold
+from app.utils.tracing import span, traced, add_span_event
+from app.utils.quota_scheduler import INTERACTIVE
+from app.utils.llm_quota import llm_quota, LLM_QUOTA_WAIT
 
 def exponential_backoff(
     max_retries: int = 10,
@@ -32,7 +35,8 @@ def exponential_backoff(
             retries = 0
             while True:
                 try:
-                    return func(*args, **kwargs)
+                    with span(f"{func.__name__}.attempt", attempt=retries + 1):
+                        return func(*args, **kwargs)
                 except Exception as e:
                     retries += 1
                     if retries > max_retries:
@@ -43,6 +47,7 @@ def exponential_backoff(
                     if jitter:
                         delay = delay * uniform(0.5, 1.5)
                     
+                    add_span_event("retry", attempt=retries, delay_s=round(delay, 3), error=str(e))
                     logging.warning(
                         f"Attempt {retries}/{max_retries} failed: {str(e)}. "
                         f"Retrying in {delay:.2f} seconds..."
@@ -52,23 +57,29 @@ def exponential_backoff(
         return wrapper
     return decorator
 
+@traced
 @exponential_backoff()
-def get_llm_response(input_prompt: str, model) -> str:
+def get_llm_response(input_prompt: str, model, priority: str = INTERACTIVE) -> str:
     """
     Get response from LLM with exponential backoff retry logic.
+
+    Every attempt takes a token of the shared LLM quota at the given priority, so batch callers
+    leave headroom for interactive requests, and reports quota errors back to the scheduler. Interactive
+    requests wait at most LLM_QUOTA_WAIT seconds for a token, batch callers as long as needed.
     """
-    res = model.generate_content(
-        input_prompt,
-        safety_settings={
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        },
-        generation_config=GenerationConfig(
-            max_output_tokens=8192,
-            temperature=0.7,
-        ),
-    ).text
+    with llm_quota.slot(priority, timeout=LLM_QUOTA_WAIT if priority == INTERACTIVE else None):
+        res = model.generate_content(
+            input_prompt,
+            safety_settings={
+                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+            },
+            generation_config=GenerationConfig(
+                max_output_tokens=8192,
+                temperature=0.7,
+            ),
+        ).text
     logging.info(f"Response generated from LLM successfully")
     return res
\ No newline at end of file
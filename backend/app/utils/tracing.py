@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import secrets
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Any
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318")
+# Requests slower than this are exported with stack samples, 0 disables the profiler
+PROFILE_LATENCY_THRESHOLD_MS = float(os.getenv("PROFILE_LATENCY_THRESHOLD_MS", "0"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "50"))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace, parent=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = "OK"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6 if self.end_ns else None,
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.root = None
+        self.profiler = None
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a background thread.
+
+    Stacks are kept in collapsed form ("outer;inner;leaf") with their sample counts.
+
+    Args:
+        thread_id: Identifier of the thread to sample.
+        interval_ms: Sampling interval in milliseconds.
+    """
+
+    def __init__(self, thread_id, interval_ms=PROFILE_SAMPLE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def top_stacks(self, limit=PROFILE_MAX_STACKS):
+        return [{"stack": stack, "samples": count} for stack, count in self.samples.most_common(limit)]
+
+
+def _file_exporter(record):
+    with open(TRACE_FILE_PATH, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_exporter(record):
+    """
+    Sends the trace in the OTLP/HTTP JSON encoding to OTLP_ENDPOINT, e.g. a local collector.
+    """
+    import httpx
+
+    spans = []
+    for span in record["spans"]:
+        otlp_span = {
+            "traceId": record["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span["attributes"].items()],
+            "events": [
+                {"name": event["name"], "timeUnixNano": str(event["time_ns"]),
+                 "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in event["attributes"].items()]}
+                for event in span["events"]
+            ],
+            "status": {"code": 1 if span["status"] == "OK" else 2},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        spans.append(otlp_span)
+
+    if record.get("profile"):
+        spans[0]["attributes"].append({"key": "profile.stacks", "value": {"stringValue": json.dumps(record["profile"])}})
+
+    payload = {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "course-compass-backend"}}]},
+            "scopeSpans": [{"scope": {"name": "app.utils.tracing"}, "spans": spans}],
+        }]
+    }
+    httpx.post(f"{OTLP_ENDPOINT}/v1/traces", json=payload, timeout=5)
+
+
+_EXPORTERS = {"file": _file_exporter, "otlp": _otlp_exporter}
+_export_queue = queue.Queue(maxsize=1000)
+
+
+def _export_worker():
+    while True:
+        record = _export_queue.get()
+        try:
+            _EXPORTERS[TRACE_EXPORTER](record)
+        except Exception as e:
+            logging.warning(f"Error exporting trace {record['trace_id']}: {e}")
+
+
+def tracing_enabled() -> bool:
+    return TRACE_EXPORTER in _EXPORTERS
+
+
+if tracing_enabled():
+    threading.Thread(target=_export_worker, daemon=True).start()
+
+
+def _export(trace):
+    root = trace.root
+    record = {
+        "trace_id": trace.trace_id,
+        "query_id": root.attributes.get("query_id"),
+        "name": root.name,
+        "duration_ms": (root.end_ns - root.start_ns) / 1e6,
+        "spans": [span.to_dict() for span in trace.spans],
+    }
+    if trace.profiler is not None and record["duration_ms"] >= PROFILE_LATENCY_THRESHOLD_MS:
+        record["profile"] = trace.profiler.top_stacks()
+        logging.warning(f"Slow request {record['query_id']} took {record['duration_ms']:.0f} ms, exported with stack samples")
+    try:
+        _export_queue.put_nowait(record)
+    except queue.Full:
+        logging.warning(f"Trace export queue full, dropping trace {trace.trace_id}")
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Records a span around the wrapped block.
+
+    The first span of a request becomes the root of a new trace, which is exported once the root
+    span ends. Exceptions are recorded on the span and re-raised.
+    """
+    if not tracing_enabled():
+        yield None
+        return
+
+    parent = _current_span.get()
+    trace = parent.trace if parent else Trace()
+    current = Span(name, trace, parent, attributes)
+    trace.spans.append(current)
+    if parent is None:
+        trace.root = current
+        if PROFILE_LATENCY_THRESHOLD_MS > 0:
+            trace.profiler = SamplingProfiler(threading.get_ident())
+            trace.profiler.start()
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.status = "ERROR"
+        current.attributes["error"] = str(e)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if parent is None:
+            if trace.profiler is not None:
+                trace.profiler.stop()
+            _export(trace)
+
+
+def traced(func: Callable) -> Callable:
+    """
+    Decorator that records a span named after the function around every call.
+    """
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def set_trace_attribute(key: str, value):
+    """
+    Sets an attribute on the root span of the current trace, e.g. the query_id linking the trace
+    to its interaction row.
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.trace.root.attributes[key] = value
+
+
+def add_span_event(name: str, **attributes):
+    """
+    Adds an event to the current span.
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
@@ -0,0 +1,111 @@
+"""
+Accuracy and speed of centroid-summarized drift scoring against the exact
+blocked similarity engine.
+
+The train set is clustered synthetic data; the test set mixes queries drawn
+from the train clusters with queries from new clusters. The new clusters
+share less of the common direction of the train set, by a factor drawn
+between --shift-low and --shift-high, so their queries fall on both sides of
+the drift thresholds. The summary is fitted on most of the train set and then
+updated with the rest, as when new training rows land between runs. The
+queries flagged from the summary are compared with those the exact engine
+flags, as precision and recall, under both threshold methods of
+scripts/threshold_calibration.py: 'min' (the default) and 'percentile'.
+
+Usage:
+    python data_drift/benchmarks/benchmark_centroid_summary.py --n-train 100000 --n-test 2000
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+from scripts.similarity_engine import similarity_stats
+from scripts.threshold_calibration import calibrate_thresholds
+from scripts.centroid_summary import CentroidSummary, refresh_summary
+
+logging.disable(logging.INFO)
+
+
+def clustered(rng, centres, n, noise):
+    points = centres[rng.integers(0, len(centres), n)] + noise * rng.standard_normal((n, centres.shape[1]), dtype=np.float32)
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-train', type=int, default=100000)
+    parser.add_argument('--n-test', type=int, default=2000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--clusters', type=int, default=64)
+    parser.add_argument('--centroids', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--boundary-points', type=int, default=16)
+    parser.add_argument('--update-fraction', type=float, default=0.1)
+    parser.add_argument('--shift-low', type=float, default=0.4, help='smallest shared-direction factor of a new cluster')
+    parser.add_argument('--shift-high', type=float, default=0.8, help='largest shared-direction factor of a new cluster')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # a shared direction keeps similarities positive, as with text embeddings
+    shared = 2 * rng.standard_normal(args.dim, dtype=np.float32)
+    centres = shared + rng.standard_normal((args.clusters, args.dim), dtype=np.float32)
+    shift = rng.uniform(args.shift_low, args.shift_high, (args.clusters // 4, 1)).astype(np.float32)
+    new_centres = shift * shared + rng.standard_normal((args.clusters // 4, args.dim), dtype=np.float32)
+    train = clustered(rng, centres, args.n_train, 1.2)
+    test = np.concatenate([clustered(rng, centres, args.n_test // 2, 1.2),
+                           clustered(rng, new_centres, args.n_test - args.n_test // 2, 1.2)])
+    keys = np.arange(args.n_train, dtype=np.uint64)
+
+    thresholds = {}
+    for method in ('min', 'percentile'):
+        calibration = calibrate_thresholds(train, method=method)
+        thresholds[method] = (calibration['upper_threshold'], calibration['lower_threshold'])
+
+    def flags(min_similarity, method):
+        upper, lower = thresholds[method]
+        return (min_similarity < upper) & (min_similarity > lower)
+
+    def precision_recall(scores, exact, method):
+        flagged, expected = flags(scores['min'], method), flags(exact['min'], method)
+        hits = (flagged & expected).sum()
+        precision = hits / flagged.sum() if flagged.sum() else float('nan')
+        recall = hits / expected.sum() if expected.sum() else float('nan')
+        return f"{precision:>8.1%} {recall:>7.1%}"
+
+    start = time.perf_counter()
+    exact = similarity_stats(test, train)
+    exact_seconds = time.perf_counter() - start
+
+    print(f"workload: {args.n_test} test x {args.n_train} train x {args.dim}")
+    print(f"exact:    {exact_seconds:.2f} s, queries flagged: {flags(exact['min'], 'min').sum()} (min), "
+          f"{flags(exact['min'], 'percentile').sum()} (percentile)")
+    print(f"{'k':>6} {'points':>7} {'fit s':>7} {'update s':>9} {'score s':>8} {'speedup':>8} "
+          f"{'min MAE':>8} {'max MAE':>8} {'bound ok':>9} {'min prec':>8} {'recall':>7} {'pct prec':>8} {'recall':>7}")
+
+    n_fit = int(args.n_train * (1 - args.update_fraction))
+    for k in args.centroids:
+        start = time.perf_counter()
+        summary = CentroidSummary.fit(train[:n_fit], keys[:n_fit], k, args.boundary_points)
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        summary, _ = refresh_summary(summary, train, keys, k, args.boundary_points)
+        update_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = summary.score(test)
+        score_seconds = time.perf_counter() - start
+
+        print(f"{k:>6} {len(summary.boundary):>7} {fit_seconds:>7.2f} {update_seconds:>9.3f} {score_seconds:>8.3f} "
+              f"{exact_seconds / score_seconds:>7.0f}x "
+              f"{np.abs(scores['min'] - exact['min']).mean():>8.4f} {np.abs(scores['max'] - exact['max']).mean():>8.4f} "
+              f"{(scores['min_lower_bound'] <= exact['min'] + 1e-5).mean():>9.1%} "
+              f"{precision_recall(scores, exact, 'min')} {precision_recall(scores, exact, 'percentile')}")
+
+
+if __name__ == '__main__':
+    main()
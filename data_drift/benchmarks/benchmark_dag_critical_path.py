@@ -0,0 +1,210 @@
+"""
+End-to-end wall-clock time of the drift detection stages, scheduled as the
+old serial chain and as the parallel train and test branches with sharded
+embedding.
+
+Every task does the work of its DAG counterpart on synthetic questions: the
+BigQuery extracts are simulated with a sleep, embeddings come from
+FakeEmbeddingModel with a per-call latency through EmbeddingClient, and the
+prescreen, threshold calibration and drift scoring run the real code. Tasks
+run in worker processes as soon as their upstream tasks are done, like the
+Airflow scheduler would, and the embedding shards of both branches share
+one pool of slots and split the request quota between them.
+
+Usage:
+    python data_drift/benchmarks/benchmark_dag_critical_path.py --n-train 50000 --n-test 5000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import json
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+from scripts.embedding_client import EmbeddingClient, FakeEmbeddingModel
+from scripts.lexical_prescreen import MinHasher, LSHIndex, JACCARD_THRESHOLD
+from scripts.threshold_calibration import calibrate_thresholds
+from scripts.similarity_engine import similarity_stats
+
+logging.disable(logging.INFO)
+
+WORDS = ("course professor exam lecture grading homework project difficult easy data science machine learning "
+         "algorithms systems database networks security compilers theory graphics robotics vision").split()
+
+
+def synthetic_questions(rng, n):
+    return [' '.join(rng.choices(WORDS, k=rng.randint(6, 14))) + f' {i}' for i in range(n)]
+
+
+# Tasks hand their results over through files in the work directory, like the
+# DAG tasks do through run-scoped artifacts, and run in separate processes.
+
+def _read(workdir, name):
+    with open(os.path.join(workdir, f'{name}.json')) as f:
+        return json.load(f)
+
+
+def _write(workdir, name, value):
+    with open(os.path.join(workdir, f'{name}.json'), 'w') as f:
+        json.dump(value, f)
+
+
+def extract_task(workdir, source, target, seconds):
+    time.sleep(seconds)
+    _write(workdir, target, _read(workdir, source))
+
+
+def prescreen_task(workdir):
+    hasher = MinHasher()
+    # train signatures are persisted between runs, only the test questions are hashed
+    index = LSHIndex(np.load(os.path.join(workdir, 'train_signatures.npy')))
+    test_questions = _read(workdir, 'test_questions')
+    _, similarities = index.best_matches(hasher.signatures(test_questions))
+    _write(workdir, 'embed_test', [q for q, s in zip(test_questions, similarities) if s < JACCARD_THRESHOLD])
+
+
+def embed_task(workdir, source, start, stop, out, requests_per_second, latency, workers, dim):
+    client = EmbeddingClient(FakeEmbeddingModel(dim=dim, latency=latency), max_workers=workers,
+                             requests_per_second=requests_per_second, input_factory=lambda text, task: text)
+    embeddings, _ = client.embed(_read(workdir, source)[start:stop])
+    np.save(os.path.join(workdir, f'{out}.npy'), np.asarray(embeddings, dtype=np.float32).reshape(-1, dim))
+
+
+def gather_task(workdir, label, shards):
+    arrays = [np.load(os.path.join(workdir, f'{label}_{shard}.npy')) for shard in range(shards)]
+    np.save(os.path.join(workdir, f'{label}.npy'), np.concatenate(arrays))
+
+
+def thresholds_task(workdir):
+    calibrate_thresholds(np.load(os.path.join(workdir, 'train.npy'), mmap_mode='r'))
+
+
+def detect_task(workdir):
+    similarity_stats(np.load(os.path.join(workdir, 'test.npy'), mmap_mode='r'),
+                     np.load(os.path.join(workdir, 'train.npy'), mmap_mode='r'))
+
+
+def _timed(fn, kwargs):
+    began = time.time()
+    fn(**kwargs)
+    return began, time.time()
+
+
+def run_graph(tasks, upstream, workers, pool_slots=None):
+    """
+    Run tasks on a pool of worker processes in dependency order.
+
+    :param tasks: dict of task name to a (function, kwargs) pair
+    :param upstream: dict of task name to the names it waits for
+    :param pool_slots: maximum running instances of all mapped tasks, named
+        <task>[<index>], together, like an Airflow pool they share
+    :return: tuple of the wall-clock seconds and the (start, end) of every task
+    """
+    spans, done, running = {}, set(), {}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(done) < len(tasks):
+            for name, (fn, kwargs) in tasks.items():
+                if pool_slots and '[' in name and sum('[' in other for other in running) >= pool_slots:
+                    continue
+                if name not in done and name not in running and set(upstream.get(name, ())) <= done:
+                    running[name] = executor.submit(_timed, fn, kwargs)
+            finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for name in [name for name, future in running.items() if future in finished]:
+                began, ended = running.pop(name).result()
+                spans[name] = (began - start, ended - start)
+                done.add(name)
+    return time.time() - start, spans
+
+
+def build_graph(workdir, args, n_embed_test, sharded):
+    tasks, upstream = {}, {}
+
+    def add(name, fn, after=(), **kwargs):
+        tasks[name] = (fn, {'workdir': workdir, **kwargs})
+        upstream[name] = list(after)
+
+    add('get_train_questions', extract_task, source='train_table', target='train_questions', seconds=args.extract_seconds)
+    add('get_test_questions', extract_task, source='user_table', target='test_questions', seconds=args.extract_seconds)
+    add('prescreen_test_questions', prescreen_task, ['get_train_questions', 'get_test_questions'])
+
+    embedding = {'latency': args.call_latency, 'workers': args.embedding_workers, 'dim': args.dim}
+    for label, questions_task, source, n in (('train', 'get_train_questions', 'train_questions', args.n_train),
+                                             ('test', 'prescreen_test_questions', 'embed_test', n_embed_test)):
+        bounds = [(lo, lo + args.shard_size) for lo in range(0, n, args.shard_size)] if sharded else [(0, n)]
+        # the quota is split between all pool slots, whichever branch runs in them
+        rate = args.requests_per_second / (args.pool_slots if sharded else 1)
+        shard_tasks = []
+        for shard, (lo, hi) in enumerate(bounds):
+            shard_tasks.append(f'embed_{label}_shard[{shard}]')
+            add(shard_tasks[-1], embed_task, [questions_task], source=source, start=lo, stop=hi,
+                out=f'{label}_{shard}', requests_per_second=rate, **embedding)
+        add(f'get_{label}_embeddings', gather_task, shard_tasks, label=label, shards=len(bounds))
+
+    add('get_thresholds', thresholds_task, ['get_train_embeddings'])
+    add('data_drift_detection', detect_task, ['get_thresholds', 'get_test_embeddings'])
+
+    if not sharded:
+        # the old chain: every task waits for the one before it
+        order = ['get_train_questions', 'get_test_questions', 'prescreen_test_questions', 'embed_train_shard[0]',
+                 'get_train_embeddings', 'embed_test_shard[0]', 'get_test_embeddings', 'get_thresholds',
+                 'data_drift_detection']
+        upstream = {name: [previous] for previous, name in zip(order, order[1:])}
+    return tasks, upstream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-train', type=int, default=50000)
+    parser.add_argument('--n-test', type=int, default=5000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--extract-seconds', type=float, default=5.0)
+    parser.add_argument('--call-latency', type=float, default=0.5)
+    parser.add_argument('--requests-per-second', type=float, default=25)
+    parser.add_argument('--embedding-workers', type=int, default=4)
+    parser.add_argument('--shard-size', type=int, default=5000)
+    parser.add_argument('--pool-slots', type=int, default=8)
+    parser.add_argument('--worker-slots', type=int, default=8)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    train_questions = synthetic_questions(rng, args.n_train)
+    test_questions = synthetic_questions(rng, args.n_test)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        _write(workdir, 'train_table', train_questions)
+        _write(workdir, 'user_table', test_questions)
+        np.save(os.path.join(workdir, 'train_signatures.npy'), MinHasher().signatures(train_questions))
+        _write(workdir, 'test_questions', test_questions)
+        prescreen_task(workdir)
+        n_embed_test = len(_read(workdir, 'embed_test'))
+
+        for name, sharded in (('serial chain', False), ('parallel branches', True)):
+            tasks, upstream = build_graph(workdir, args, n_embed_test, sharded)
+            results[name] = run_graph(tasks, upstream, args.worker_slots, args.pool_slots)
+
+    print(f"workload: {args.n_train} train + {args.n_test} test questions ({n_embed_test} after prescreen), "
+          f"{args.call_latency * 1000:.0f} ms per embedding call, {args.requests_per_second:.0f} requests/s quota, "
+          f"{args.extract_seconds:.0f} s per extract, {args.worker_slots} worker slots on {os.cpu_count()} CPUs")
+    for name, (seconds, spans) in results.items():
+        print(f"\n{name}: {seconds:.1f} s end to end")
+        for task, (began, ended) in sorted(spans.items(), key=lambda item: item[1][0]):
+            if '_shard[' not in task:
+                print(f"  {task:<26} {began:>6.1f} -> {ended:>6.1f} s")
+        for label in ('train', 'test'):
+            shards = [span for task, span in spans.items() if task.startswith(f'embed_{label}_shard[')]
+            print(f"  {len(shards):>2} {label} embedding shards {min(s[0] for s in shards):>5.1f} -> "
+                  f"{max(s[1] for s in shards):>6.1f} s")
+    serial, parallel = results['serial chain'][0], results['parallel branches'][0]
+    print(f"\ncritical path reduced by {serial - parallel:.1f} s ({1 - parallel / serial:.0%}), {serial / parallel:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
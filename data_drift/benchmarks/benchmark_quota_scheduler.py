@@ -0,0 +1,159 @@
+"""
+Latency of interactive LLM calls while a batch job generates answers against
+the same quota, with and without the shared quota scheduler.
+
+A fake model enforces the quota: it holds a token bucket in a file shared by
+all processes and answers with ResourceExhausted (429) when the bucket is
+empty. An interactive process sends requests at random times like live
+traffic; a batch process runs answer generation on a thread pool. Both retry
+429s with scripts/backoff.py.
+
+- uncoordinated: the batch job only limits itself with its own token bucket
+  at the full quota, as before the scheduler.
+- shared scheduler: both processes take tokens from one QuotaScheduler
+  through a FileQuotaStore, interactive before batch.
+
+Usage:
+    python data_drift/benchmarks/benchmark_quota_scheduler.py --quota 10 --seconds 30
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+from scripts.backoff import exponential_backoff
+from scripts.rate_limiter import TokenBucket
+from scripts.quota_scheduler import QuotaScheduler, FileQuotaStore, INTERACTIVE, BATCH
+
+logging.disable(logging.WARNING)
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+class FakeModel:
+    """
+    Model endpoint with a quota of `quota` requests per second shared by all
+    processes, and a fixed latency per call.
+    """
+
+    def __init__(self, path, quota, latency):
+        self.store = FileQuotaStore(path)
+        self.quota = quota
+        self.latency = latency
+
+    def generate_content(self):
+        with self.store.transaction('server') as state:
+            now = time.time()
+            tokens = min(self.quota, state.get('tokens', self.quota) + (now - state.get('updated', now)) * self.quota)
+            state['updated'] = now
+            state['tokens'] = tokens - 1 if tokens >= 1 else tokens
+            state['throttled'] = state.get('throttled', 0) + (tokens < 1)
+        if tokens < 1:
+            raise ResourceExhausted('429 Quota exceeded')
+        time.sleep(self.latency)
+
+
+def make_caller(model, scheduler, priority):
+    @exponential_backoff(base_delay=0.5, max_delay=8)
+    def call():
+        if scheduler is None:
+            model.generate_content()
+            return
+        with scheduler.slot(priority):
+            model.generate_content()
+    return call
+
+
+def interactive_process(workdir, args, shared, out):
+    rng = random.Random(1)
+    model = FakeModel(os.path.join(workdir, 'server.json'), args.quota, args.latency)
+    scheduler = QuotaScheduler('project', 'model', args.quota, store=FileQuotaStore(shared)) if shared else None
+    call = make_caller(model, scheduler, INTERACTIVE)
+    latencies = []
+
+    def timed():
+        began = time.time()
+        call()
+        latencies.append(time.time() - began)
+
+    deadline = time.time() + args.seconds
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        while time.time() < deadline:
+            time.sleep(rng.expovariate(args.interactive_rate))
+            executor.submit(timed)
+    with open(out, 'w') as f:
+        json.dump(latencies, f)
+
+
+def batch_process(workdir, args, shared, out):
+    model = FakeModel(os.path.join(workdir, 'server.json'), args.quota, args.latency)
+    scheduler = QuotaScheduler('project', 'model', args.quota, store=FileQuotaStore(shared)) if shared else None
+    limiter = TokenBucket(args.quota, capacity=args.batch_workers)
+    call = make_caller(model, scheduler, BATCH)
+    deadline = time.time() + args.seconds
+    done = []
+
+    def worker():
+        while time.time() < deadline:
+            if scheduler is None:
+                limiter.acquire()
+            call()
+            done.append(1)
+
+    with ThreadPoolExecutor(max_workers=args.batch_workers) as executor:
+        for _ in range(args.batch_workers):
+            executor.submit(worker)
+    with open(out, 'w') as f:
+        json.dump(len(done), f)
+
+
+def run(args, shared):
+    with tempfile.TemporaryDirectory() as workdir:
+        store = os.path.join(workdir, 'quota.json') if shared else None
+        interactive_out, batch_out = os.path.join(workdir, 'interactive.json'), os.path.join(workdir, 'batch.json')
+        processes = [multiprocessing.Process(target=interactive_process, args=(workdir, args, store, interactive_out)),
+                     multiprocessing.Process(target=batch_process, args=(workdir, args, store, batch_out))]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(interactive_out) as f:
+            latencies = np.array(json.load(f))
+        with open(batch_out) as f:
+            batch_calls = json.load(f)
+        with open(os.path.join(workdir, 'server.json')) as f:
+            throttled = json.load(f)['server']['throttled']
+    return latencies, batch_calls, throttled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quota', type=float, default=10, help='requests per second granted by the model')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per model call')
+    parser.add_argument('--interactive-rate', type=float, default=3, help='interactive requests per second')
+    parser.add_argument('--batch-workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=30)
+    args = parser.parse_args()
+
+    print(f"quota {args.quota:.0f} requests/s, {args.latency * 1000:.0f} ms per call, "
+          f"{args.interactive_rate:.0f} interactive requests/s, {args.batch_workers} batch workers, {args.seconds:.0f} s")
+    print(f"{'':<18} {'interactive p50':>16} {'p95':>8} {'max':>8} {'batch calls/s':>14} {'429s':>6}")
+    for name, shared in (('uncoordinated', False), ('shared scheduler', True)):
+        latencies, batch_calls, throttled = run(args, shared)
+        print(f"{name:<18} {np.percentile(latencies, 50):>15.2f}s {np.percentile(latencies, 95):>7.2f}s "
+              f"{latencies.max():>7.2f}s {batch_calls / args.seconds:>14.1f} {throttled:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Runtime and memory profile of threshold calibration for growing train sets.
+
+Sizes up to --exact-max-n use the exact blocked pass, larger sizes the
+stratified pair sample. For sampled sizes the estimated percentiles are
+compared with the exact values where the exact pass is still affordable.
+
+Usage:
+    python data_drift/benchmarks/benchmark_threshold_calibration.py --sizes 2000 10000 20000 100000
+"""
+import os
+import sys
+import argparse
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+from scripts.threshold_calibration import calibrate_thresholds, exact_pairwise_stats
+
+logging.disable(logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 10000, 20000, 100000])
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--exact-max-n', type=int, default=20000)
+    parser.add_argument('--sample-pairs', type=int, default=2000000)
+    parser.add_argument('--memory-limit-mb', type=int, default=512)
+    parser.add_argument('--verify-max-n', type=int, default=40000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'n':>8} {'mode':>8} {'pairs':>12} {'seconds':>8} {'peak MB':>8} {'p5':>8} {'p5 exact':>9}")
+    for n in args.sizes:
+        # clustered data so that the similarity distribution is not trivially centred on 0
+        centres = rng.standard_normal((32, args.dim), dtype=np.float32)
+        train = centres[rng.integers(0, 32, n)] + rng.standard_normal((n, args.dim), dtype=np.float32)
+
+        result = calibrate_thresholds(train, method='percentile', upper_percentile=5, exact_max_n=args.exact_max_n,
+                                      n_sample_pairs=args.sample_pairs, memory_limit_mb=args.memory_limit_mb)
+        stats = result['stats']
+        exact_p5 = ''
+        if stats['mode'] == 'sampled' and n <= args.verify_max_n:
+            exact_p5 = f"{exact_pairwise_stats(train, args.memory_limit_mb, (5,))['percentiles'][5]:.4f}"
+        print(f"{n:>8} {stats['mode']:>8} {stats['n_pairs']:>12} {result['elapsed_seconds']:>8.2f} "
+              f"{result['peak_memory_mb']:>8.1f} {stats['percentiles'][5]:>8.4f} {exact_p5:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+Check that the modules vendored into the DAG scripts are identical to their
+source in the backend.
+
+The DAG is deployed on its own and cannot import the backend package, so
+modules both sides share are copied into dags/scripts. Edit the backend file
+and copy it over; this check fails when the two differ.
+
+Usage:
+    python data_drift/check_vendored.py
+"""
+import os
+import sys
+import filecmp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# vendored copy -> source, relative to the repository root
+VENDORED = {
+    'data_drift/dags/scripts/quota_scheduler.py': 'backend/app/utils/quota_scheduler.py',
+}
+
+
+def main():
+    stale = [copy for copy, source in VENDORED.items()
+             if not filecmp.cmp(os.path.join(ROOT, copy), os.path.join(ROOT, source), shallow=False)]
+    for copy in stale:
+        print(f"{copy} differs from {VENDORED[copy]}, copy the source over it")
+    return 1 if stale else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
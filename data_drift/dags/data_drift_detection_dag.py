@@ -1,17 +1,20 @@
 from datetime import datetime, timedelta
 from airflow import DAG
-from airflow.operators.python import PythonOperator, BranchPythonOperator
+from airflow.operators.python import PythonOperator, BranchPythonOperator, ShortCircuitOperator
 import logging
 import logging
 from airflow.operators.email import EmailOperator
 from airflow.operators.python import PythonOperator
 from airflow.operators.empty import EmptyOperator
 from airflow.models import Variable
+from airflow.providers.google.cloud.operators.bigquery import BigQueryInsertJobOperator
+from airflow.providers.google.cloud.transfers.gcs_to_bigquery import GCSToBigQueryOperator
 
-from scripts.bigquery_utils_data_drift import get_train_queries_from_bq, get_new_queries, perform_similarity_search, upload_gcs_to_bq, move_data_from_user_table
-from scripts.drift_detection import get_train_embeddings, get_test_embeddings, get_thresholds, detect_data_drift, check_drift_trend
+from scripts.bigquery_utils_data_drift import plan_train_questions_query, get_train_queries_from_bq, plan_new_queries_query, get_new_queries, perform_similarity_search, plan_user_table_archival, plan_partition_appends, move_data_from_user_table
+from scripts.drift_detection import plan_embedding_shards, embed_question_shard, gather_embeddings, MAX_ACTIVE_SHARDS, EMBEDDING_POOL, get_thresholds, detect_data_drift, check_drift_trend, compute_distribution_shift, export_monitor_summary, prescreen_test_questions
 from scripts.llm_utils_data_drift import generate_llm_response
 from scripts.gcs_utils_data_drift import upload_train_data_to_gcs
+from scripts.constants_data_drift import BIGQUERY_LOCATION, TRAIN_DATA_PREFIX
 
 from airflow.operators.dagrun_operator import TriggerDagRunOperator
 
@@ -61,6 +64,23 @@ with DAG(
     max_active_runs=1
 ) as dag:
     
+    # BigQuery waits run in deferrable tasks: the query job is built by a short task, awaited by the
+    # triggerer without holding a worker slot, and its result read by the task downstream
+    plan_train_questions = PythonOperator(
+        task_id='plan_train_questions',
+        python_callable=plan_train_questions_query,
+        provide_context=True,
+        dag=dag
+    )
+
+    query_train_questions = BigQueryInsertJobOperator(
+        task_id='query_train_questions',
+        configuration=plan_train_questions.output,
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        dag=dag
+    )
+
     train_questions = PythonOperator(
         task_id='get_train_questions',
         python_callable=get_train_queries_from_bq,
@@ -68,6 +88,21 @@ with DAG(
         dag=dag
     )
 
+    plan_test_questions = PythonOperator(
+        task_id='plan_test_questions',
+        python_callable=plan_new_queries_query,
+        provide_context=True,
+        dag=dag
+    )
+
+    query_test_questions = BigQueryInsertJobOperator(
+        task_id='query_test_questions',
+        configuration=plan_test_questions.output,
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        dag=dag
+    )
+
     new_questions = PythonOperator(
         task_id='get_test_questions',
         python_callable=get_new_queries,
@@ -75,16 +110,60 @@ with DAG(
         dag=dag
     )
 
+    plan_train_shards = PythonOperator(
+        task_id='plan_train_shards',
+        python_callable=plan_embedding_shards,
+        op_kwargs={'label': 'train'},
+        provide_context=True,
+        dag=dag
+    )
+
+    # one mapped task instance per shard of questions, sharing the embedding pool with the test shards
+    embed_train_shards = PythonOperator.partial(
+        task_id='embed_train_shard',
+        python_callable=embed_question_shard,
+        max_active_tis_per_dag=MAX_ACTIVE_SHARDS,
+        pool=EMBEDDING_POOL,
+        dag=dag
+    ).expand(op_kwargs=plan_train_shards.output)
+
     train_embeddings = PythonOperator(
         task_id='get_train_embeddings',
-        python_callable=get_train_embeddings,
+        python_callable=gather_embeddings,
+        op_kwargs={'label': 'train'},
+        provide_context=True,
+        trigger_rule='none_failed',
+        dag=dag
+    )
+
+    plan_test_shards = PythonOperator(
+        task_id='plan_test_shards',
+        python_callable=plan_embedding_shards,
+        op_kwargs={'label': 'test'},
         provide_context=True,
         dag=dag
     )
 
+    embed_test_shards = PythonOperator.partial(
+        task_id='embed_test_shard',
+        python_callable=embed_question_shard,
+        max_active_tis_per_dag=MAX_ACTIVE_SHARDS,
+        pool=EMBEDDING_POOL,
+        dag=dag
+    ).expand(op_kwargs=plan_test_shards.output)
+
     test_embeddings = PythonOperator(
         task_id='get_test_embeddings',
-        python_callable=get_test_embeddings,
+        python_callable=gather_embeddings,
+        op_kwargs={'label': 'test'},
+        provide_context=True,
+        trigger_rule='none_failed',
+        dag=dag
+    )
+
+    prescreen = PythonOperator(
+        task_id='prescreen_test_questions',
+        python_callable=prescreen_test_questions,
         provide_context=True,
         dag=dag
     )
@@ -96,6 +175,20 @@ with DAG(
         dag=dag
     )
 
+    distribution_shift = PythonOperator(
+        task_id='distribution_shift',
+        python_callable=compute_distribution_shift,
+        provide_context=True,
+        dag=dag
+    )
+
+    monitor_summary = PythonOperator(
+        task_id='export_monitor_summary',
+        python_callable=export_monitor_summary,
+        provide_context=True,
+        dag=dag
+    )
+
     data_drift = PythonOperator(
         task_id='data_drift_detection',
         python_callable=detect_data_drift,
@@ -130,17 +223,26 @@ with DAG(
         dag=dag
     )
 
-    upload_train_data_to_gcs_task = PythonOperator(
+    # without uploaded train data, the load and the retraining trigger are skipped
+    upload_train_data_to_gcs_task = ShortCircuitOperator(
         task_id='upload_train_data_to_gcs',
         python_callable=upload_train_data_to_gcs,
+        ignore_downstream_trigger_rules=False,
         provide_context=True,
         dag=dag
     )
 
-    load_to_bigquery_task = PythonOperator(
+    load_to_bigquery_task = GCSToBigQueryOperator(
         task_id='upload_gcs_to_bq',
-        python_callable=upload_gcs_to_bq,
-        provide_context=True,
+        bucket="{{ var.value.default_bucket_name }}",
+        source_objects=["{{ ti.xcom_pull(task_ids='upload_train_data_to_gcs', key='train_data_gcs_prefix') }}/"
+                        f"{TRAIN_DATA_PREFIX}-*.parquet"],
+        destination_project_dataset_table="{{ var.value.train_data_table_name }}",
+        write_disposition='WRITE_APPEND',
+        autodetect=True,
+        source_format='PARQUET',
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
         dag=dag
     )
 
@@ -151,12 +253,59 @@ with DAG(
         dag=dag
     )
 
+    plan_archival_task = BranchPythonOperator(
+        task_id='plan_user_table_archival',
+        python_callable=plan_user_table_archival,
+        provide_context=True,
+        dag=dag,
+        trigger_rule='none_failed'
+    )
+
+    archive_user_table_task = BigQueryInsertJobOperator(
+        task_id='archive_user_table',
+        configuration=plan_archival_task.output['archive_job'],
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        dag=dag
+    )
+
+    # sealed partitions are copied to staging, removed from the user table and appended to the historic
+    # table by deferrable jobs; the guarded deletes run one at a time, as transactions on one table conflict
+    copy_user_partitions = BigQueryInsertJobOperator.partial(
+        task_id='copy_user_partitions',
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        dag=dag
+    ).expand(configuration=plan_archival_task.output['partition_copy_jobs'])
+
+    archive_user_partitions = BigQueryInsertJobOperator.partial(
+        task_id='archive_user_partitions',
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        max_active_tis_per_dag=1,
+        dag=dag
+    ).expand(configuration=plan_archival_task.output['partition_archive_jobs'])
+
+    plan_appends_task = PythonOperator(
+        task_id='plan_partition_appends',
+        python_callable=plan_partition_appends,
+        provide_context=True,
+        dag=dag
+    )
+
+    append_user_partitions = BigQueryInsertJobOperator.partial(
+        task_id='append_user_partitions',
+        location=BIGQUERY_LOCATION,
+        deferrable=True,
+        dag=dag
+    ).expand(configuration=plan_appends_task.output)
+
     move_data_from_user_table_task = PythonOperator(
         task_id='move_data_from_user_table',
         python_callable=move_data_from_user_table,
         provide_context=True,
         dag=dag,
-        trigger_rule='one_success'
+        trigger_rule='none_failed'
     )
 
 
@@ -177,10 +326,18 @@ with DAG(
 
 
     # Define the task dependencies
-    train_questions >> new_questions >> train_embeddings >> test_embeddings >> thresholds >> data_drift
+    # train and test branches run in parallel and meet at drift detection
+    plan_train_questions >> query_train_questions >> train_questions
+    plan_test_questions >> query_test_questions >> new_questions
+    train_questions >> plan_train_shards >> embed_train_shards >> train_embeddings >> thresholds
+    [train_questions, new_questions] >> prescreen >> plan_test_shards >> embed_test_shards >> test_embeddings
+    [thresholds, test_embeddings] >> data_drift
+    [train_embeddings, test_embeddings] >> distribution_shift
+    [thresholds, test_embeddings] >> monitor_summary
     data_drift >> data_drift_trend_task >> [dummy_task, similarity_search_results]
     similarity_search_results >> llm_response >>  upload_train_data_to_gcs_task >> load_to_bigquery_task >> trigger_dag_run 
-    dummy_task >> move_data_from_user_table_task 
-    trigger_dag_run >> move_data_from_user_table_task
+    [dummy_task, trigger_dag_run] >> plan_archival_task >> [copy_user_partitions, archive_user_table_task, move_data_from_user_table_task]
+    copy_user_partitions >> archive_user_partitions >> plan_appends_task >> append_user_partitions >> move_data_from_user_table_task
+    archive_user_table_task >> move_data_from_user_table_task
     move_data_from_user_table_task >> success_email_task
     
\ No newline at end of file
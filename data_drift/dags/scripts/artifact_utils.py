@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import logging
+import threading
+import numpy as np
+from airflow.models import Variable
+from airflow.providers.google.cloud.hooks.gcs import GCSHook
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_ARTIFACT_URI = '/tmp/drift_artifacts'
+DEFAULT_STAGING_DIR = '/tmp/drift_artifacts_staging'
+
+
+def _split_gcs_uri(uri):
+    bucket, _, object_name = uri[len('gs://'):].partition('/')
+    return bucket, object_name
+
+
+def _artifact_root():
+    return Variable.get('drift_artifact_uri', default_var=DEFAULT_ARTIFACT_URI).rstrip('/')
+
+
+def run_scope(context):
+    """
+    Path segment unique to the DAG run: <dag_id>/<run_id>, with the run id made safe for file and object names.
+    """
+    run_id = re.sub(r'[^A-Za-z0-9_.-]', '_', context['run_id'])
+    return f"{context['dag'].dag_id}/{run_id}"
+
+
+def run_artifact_uri(context, name, extension='npy'):
+    """
+    Run-scoped location of an artifact: <drift_artifact_uri>/<dag_id>/<run_id>/<name>.<extension>
+
+    :param context: Airflow task context
+    :param name: artifact name, e.g. train_embeddings
+    :return: local path or gs:// URI
+    """
+    return f"{_artifact_root()}/{run_scope(context)}/{name}.{extension}"
+
+
+def _staging_path(uri):
+    bucket, object_name = _split_gcs_uri(uri)
+    return os.path.join(DEFAULT_STAGING_DIR, bucket, object_name)
+
+
+def _write_file(uri, write, suffix):
+    local_path = _staging_path(uri) if uri.startswith('gs://') else uri
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    tmp_path = f"{local_path}.tmp{suffix}"
+    write(tmp_path)
+    os.replace(tmp_path, local_path)
+
+    if uri.startswith('gs://'):
+        bucket, object_name = _split_gcs_uri(uri)
+        GCSHook().upload(bucket_name=bucket, object_name=object_name, filename=local_path)
+
+
+def _write_npy(uri, array):
+    _write_file(uri, lambda path: np.save(path, array), '.npy')
+
+
+def save_array(array, context, name):
+    """
+    Write an array as a run-scoped .npy artifact.
+
+    Only the returned reference is meant to go through XCom, so the metadata
+    database never holds the array itself.
+
+    :param array: array to save
+    :param context: Airflow task context
+    :param name: artifact name
+    :return: dict with uri, shape and dtype of the artifact
+    """
+    array = np.ascontiguousarray(array)
+    uri = run_artifact_uri(context, name)
+    _write_npy(uri, array)
+
+    logging.info(f"Saved {name} artifact {array.shape} {array.dtype} ({array.nbytes / 1024 ** 2:.1f} MB) to {uri}")
+    return {'uri': uri, 'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+
+def load_array(ref, mmap=True):
+    """
+    Load an artifact saved by save_array.
+
+    The file is memory-mapped read-only, so nothing is copied until the
+    consumer reads it. Artifacts on GCS are downloaded once per worker into
+    the staging directory and mapped from there.
+
+    :param ref: reference returned by save_array
+    :param mmap: memory-map the file instead of reading it into memory
+    :return: numpy array, or None if ref is None
+    """
+    if ref is None:
+        return None
+
+    uri = ref['uri']
+    local_path = uri
+    if uri.startswith('gs://'):
+        local_path = _staging_path(uri)
+        if not os.path.exists(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            bucket, object_name = _split_gcs_uri(uri)
+            GCSHook().download(bucket_name=bucket, object_name=object_name, filename=local_path)
+
+    array = np.load(local_path, mmap_mode='r' if mmap else None)
+    if list(array.shape) != list(ref['shape']) or str(array.dtype) != ref['dtype']:
+        raise ValueError(f"Artifact {uri} is {array.shape} {array.dtype}, expected {tuple(ref['shape'])} {ref['dtype']}")
+    return array
+
+
+def state_uri(name, extension='json'):
+    """
+    Location of pipeline state that outlives a run: <drift_artifact_uri>/state/<name>.<extension>
+    """
+    return f"{_artifact_root()}/state/{name}.{extension}"
+
+
+def load_state(name):
+    """
+    Load a JSON state document saved by save_state.
+
+    :param name: state name
+    :return: the document, or None if it was never saved
+    """
+    uri = state_uri(name)
+    if uri.startswith('gs://'):
+        bucket, object_name = _split_gcs_uri(uri)
+        gcs_hook = GCSHook()
+        if not gcs_hook.exists(bucket_name=bucket, object_name=object_name):
+            return None
+        return json.loads(gcs_hook.download(bucket_name=bucket, object_name=object_name))
+
+    if not os.path.exists(uri):
+        return None
+    with open(uri) as f:
+        return json.load(f)
+
+
+def save_state(name, document):
+    """
+    Atomically replace a JSON state document.
+
+    :param name: state name
+    :param document: JSON serializable document
+    """
+    uri = state_uri(name)
+    data = json.dumps(document)
+    if uri.startswith('gs://'):
+        bucket, object_name = _split_gcs_uri(uri)
+        GCSHook().upload(bucket_name=bucket, object_name=object_name, data=data, mime_type='application/json')
+    else:
+        os.makedirs(os.path.dirname(uri), exist_ok=True)
+        tmp_path = f"{uri}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, uri)
+    logging.info(f"Saved {name} state ({len(data) / 1024:.1f} KB) to {uri}")
+
+
+def save_state_array(name, array):
+    """
+    Replace an array kept as pipeline state, e.g. a matrix reused across runs.
+    """
+    array = np.ascontiguousarray(array)
+    _write_npy(state_uri(name, 'npy'), array)
+    logging.info(f"Saved {name} state {array.shape} {array.dtype}")
+
+
+def _fetch_state_file(uri):
+    local_path = uri
+    if uri.startswith('gs://'):
+        # state changes between runs, so the staged copy is always refreshed
+        local_path = _staging_path(uri)
+        bucket, object_name = _split_gcs_uri(uri)
+        gcs_hook = GCSHook()
+        if not gcs_hook.exists(bucket_name=bucket, object_name=object_name):
+            return None
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        gcs_hook.download(bucket_name=bucket, object_name=object_name, filename=local_path)
+
+    return local_path if os.path.exists(local_path) else None
+
+
+def load_state_array(name):
+    """
+    Memory-map an array saved by save_state_array.
+
+    :return: numpy array, or None if it was never saved
+    """
+    local_path = _fetch_state_file(state_uri(name, 'npy'))
+    if local_path is None:
+        return None
+    return np.load(local_path, mmap_mode='r')
+
+
+def save_state_arrays(name, arrays):
+    """
+    Replace a set of arrays kept together as pipeline state, as one .npz file.
+
+    :param name: state name
+    :param arrays: dict of array name to array
+    """
+    _write_file(state_uri(name, 'npz'), lambda path: np.savez(path, **arrays), '.npz')
+    logging.info(f"Saved {name} state ({', '.join(arrays)})")
+
+
+def load_state_arrays(name):
+    """
+    Load arrays saved by save_state_arrays.
+
+    :return: dict of array name to array, or None if they were never saved
+    """
+    local_path = _fetch_state_file(state_uri(name, 'npz'))
+    if local_path is None:
+        return None
+    with np.load(local_path) as data:
+        return {key: data[key] for key in data.files}
+
+
+class RunCheckpoint:
+    """
+    Append-only JSONL checkpoint scoped to the DAG run.
+
+    Records are appended and flushed to a local file as they are produced.
+    When drift_artifact_uri is on GCS, the file is uploaded every sync_every
+    records and on sync(), so a retry of the task on another worker resumes
+    from it.
+
+    :param context: Airflow task context
+    :param name: checkpoint name
+    :param sync_every: records between uploads to GCS
+    """
+
+    def __init__(self, context, name, sync_every=10):
+        self.uri = run_artifact_uri(context, name, 'jsonl')
+        self.local_path = _staging_path(self.uri) if self.uri.startswith('gs://') else self.uri
+        self.sync_every = sync_every
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+
+    def load(self):
+        """
+        :return: list of the records written by earlier attempts of the task
+        """
+        if self.uri.startswith('gs://'):
+            bucket, object_name = _split_gcs_uri(self.uri)
+            gcs_hook = GCSHook()
+            if gcs_hook.exists(bucket_name=bucket, object_name=object_name):
+                gcs_hook.download(bucket_name=bucket, object_name=object_name, filename=self.local_path)
+
+        if not os.path.exists(self.local_path):
+            return []
+        records = []
+        with open(self.local_path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a line cut short by a crash: drop it so that appends start on a clean line
+                    with open(self.local_path, 'w') as rewritten:
+                        rewritten.writelines(json.dumps(record) + '\n' for record in records)
+                    break
+        return records
+
+    def append(self, record):
+        with self._lock:
+            with open(self.local_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        if self.uri.startswith('gs://') and os.path.exists(self.local_path):
+            bucket, object_name = _split_gcs_uri(self.uri)
+            GCSHook().upload(bucket_name=bucket, object_name=object_name, filename=self.local_path)
+        self._unsynced = 0
+
+    def sync(self):
+        with self._lock:
+            self._sync()
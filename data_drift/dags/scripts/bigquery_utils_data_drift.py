@@ -4,72 +4,356 @@ from google.cloud import bigquery
 from airflow.models import Variable
 import logging
 from google.cloud import bigquery
-from airflow.providers.google.cloud.transfers.gcs_to_bigquery import (
-    GCSToBigQueryOperator
-)
 import string
+from scripts.incremental_extract import new_values_query, query_job_configuration, read_new_values, watermark_parameter, lagged_watermark, later_watermark, PAGE_SIZE
+from scripts.artifact_utils import load_state, save_state
+from scripts.partition_archive import supports_partition_archival, plan_partition_archival, copy_job_configuration, staging_table_name
+from scripts.course_search import local_similarity_search
+from scripts.embedding_cache import embedding_identity
+from scripts.constants_data_drift import COURSE_SEARCH_TOP_K, EMBEDDING_MODEL_NAME, EMBEDDING_TASK, BIGQUERY_LOCATION, SERVING_EMBEDDING_MODEL, SERVING_EMBEDDING_TASK, USER_ROW_KEY_COLUMNS, USER_ROW_UPDATABLE_COLUMNS
 
 
 logging.basicConfig(level=logging.INFO)
 
-def get_train_queries_from_bq(**context):
+def query_job_rows(job_id, page_size=PAGE_SIZE):
     """
-    Retrieves 
+    Result of a query job run by a deferrable BigQueryInsertJobOperator task.
+
+    The job is done when the task hands over its id, so the rows are read
+    without waiting on BigQuery.
+
+    :param job_id: job id returned by the operator
+    :return: RowIterator of the result, read page by page
     """
     client = bigquery.Client()
-    
-    train_data_query = """
-        SELECT DISTINCT question
-        FROM `{}`""".format(Variable.get('train_data_table_name'))
-    
-    question_list = list(set(row["question"] for row in client.query(train_data_query).result()))
-    
-    logging.info(f"Found {len(question_list)} unique train questions")
-    
+    return client.get_job(job_id, location=BIGQUERY_LOCATION).result(page_size=page_size)
+
+
+def _train_questions_state(watermark_column):
+    state = load_state('train_questions') if watermark_column else None
+    if state is None or state.get('watermark_column') != watermark_column:
+        state = {'watermark_column': watermark_column, 'watermark': None, 'questions': []}
+    return state
+
+
+def plan_train_questions_query(**context):
+    """
+    Builds the query job of the train questions, run by the deferrable
+    query_train_questions task.
+
+    When the train_data_watermark_column Variable names an insertion time
+    column of the train table, only the questions added since the last run are
+    queried. Otherwise the distinct questions of the whole table are.
+
+    :return: BigQueryInsertJobOperator configuration
+    """
+    table_name = Variable.get('train_data_table_name')
+    watermark_column = Variable.get('train_data_watermark_column', default_var=None)
+    state = _train_questions_state(watermark_column)
+    query, query_params = new_values_query(table_name, 'question', watermark_column, state['watermark'])
+    return query_job_configuration(query, query_params)
+
+
+def get_train_queries_from_bq(**context):
+    """
+    Retrieves the distinct train questions from the result of
+    query_train_questions.
+
+    With a train_data_watermark_column, the questions added since the last run
+    are merged into the train question set persisted by the previous run.
+    """
+    table_name = Variable.get('train_data_table_name')
+    watermark_column = Variable.get('train_data_watermark_column', default_var=None)
+    state = _train_questions_state(watermark_column)
+
+    rows = query_job_rows(context['ti'].xcom_pull(task_ids='query_train_questions'))
+    new_questions, watermark = read_new_values(rows, table_name, watermark_column, state['watermark'])
+
+    known_questions = set(state['questions'])
+    question_list = state['questions'] + [question for question in new_questions if question not in known_questions]
+
+    if watermark_column:
+        save_state('train_questions', {'watermark_column': watermark_column, 'watermark': watermark, 'questions': question_list})
+
+    logging.info(f"Found {len(question_list)} unique train questions, {len(question_list) - len(known_questions)} new")
+
     context['ti'].xcom_push(key='questions', value=question_list)
     return question_list
 
 
-def get_new_queries(**context):
+def plan_new_queries_query(**context):
     """
-    Retrieves 
+    Builds the query job of the distinct user queries added since the
+    user_data_watermark Variable, run by the deferrable query_test_questions
+    task.
+
+    Rows are read up to user_data_watermark_lag_seconds before now, pushed to
+    XCom as 'watermark_cap': the backend stamps a row when its request starts
+    and writes it when the request ends, so later rows may still be in flight.
+    The cap becomes the new watermark, and archival stops at it too.
+
+    :return: BigQueryInsertJobOperator configuration
     """
     client = bigquery.Client()
-    
-    test_data_query = """
-        SELECT DISTINCT query
-        FROM `{}`""".format(Variable.get('user_data_table_name'))
-    
-    question_list = list(set(row["query"] for row in client.query(test_data_query).result()))
-    
-    logging.info(f"Found {len(question_list)} unique test questions")
-    
+    table_name = Variable.get('user_data_table_name')
+    watermark_column = Variable.get('user_data_watermark_column', default_var='timestamp')
+    watermark = Variable.get('user_data_watermark', default_var=None, deserialize_json=True)
+    lag_seconds = int(Variable.get('user_data_watermark_lag_seconds', default_var=3600))
+
+    field_types = {field.name: field.field_type for field in client.get_table(table_name).schema}
+    if watermark_column not in field_types:
+        raise ValueError(f"Watermark column {watermark_column} not found in {table_name}")
+    watermark_cap = lagged_watermark(field_types[watermark_column], lag_seconds)
+    context['ti'].xcom_push(key='watermark_cap', value=watermark_cap)
+
+    query, query_params = new_values_query(table_name, 'query', watermark_column, watermark, upper=watermark_cap)
+    return query_job_configuration(query, query_params)
+
+
+def get_new_queries(**context):
+    """
+    Retrieves the distinct user queries from the result of
+    query_test_questions.
+
+    The watermark cap of plan_test_questions is pushed to XCom as the new
+    watermark, and only committed by move_data_from_user_table, once the run
+    has archived the rows up to it.
+    """
+    table_name = Variable.get('user_data_table_name')
+    watermark_column = Variable.get('user_data_watermark_column', default_var='timestamp')
+    watermark = Variable.get('user_data_watermark', default_var=None, deserialize_json=True)
+    watermark_cap = context['ti'].xcom_pull(task_ids='plan_test_questions', key='watermark_cap')
+
+    rows = query_job_rows(context['ti'].xcom_pull(task_ids='query_test_questions'))
+    question_list, _ = read_new_values(rows, table_name, watermark_column, watermark)
+    # every row up to the cap is written, so the watermark moves to the cap even past the last row read
+    new_watermark = later_watermark(watermark, watermark_cap)
+
+    logging.info(f"Found {len(question_list)} unique test questions since watermark {watermark}")
+
     context['ti'].xcom_push(key='questions', value=question_list)
+    context['ti'].xcom_push(key='watermark', value=new_watermark)
     return question_list
 
 
+def get_serving_embedding_identity(client):
+    """
+    Identity of the query embeddings the backend stores, read from the
+    metadata of the remote model its SIMILARITY_QUERY embeds with, in the
+    form of embedding_cache.embedding_identity. The backend stamps its rows
+    with the same string.
+
+    :return: the identity, or None if the model metadata could not be read
+    """
+    try:
+        model = client.get_model(SERVING_EMBEDDING_MODEL)
+        endpoint = model.to_api_repr().get('remoteModelInfo', {}).get('endpoint')
+    except Exception as e:
+        logging.warning(f"Could not read the metadata of {SERVING_EMBEDDING_MODEL}: {e}")
+        return None
+    if not endpoint:
+        logging.warning(f"{SERVING_EMBEDDING_MODEL} is not a remote model with an endpoint")
+        return None
+    # endpoints are a model name or a URL ending in .../publishers/google/models/<model>
+    return embedding_identity(endpoint.rstrip('/').rsplit('/', 1)[-1], SERVING_EMBEDDING_TASK)
+
+
+def get_serving_embeddings(**context):
+    """
+    Reads the query embeddings the backend stored with the user rows read by
+    get_test_questions.
+
+    The backend keeps the embedding BigQuery computed for the course search,
+    together with the identity of the model and task type it was computed
+    with, in every interaction row. Serving embeddings are only returned when
+    the remote model of the backend currently resolves to the model and task
+    type the pipeline embeds with, and only from rows stamped with exactly
+    that identity, so that train and test embeddings stay comparable; queries
+    without one are embedded by the pipeline.
+
+    :return: dict of query to its embedding
+    """
+    new_watermark = context['ti'].xcom_pull(task_ids='get_test_questions', key='watermark')
+    if new_watermark is None:
+        return {}
+
+    client = bigquery.Client()
+    identity = embedding_identity(EMBEDDING_MODEL_NAME, EMBEDDING_TASK)
+    serving_identity = get_serving_embedding_identity(client)
+    if serving_identity != identity:
+        logging.info(f"Serving embeddings come from {serving_identity}, not {identity}: embedding every query")
+        return {}
+
+    table_name = Variable.get('user_data_table_name')
+    watermark_column = Variable.get('user_data_watermark_column', default_var='timestamp')
+    watermark = Variable.get('user_data_watermark', default_var=None, deserialize_json=True)
+
+    query_params = [
+        bigquery.ScalarQueryParameter('embedding_model', 'STRING', identity),
+        watermark_parameter(new_watermark, 'new_watermark'),
+    ]
+    where = ''
+    if watermark is not None:
+        where = f"AND {watermark_column} > @watermark"
+        query_params.append(watermark_parameter(watermark))
+    query = f"""
+        SELECT query, ANY_VALUE(query_embedding) AS embedding
+        FROM `{table_name}`
+        WHERE embedding_model = @embedding_model
+            AND ARRAY_LENGTH(query_embedding) > 0
+            AND {watermark_column} <= @new_watermark
+            {where}
+        GROUP BY query"""
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_params)
+    try:
+        rows = client.query(query, job_config=job_config).result(page_size=PAGE_SIZE)
+        embeddings = {row['query']: list(row['embedding']) for row in rows}
+    except Exception as e:
+        # e.g. a user table without the embedding columns: embed every query instead
+        logging.warning(f"Could not read serving embeddings from {table_name}: {e}")
+        return {}
+
+    logging.info(f"Read {len(embeddings)} serving embeddings of {identity} from {table_name}")
+    return embeddings
+
+
+def plan_user_table_archival(**context):
+    """
+    Plans the jobs that archive the user rows read by this run.
+
+    When the user and historic tables are partitioned the same way on the
+    watermark column, the sealed partitions, those entirely below the watermark,
+    are moved with copy jobs and one guarded DELETE per partition (see
+    scripts/partition_archive.py). Their configurations are pushed as
+    'partition_copy_jobs' and 'partition_archive_jobs', for the deferrable
+    copy_user_partitions and archive_user_partitions tasks, and the partition
+    ids as 'sealed_partitions'. The partition holding the watermark stays in
+    the user table until a later run seals it; the watermark keeps its rows
+    from being analyzed twice.
+
+    Otherwise rows up to the watermark pushed by get_test_questions are moved
+    with an INSERT and a DELETE statement in one transaction, pushed as the
+    'archive_job' configuration of the deferrable archive_user_table task.
+    Either way, archival stops at the lagged watermark, so rows of requests
+    still in flight when the run read the table, and queries arriving while the
+    DAG runs, stay in the user table for the next run.
+
+    :return: task id to follow, copy_user_partitions, archive_user_table or
+        move_data_from_user_table
+    """
+    watermark = context['ti'].xcom_pull(task_ids='get_test_questions', key='watermark')
+    if watermark is None:
+        logging.info("No user queries were read in this run. Nothing to archive")
+        return 'move_data_from_user_table'
 
-def move_data_from_user_table(**context):
     client = bigquery.Client()
 
     source_table_ref = Variable.get('user_data_table_name')
     destination_table_ref = Variable.get('historic_user_data_table_name')
+    watermark_column = Variable.get('user_data_watermark_column', default_var='timestamp')
+
+    if supports_partition_archival(client.get_table(source_table_ref), client.get_table(destination_table_ref),
+                                   watermark_column, watermark):
+        partition_ids, copy_jobs, archive_jobs = plan_partition_archival(
+            client, source_table_ref, destination_table_ref, watermark, USER_ROW_KEY_COLUMNS,
+            USER_ROW_UPDATABLE_COLUMNS)
+        if not partition_ids:
+            logging.info(f"No partition of {source_table_ref} is sealed by {watermark_column} "
+                         f"{watermark['value']}. Nothing to archive")
+            return 'move_data_from_user_table'
+        logging.info(f"Archiving {len(partition_ids)} sealed partitions of {source_table_ref} to "
+                     f"{destination_table_ref}. Rows after partitions sealed by {watermark_column} "
+                     f"{watermark['value']} stay in the source.")
+        context['ti'].xcom_push(key='sealed_partitions', value=partition_ids)
+        context['ti'].xcom_push(key='partition_copy_jobs', value=copy_jobs)
+        context['ti'].xcom_push(key='partition_archive_jobs', value=archive_jobs)
+        return 'copy_user_partitions'
+
+    logging.warning(f"{source_table_ref} and {destination_table_ref} are not partitioned alike on "
+                    f"{watermark_column}. Archiving with INSERT and DELETE statements")
+    archive_script = f"""
+    BEGIN TRANSACTION;
 
-    insert_query = f"""
     INSERT INTO {destination_table_ref}
-    SELECT * FROM {source_table_ref};
-    """
-    query_job = client.query(insert_query)
-    query_job.result()  
+    SELECT * FROM {source_table_ref}
+    WHERE {watermark_column} <= @watermark;
 
-    delete_query = f"""
     DELETE FROM {source_table_ref}
-    WHERE TRUE;
+    WHERE {watermark_column} <= @watermark;
+
+    COMMIT TRANSACTION;
+    """
+    context['ti'].xcom_push(key='archive_job',
+                            value=query_job_configuration(archive_script, [watermark_parameter(watermark)]))
+    return 'archive_user_table'
+
+
+def plan_partition_appends(**context):
+    """
+    Reads the result of the archive_user_partitions jobs, and plans the
+    append of the partitions they removed from the user table to the same
+    partitions of the historic table.
+
+    The staging copy of a partition left in the user table is dropped; the
+    partition is archived by a later run. The removed partition ids are
+    pushed as 'archived_partitions', so move_data_from_user_table drops their
+    staging copies once appended.
+
+    :return: list of copy job configurations of the deferrable
+        append_user_partitions task
     """
-    query_job = client.query(delete_query)
-    query_job.result() 
+    partition_ids = context['ti'].xcom_pull(task_ids='plan_user_table_archival', key='sealed_partitions')
+    job_ids = context['ti'].xcom_pull(task_ids='archive_user_partitions')
+    client = bigquery.Client()
+    source_table_ref = Variable.get('user_data_table_name')
+    destination_table_ref = Variable.get('historic_user_data_table_name')
 
-    logging.info(f"Data moved from {source_table_ref} to {destination_table_ref} and deleted from source.")
+    archived = []
+    for partition_id, job_id in zip(partition_ids, job_ids):
+        row = next(iter(query_job_rows(job_id)))
+        if row['archived_rows']:
+            archived.append(partition_id)
+            logging.info(f"Removed partition {partition_id} ({row['archived_rows']} rows) from {source_table_ref}")
+            continue
+        if row['error']:
+            logging.warning(f"Could not remove partition {partition_id} from {source_table_ref}, "
+                            f"leaving it to a later run: {row['error']}")
+        else:
+            logging.warning(f"Partition {partition_id} of {source_table_ref} received rows since its copy, "
+                            f"leaving it to a later run")
+        client.delete_table(staging_table_name(destination_table_ref, partition_id), not_found_ok=True)
+
+    context['ti'].xcom_push(key='archived_partitions', value=archived)
+    return [
+        copy_job_configuration(client, staging_table_name(destination_table_ref, partition_id),
+                               f"{destination_table_ref}${partition_id}", 'WRITE_APPEND')
+        for partition_id in archived
+    ]
+
+
+def move_data_from_user_table(**context):
+    """
+    Commits the user watermark once the rows read by this run are archived,
+    by append_user_partitions or archive_user_table, and drops the staging
+    copies of the appended partitions.
+    """
+    watermark = context['ti'].xcom_pull(task_ids='get_test_questions', key='watermark')
+    if watermark is None:
+        logging.info("No user queries were read in this run. Watermark unchanged")
+        return
+
+    archived = context['ti'].xcom_pull(task_ids='plan_partition_appends', key='archived_partitions')
+    if archived:
+        client = bigquery.Client()
+        destination_table_ref = Variable.get('historic_user_data_table_name')
+        for partition_id in archived:
+            client.delete_table(staging_table_name(destination_table_ref, partition_id), not_found_ok=True)
+        logging.info(f"Archived {len(archived)} partitions to {destination_table_ref}")
+
+    Variable.set('user_data_watermark', watermark, serialize_json=True)
+    watermark_column = Variable.get('user_data_watermark_column', default_var='timestamp')
+    logging.info(f"Committed user data watermark {watermark_column} {watermark['value']}")
 
 
 def remove_punctuation(text):
@@ -90,20 +374,106 @@ def remove_punctuation(text):
     new_text = ''.join(e for e in text if e not in punts)
     return new_text
 
+def batched_similarity_search(client, queries):
+    """
+    Run the vector search of all queries as a single BigQuery job.
+
+    The queries are passed as one array parameter, embedded together and
+    searched with a single VECTOR_SEARCH whose query table holds one row per
+    query, so the job returns the top-k matches of every query at once.
+
+    :param client: bigquery.Client
+    :param queries: list of query strings
+    :return: dict of query to a list of {crn, full_info, score}
+    """
+    bq_query = """
+            WITH query_embedding AS (
+                SELECT content AS drift_query, ml_generate_embedding_result
+                FROM ML.GENERATE_EMBEDDING(
+                    MODEL `coursecompass.mlopsdataset.embeddings_model`,
+                    (SELECT new_query AS content FROM UNNEST(@new_queries) AS new_query)
+                )
+            ),
+            vector_search_results AS (
+                SELECT 
+                    query.drift_query,
+                    base.*,
+                    distance as search_distance
+                FROM VECTOR_SEARCH(
+                    (
+                        SELECT *
+                        FROM `coursecompass.mlopsdataset.banner_data_embeddings`
+                        WHERE ARRAY_LENGTH(ml_generate_embedding_result) = 768
+                    ),
+                    'ml_generate_embedding_result',
+                    TABLE query_embedding,
+                    query_column_to_search => 'ml_generate_embedding_result',
+                    distance_type => 'COSINE',
+                    top_k => {top_k},
+                    options => '{"use_brute_force": true}'
+                )
+            ),
+            course_matches AS (
+                SELECT 
+                    v.*,
+                    c.crn AS course_crn
+                FROM vector_search_results v
+                JOIN `coursecompass.mlopsdataset.course_data_table` c
+                    ON v.faculty_name = c.instructor
+            ),
+            review_data AS (
+                SELECT * EXCEPT(review_id)
+                FROM `coursecompass.mlopsdataset.review_data_table`
+            )
+            SELECT
+                cm.drift_query,
+                cm.course_crn AS crn,
+                cm.search_distance AS score,
+                CONCAT(
+                    'Course Information:\\n',
+                    cm.content,
+                    '\\nReview Information:\\n',
+                    STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; '),
+                    '\\n'
+                ) AS full_info
+            FROM course_matches cm
+            JOIN review_data AS review
+                ON cm.course_crn = review.crn
+            GROUP BY
+                cm.drift_query,
+                cm.course_crn,
+                cm.content,
+                cm.search_distance
+            ORDER BY cm.drift_query, score
+            """.replace("{top_k}", str(COURSE_SEARCH_TOP_K))
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("new_queries", "STRING", queries),
+        ]
+    )
+
+    results = {query: [] for query in queries}
+    for row in client.query(bq_query, job_config=job_config).result():
+        results[row.drift_query].append({'crn': row.crn, 'full_info': row.full_info, 'score': row.score})
+    return results
+
+
 def perform_similarity_search(**context):
     """
     Perform similarity search between course-prof pairs and PDF content using a vector search model.
 
-    This DAG task retrieves the initial queries from the previous task and generates new queries using the LLM.
-    It then performs a vector search on the generated queries to find the closest matching courses in the
-    BigQuery table specified by Variable.get('banner_table_name'). The results of the vector search are
-    then processed and saved to the 'similarity_results' XCom key.
+    This DAG task retrieves the drift queries from the previous task and finds the closest matching
+    courses for all of them at once. With the similarity_search_backend Variable set to 'bigquery'
+    (the default), the queries are searched in a single BigQuery VECTOR_SEARCH job; with 'local', they
+    are scored against the course embedding matrix kept by scripts/course_search.py. The results
+    are saved to the 'similarity_results' XCom key.
 
     Args:
         **context: Arbitrary keyword arguments. This can include Airflow context variables.
 
     Returns:
-        str: "stop_task" if the target sample count has been reached, or "generate_samples" to continue
+        str: "stop_task" if the search failed, or "generate_samples" to continue
         with the DAG run.
     """
 
@@ -113,150 +483,43 @@ def perform_similarity_search(**context):
         return False
     
     queries = context['ti'].xcom_pull(task_ids='data_drift_trend_task', key='drift_queries')
+    backend = Variable.get('similarity_search_backend', default_var='bigquery')
+    logging.info(f"Searching {len(queries)} drift queries with the {backend} backend")
 
-    client = bigquery.Client()
-    query_response = {}
-
-    for new_query in queries:
-        logging.info(f"Processing seed query: {new_query}")
-        bq_query = """
-                WITH query_embedding AS (
-                    SELECT ml_generate_embedding_result 
-                    FROM ML.GENERATE_EMBEDDING(
-                        MODEL `coursecompass.mlopsdataset.embeddings_model`,
-                        (SELECT @new_query AS content)
-                    )
-                ),
-                vector_search_results AS (
-                    SELECT 
-                        base.*,
-                        distance as search_distance
-                    FROM VECTOR_SEARCH(
-                        (
-                            SELECT *
-                            FROM `coursecompass.mlopsdataset.banner_data_embeddings`
-                            WHERE ARRAY_LENGTH(ml_generate_embedding_result) = 768
-                        ),
-                        'ml_generate_embedding_result',
-                        TABLE query_embedding,
-                        distance_type => 'COSINE',
-                        top_k => 5,
-                        options => '{"use_brute_force": true}'
-                    )
-                ),
-                course_matches AS (
-                    SELECT 
-                        v.*,
-                        c.crn AS course_crn
-                    FROM vector_search_results v
-                    JOIN `coursecompass.mlopsdataset.course_data_table` c
-                        ON v.faculty_name = c.instructor
-                ),
-                review_data AS (
-                    SELECT * EXCEPT(review_id)
-                    FROM `coursecompass.mlopsdataset.review_data_table`
-                )
-                SELECT DISTINCT
-                    cm.course_crn AS crn,
-                    cm.content,
-                    STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; ') AS concatenated_review_info,
-                    cm.search_distance AS score,
-                    CONCAT(
-                        'Course Information:\\n',
-                        cm.content,
-                        '\\nReview Information:\\n',
-                        STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; '),
-                        '\\n'
-                    ) AS full_info
-                FROM course_matches cm
-                JOIN review_data AS review
-                    ON cm.course_crn = review.crn
-                GROUP BY
-                    cm.course_crn,
-                    cm.content,
-                    cm.search_distance
-                """
-
-        query_params = [
-            bigquery.ScalarQueryParameter("new_query", "STRING", new_query),
-        ]
-
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=query_params
-        )
-
+    if backend == 'local':
+        search_results = local_similarity_search(queries)
+    else:
+        client = bigquery.Client()
         retry_count = 3
         for i in range(retry_count):
             try:
-                query_job = client.query(bq_query, job_config=job_config)
-                results = query_job.result()
+                search_results = batched_similarity_search(client, queries)
                 break
             except Exception as e:
                 logging.error(f"Error executing query: {e}")
                 if i == retry_count - 1:
                     return "stop_task"
-        
-
-        
-
-        result_crns = []
-        result_content = []
 
-        for row in results:
-            result_crns.append(row.crn)
-            result_content.append(remove_punctuation(row.full_info))
+    query_response = {}
+    for new_query, matches in search_results.items():
         query_response[new_query] = {
-            'crns': result_crns,
-            'final_content': '\n\n'.join(result_content)
+            'crns': [match['crn'] for match in matches],
+            'final_content': '\n\n'.join(remove_punctuation(match['full_info']) for match in matches)
         }
 
-            # logging.info(f"Similarity search results for query '{new_query}': {','.join(result_crns)}")
-   
     context['ti'].xcom_push(key='similarity_results', value=query_response)
     return "generate_samples"
 
-def upload_gcs_to_bq(**context):
-    """
-    Uploads the generated sample data from GCS to BigQuery.
-
-    This task will only run if the "check_sample_count" task does not return "stop_task".
-    Otherwise, this task will return "stop_task" without performing any actions.
-
-    The sample data is loaded from the 'processed_trace_data' folder in the default GCS bucket.
-    The data is uploaded to the table specified in the 'train_data_table_name' variable.
-
-    :param context: Airflow context object
-    :return: "generate_samples" if successful, "stop_task" if not
-    """
-    drift_status = context['ti'].xcom_pull(task_ids='data_drift_detection', key='data_drift')
-    if drift_status == False:
-        logging.info("No data drift detected. Not uploading to BigQuery")
-        return False
-
-    logging.info("Uploading to BigQuery")
-    load_to_bigquery = GCSToBigQueryOperator(
-        task_id='load_to_bigquery',
-        bucket=Variable.get('default_bucket_name'),
-        source_objects=['processed_trace_data/llm_train_data_drift.pq'],
-        destination_project_dataset_table=Variable.get('train_data_table_name'),
-        write_disposition='WRITE_APPEND',
-        autodetect=True,
-        skip_leading_rows=1,
-        dag=context['dag'],
-        source_format='PARQUET', 
-    )
-
-    load_to_bigquery.execute(context=context)
-    return True
-
-def insert_drift_history_into_table(detected_drift_queries):
+def insert_drift_history_into_table(detected_drift_queries, timestamp):
     """
-        Insert the drift detected into the data_drift_table
+    Insert the drift detected into the data_drift_table with one load job.
 
+    :param detected_drift_queries: list of {query, similarity} dicts
+    :param timestamp: run timestamp as a "%Y-%m-%d %H:%M:%S" string
+    :return: True if the rows were inserted
     """
     client = bigquery.Client()
     table_id = Variable.get('data_drift_table_name')
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     rows_to_insert = []
 
     for query in detected_drift_queries:
@@ -268,27 +531,39 @@ def insert_drift_history_into_table(detected_drift_queries):
             }
         )
 
-    errors = client.load_table_from_json(table_id, rows_to_insert)
-    if errors == []:
-        logging.info(f"Inserted {len(rows_to_insert)} rows into {table_id}")
-    else:
-        logging.error(f"Errors: {errors}")
+    load_job = client.load_table_from_json(rows_to_insert, table_id)
+    try:
+        load_job.result()
+    except Exception as e:
+        logging.error(f"Errors: {load_job.errors or e}")
+        return False
+    logging.info(f"Inserted {len(rows_to_insert)} rows into {table_id}")
+    return True
+
+
+def _since_parameter(since):
+    return bigquery.ScalarQueryParameter('since', 'TIMESTAMP', datetime.strptime(since, "%Y-%m-%d %H:%M:%S"))
+
 
-def fetch_drift_history(query_condition):
+def fetch_drift_history(since):
     """
-        Fetch the drift history from the data_drift_table
+    Fetch the drift queries recorded after a timestamp from the data_drift_table.
+
+    The timestamp is a query parameter, so with the table partitioned by
+    DATE(timestamp) only the partitions of the window are read.
+
+    :param since: "%Y-%m-%d %H:%M:%S" string, exclusive
+    :return: list of {query, distance, timestamp}
     """
     client = bigquery.Client()
     table_id = Variable.get('data_drift_table_name')
-    drift_last_detected_at = Variable.get('drift_last_detected_at')
     query = f"""
-        SELECT *
-        FROM {table_id}
-        WHERE timestamp > '{query_condition}'
+        SELECT query, distance, timestamp
+        FROM `{table_id}`
+        WHERE timestamp > @since
     """
-
-    query_job = client.query(query)
-    results = query_job.result()
+    job_config = bigquery.QueryJobConfig(query_parameters=[_since_parameter(since)])
+    results = client.query(query, job_config=job_config).result()
 
     drift_history = []
     for row in results:
@@ -301,4 +576,34 @@ def fetch_drift_history(query_condition):
         )
 
     return drift_history
-    
\ No newline at end of file
+
+
+def fetch_drift_history_aggregates(since):
+    """
+    Per-run aggregates of the drift queries recorded after a timestamp, to
+    rebuild scripts/drift_history.DriftHistory when its state is missing.
+
+    :param since: "%Y-%m-%d %H:%M:%S" string, exclusive
+    :return: list of {timestamp, count, sum, squares, min, max} in timestamp order
+    """
+    client = bigquery.Client()
+    table_id = Variable.get('data_drift_table_name')
+    query = f"""
+        SELECT
+            FORMAT_TIMESTAMP('%Y-%m-%d %H:%M:%S', timestamp) AS timestamp,
+            COUNT(*) AS count,
+            SUM(distance) AS sum,
+            SUM(distance * distance) AS squares,
+            MIN(distance) AS min,
+            MAX(distance) AS max
+        FROM `{table_id}`
+        WHERE timestamp > @since
+        GROUP BY 1
+        ORDER BY 1
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[_since_parameter(since)])
+    return [
+        {'timestamp': row['timestamp'], 'count': row['count'], 'sum': row['sum'], 'squares': row['squares'],
+         'min': row['min'], 'max': row['max']}
+        for row in client.query(query, job_config=job_config).result()
+    ]
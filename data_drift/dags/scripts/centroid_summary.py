@@ -0,0 +1,258 @@
+import logging
+import numpy as np
+from scripts.similarity_engine import to_normalized_matrix
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_N_CENTROIDS = 256
+DEFAULT_BOUNDARY_POINTS = 16
+BATCH_SIZE = 4096
+N_BATCHES = 50
+ASSIGN_BLOCK = 8192
+# refit from scratch once this fraction of the rows arrived through updates
+REFIT_FRACTION = 0.5
+
+
+def _assign(embeddings, centroids):
+    """
+    Nearest centroid and its similarity for every row, in blocks.
+    """
+    labels = np.empty(embeddings.shape[0], dtype=np.int64)
+    sims = np.empty(embeddings.shape[0], dtype=np.float32)
+    for start in range(0, embeddings.shape[0], ASSIGN_BLOCK):
+        block_sims = embeddings[start:start + ASSIGN_BLOCK] @ centroids.T
+        labels[start:start + ASSIGN_BLOCK] = block_sims.argmax(axis=1)
+        sims[start:start + ASSIGN_BLOCK] = block_sims.max(axis=1)
+    return labels, sims
+
+
+def _cluster_sums(points, labels, k):
+    """
+    Sum of the points of every cluster, as one-hot matrix products in blocks.
+    """
+    sums = np.zeros((k, points.shape[1]), dtype=np.float64)
+    for start in range(0, points.shape[0], ASSIGN_BLOCK):
+        block_labels = labels[start:start + ASSIGN_BLOCK]
+        one_hot = np.zeros((block_labels.size, k), dtype=points.dtype)
+        one_hot[np.arange(block_labels.size), block_labels] = 1
+        sums += one_hot.T @ points[start:start + ASSIGN_BLOCK]
+    return sums
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _kmeans_plus_plus(sample, k, rng):
+    """
+    k-means++ seeding on the sphere, with 1 - cosine similarity as distance.
+    """
+    centroids = [sample[rng.integers(sample.shape[0])]]
+    distances = 1 - sample @ centroids[0]
+    for _ in range(1, k):
+        weights = np.clip(distances, 0, None)
+        total = weights.sum()
+        index = rng.choice(sample.shape[0], p=weights / total) if total > 0 else rng.integers(sample.shape[0])
+        centroids.append(sample[index])
+        np.minimum(distances, 1 - sample @ sample[index], out=distances)
+    return np.stack(centroids)
+
+
+class CentroidSummary:
+    """
+    Summary of the train embeddings as k spherical clusters.
+
+    Every cluster keeps its unit centroid, the sum and count of its members
+    (so new rows can be folded in without the old ones), its angular radius
+    and its boundary points, the members least similar to the centroid.
+
+    Test queries are scored against the k centroids and their boundary points
+    instead of all N train embeddings:
+
+    - 'min' is the lowest similarity to any boundary point. Since those are a
+      subset of the train set it never underestimates the exact minimum; the
+      lowest similarity to a cluster is usually reached at a boundary point,
+      which keeps the gap small.
+    - 'min_lower_bound' is a guaranteed lower bound of the exact minimum from
+      the radii: every member of a cluster lies within its radius of the
+      centroid, so its similarity is at least cos(angle to centroid + radius).
+    - 'max' is the highest similarity to a boundary point, a lower bound of
+      the exact nearest similarity.
+    """
+
+    def __init__(self, centroids, sums, counts, radii, boundary, boundary_labels, keys, fitted_count):
+        self.centroids = centroids
+        self.sums = sums
+        self.counts = counts
+        self.radii = radii
+        self.boundary = boundary
+        self.boundary_labels = boundary_labels
+        self.keys = keys
+        self.fitted_count = fitted_count
+
+    @classmethod
+    def fit(cls, embeddings, keys, n_centroids=DEFAULT_N_CENTROIDS, boundary_points=DEFAULT_BOUNDARY_POINTS,
+            batch_size=BATCH_SIZE, n_batches=N_BATCHES, seed=0):
+        """
+        Fit the summary with mini-batch spherical k-means.
+
+        Centroids are seeded with k-means++ on a sample, moved with per-cluster
+        learning rates over n_batches mini-batches, and finally set to the
+        normalized mean of their members in one full pass, which also yields
+        the radii and boundary points.
+
+        :param embeddings: (n, dim) train embeddings
+        :param keys: uint64 keys identifying the train rows
+        :param n_centroids: number of clusters k
+        :param boundary_points: boundary points kept per cluster
+        :return: CentroidSummary
+        """
+        train = to_normalized_matrix(embeddings)
+        n = train.shape[0]
+        if n == 0:
+            raise ValueError("At least one train embedding is needed to fit a centroid summary")
+        k = min(n_centroids, n)
+        rng = np.random.default_rng(seed)
+
+        sample = train[rng.choice(n, min(n, max(20 * k, batch_size)), replace=False)]
+        centroids = _kmeans_plus_plus(sample, k, rng)
+        seen = np.zeros(k, dtype=np.float64)
+        for _ in range(n_batches):
+            batch = train[rng.choice(n, min(batch_size, n), replace=False)]
+            labels = (batch @ centroids.T).argmax(axis=1)
+            batch_counts = np.bincount(labels, minlength=k)
+            batch_sums = _cluster_sums(batch, labels, k)
+            moved = batch_counts > 0
+            seen[moved] += batch_counts[moved]
+            rate = (batch_counts[moved] / seen[moved])[:, None]
+            centroids[moved] = (1 - rate) * centroids[moved] + rate * batch_sums[moved] / batch_counts[moved][:, None]
+            centroids = _normalize_rows(centroids).astype(np.float32)
+
+        labels, _ = _assign(train, centroids)
+        sums = _cluster_sums(train, labels, k)
+        counts = np.bincount(labels, minlength=k).astype(np.int64)
+        centroids = np.where(counts[:, None] > 0, _normalize_rows(sums), centroids).astype(np.float32)
+
+        summary = cls(centroids, sums, counts, np.zeros(k, dtype=np.float32),
+                      np.empty((0, train.shape[1]), dtype=np.float32), np.empty(0, dtype=np.int64),
+                      np.asarray(keys, dtype=np.uint64), n)
+        summary._set_boundary(train, labels, np.arange(k), boundary_points)
+        logging.info(f"Fitted {k} centroids to {n} train embeddings, "
+                     f"median radius {np.degrees(np.median(summary.radii)):.1f} degrees")
+        return summary
+
+    def _set_boundary(self, points, labels, clusters, boundary_points):
+        """
+        Recompute the radius and boundary points of the given clusters from
+        candidate points and their cluster labels (all members of those
+        clusters, or their previous boundary plus new members).
+        """
+        sims = np.einsum('ij,ij->i', points, self.centroids[labels])
+        keep = ~np.isin(self.boundary_labels, clusters)
+        new_boundary, new_labels = [self.boundary[keep]], [self.boundary_labels[keep]]
+        # members grouped by cluster, least similar to their centroid first
+        order = np.lexsort((sims, labels))
+        starts = np.searchsorted(labels[order], clusters, side='left')
+        ends = np.searchsorted(labels[order], clusters, side='right')
+        for cluster, start, end in zip(clusters, starts, ends):
+            if start == end:
+                continue
+            farthest = order[start:min(end, start + boundary_points)]
+            self.radii[cluster] = max(self.radii[cluster], float(np.arccos(np.clip(sims[farthest[0]], -1, 1))))
+            new_boundary.append(points[farthest])
+            new_labels.append(np.full(farthest.size, cluster, dtype=np.int64))
+        self.boundary = np.concatenate(new_boundary).astype(np.float32)
+        self.boundary_labels = np.concatenate(new_labels)
+
+    def update(self, embeddings, keys, boundary_points=DEFAULT_BOUNDARY_POINTS):
+        """
+        Fold train rows the summary has not seen into their nearest clusters.
+
+        Centroids move to the normalized mean of old and new members. The
+        radius of a moved cluster grows by the angle its centroid moved, which
+        keeps it valid for the old members without revisiting them.
+
+        :param embeddings: (n, dim) embeddings of the new rows only
+        :param keys: uint64 keys of the new rows
+        """
+        new = to_normalized_matrix(embeddings)
+        if new.shape[0] == 0:
+            return
+        labels, _ = _assign(new, self.centroids)
+        self.sums += _cluster_sums(new, labels, len(self.counts))
+        self.counts += np.bincount(labels, minlength=len(self.counts))
+
+        clusters = np.unique(labels)
+        moved_centroids = _normalize_rows(self.sums[clusters]).astype(np.float32)
+        shift = np.arccos(np.clip(np.einsum('ij,ij->i', moved_centroids, self.centroids[clusters]), -1, 1))
+        self.centroids[clusters] = moved_centroids
+        self.radii[clusters] += shift
+
+        old = np.isin(self.boundary_labels, clusters)
+        candidates = np.concatenate([self.boundary[old], new])
+        candidate_labels = np.concatenate([self.boundary_labels[old], labels])
+        self._set_boundary(candidates, candidate_labels, clusters, boundary_points)
+        self.keys = np.concatenate([self.keys, np.asarray(keys, dtype=np.uint64)])
+        logging.info(f"Updated {len(clusters)} centroids with {new.shape[0]} new train embeddings")
+
+    def needs_refit(self):
+        return len(self.keys) - self.fitted_count > REFIT_FRACTION * self.fitted_count
+
+    def score(self, test_embeddings):
+        """
+        Score test queries against the summary in O(k) per query.
+
+        :param test_embeddings: (n_test, dim) embeddings
+        :return: dict with 'min', 'max' and 'min_lower_bound' similarity per query
+        """
+        test = to_normalized_matrix(test_embeddings)
+        sims = test @ self.boundary.T
+        occupied = self.counts > 0
+        angles = np.arccos(np.clip(test @ self.centroids[occupied].T, -1, 1))
+        return {
+            'min': sims.min(axis=1),
+            'max': sims.max(axis=1),
+            'min_lower_bound': np.cos(np.minimum(angles + self.radii[occupied], np.pi)).min(axis=1),
+        }
+
+    def to_arrays(self):
+        return {
+            'centroids': self.centroids, 'sums': self.sums, 'counts': self.counts, 'radii': self.radii,
+            'boundary': self.boundary, 'boundary_labels': self.boundary_labels, 'keys': self.keys,
+            'fitted_count': np.array(self.fitted_count),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['centroids'], arrays['sums'], arrays['counts'], arrays['radii'], arrays['boundary'],
+                   arrays['boundary_labels'], arrays['keys'], int(arrays['fitted_count']))
+
+
+def refresh_summary(summary, embeddings, keys, n_centroids=DEFAULT_N_CENTROIDS,
+                    boundary_points=DEFAULT_BOUNDARY_POINTS):
+    """
+    Bring a summary up to date with the current train set.
+
+    The summary is fitted when there is none, when its k differs from
+    n_centroids, when the embedding dimension changed or when too many rows arrived through updates since the last
+    fit; otherwise only the rows it has not seen are folded in.
+
+    :param summary: CentroidSummary of an earlier run, or None
+    :param embeddings: (n, dim) embeddings of the whole train set
+    :param keys: uint64 keys of the train set
+    :return: tuple of the up to date summary and whether it changed
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    if (summary is None or len(summary.centroids) != min(n_centroids, len(keys))
+            or summary.centroids.shape[1] != np.shape(embeddings)[1] or summary.needs_refit()):
+        return CentroidSummary.fit(embeddings, keys, n_centroids, boundary_points), True
+
+    new_rows = np.flatnonzero(~np.isin(keys, summary.keys))
+    if new_rows.size == 0:
+        return summary, False
+    summary.update(np.asarray(embeddings)[new_rows], keys[new_rows], boundary_points)
+    if summary.needs_refit():
+        return CentroidSummary.fit(embeddings, keys, n_centroids, boundary_points), True
+    return summary, True
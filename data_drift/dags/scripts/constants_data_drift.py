@@ -4,10 +4,31 @@ from vertexai.generative_models import GenerativeModel
 PROJECT_ID = "coursecompass"
 TARGET_SAMPLE_COUNT = 500
 GENERATED_SAMPLE_COUNT = 50
+# Generated train data shards: <prefix>-NNNNN.parquet, see scripts/parquet_shards.py
+TRAIN_DATA_PREFIX = "llm_train_data_drift"
+# Location of the BigQuery datasets, where the DAG's deferrable query jobs run
+BIGQUERY_LOCATION = "US"
+# Columns identifying a user row, and the columns the backend updates after writing it
+# (UPDATE_FEEDBACK_QUERY in backend/app/constants/bq_queries.py), see scripts/partition_archive.py
+USER_ROW_KEY_COLUMNS = ("session_id", "query_id")
+USER_ROW_UPDATABLE_COLUMNS = ("feedback",)
+
+EMBEDDING_MODEL_NAME = "text-embedding-005"
+EMBEDDING_TASK = "CLUSTERING"
+# Remote BigQuery model and task type the backend embeds user queries with
+# (SIMILARITY_QUERY in backend/app/constants/bq_queries.py passes no task type).
+# Serving embeddings are only reused when they match EMBEDDING_TASK too
+SERVING_EMBEDDING_MODEL = "coursecompass.mlopsdataset.embeddings_model"
+SERVING_EMBEDDING_TASK = "MODEL_DEFAULT"
+
+# Local course search, see scripts/course_search.py
+COURSE_SEARCH_TASK = "RETRIEVAL_QUERY"
+COURSE_SEARCH_TOP_K = 5
 
 # Initialize Vertex AI
 vertexai.init(project=PROJECT_ID, location="us-central1")
-CLIENT_MODEL = GenerativeModel(model_name="gemini-1.5-flash-002")
+LLM_MODEL_NAME = "gemini-1.5-flash-002"
+CLIENT_MODEL = GenerativeModel(model_name=LLM_MODEL_NAME)
 
 LLM_PROMPT_TEMPLATE = """          
     Given the user question and the relevant information from the database, craft a concise and informative response:
@@ -0,0 +1,135 @@
+import time
+import logging
+import numpy as np
+from google.cloud import bigquery
+from airflow.models import Variable
+from vertexai.language_models import TextEmbeddingModel
+from scripts.artifact_utils import load_state, save_state, load_state_array, save_state_array
+from scripts.embedding_cache import embed_with_cache
+from scripts.embedding_client import EmbeddingClient
+from scripts.similarity_engine import similarity_stats
+from scripts.constants_data_drift import EMBEDDING_MODEL_NAME, COURSE_SEARCH_TASK, COURSE_SEARCH_TOP_K
+
+logging.basicConfig(level=logging.INFO)
+
+COURSE_INDEX_QUERY = """
+    WITH course_matches AS (
+        SELECT
+            b.faculty_name,
+            b.content,
+            b.ml_generate_embedding_result AS embedding,
+            c.crn
+        FROM `coursecompass.mlopsdataset.banner_data_embeddings` b
+        JOIN `coursecompass.mlopsdataset.course_data_table` c
+            ON b.faculty_name = c.instructor
+        WHERE ARRAY_LENGTH(b.ml_generate_embedding_result) = 768
+    ),
+    review_data AS (
+        SELECT * EXCEPT(review_id)
+        FROM `coursecompass.mlopsdataset.review_data_table`
+    )
+    SELECT
+        cm.faculty_name,
+        cm.content,
+        cm.crn,
+        ANY_VALUE(cm.embedding) AS embedding,
+        CONCAT(
+            'Course Information:\\n',
+            cm.content,
+            '\\nReview Information:\\n',
+            STRING_AGG(CONCAT(review.question, '\\n', review.response, '\\n'), '; '),
+            '\\n'
+        ) AS full_info
+    FROM course_matches cm
+    JOIN review_data AS review
+        ON cm.crn = review.crn
+    GROUP BY
+        cm.faculty_name,
+        cm.content,
+        cm.crn
+    """
+
+
+def build_course_index():
+    """
+    Read the course embedding matrix from BigQuery, together with the course
+    information each banner row expands to.
+
+    :return: tuple of the (n, 768) float32 matrix of banner row embeddings and,
+        per row, the list of {crn, full_info} of its courses
+    """
+    client = bigquery.Client()
+    row_index = {}
+    embeddings, courses = [], []
+    for row in client.query(COURSE_INDEX_QUERY).result():
+        key = (row['faculty_name'], row['content'])
+        if key not in row_index:
+            row_index[key] = len(embeddings)
+            embeddings.append(row['embedding'])
+            courses.append([])
+        courses[row_index[key]].append({'crn': row['crn'], 'full_info': row['full_info']})
+
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    logging.info(f"Built course index of {len(courses)} banner rows and {sum(len(c) for c in courses)} courses")
+    return matrix, courses
+
+
+def load_course_index():
+    """
+    Load the course index persisted by an earlier run, rebuilding it from
+    BigQuery once it is older than the course_index_max_age_hours Variable.
+
+    :return: tuple of the embedding matrix and the courses per row
+    """
+    max_age_hours = float(Variable.get('course_index_max_age_hours', default_var=24))
+    state = load_state('course_index')
+    if state is not None and time.time() - state['built_at'] < max_age_hours * 3600:
+        matrix = load_state_array('course_index_embeddings')
+        if matrix is not None and matrix.shape[0] == len(state['courses']):
+            return matrix, state['courses']
+
+    matrix, courses = build_course_index()
+    save_state_array('course_index_embeddings', matrix)
+    save_state('course_index', {'built_at': time.time(), 'courses': courses})
+    return matrix, courses
+
+
+def embed_search_queries(queries):
+    """
+    Embed search queries as retrieval queries, through the embedding cache.
+    """
+    client = EmbeddingClient(
+        TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME),
+        task=COURSE_SEARCH_TASK,
+        max_workers=int(Variable.get('embedding_max_workers', default_var=4)),
+        requests_per_second=float(Variable.get('embedding_requests_per_second', default_var=5)),
+    )
+    embeddings, _ = embed_with_cache(queries, EMBEDDING_MODEL_NAME, COURSE_SEARCH_TASK, client.embed)
+    return embeddings
+
+
+def local_similarity_search(queries, top_k=COURSE_SEARCH_TOP_K):
+    """
+    Find the courses closest to each query with the local course embedding
+    matrix instead of a BigQuery VECTOR_SEARCH.
+
+    All queries are scored against the matrix in one blocked multiply and
+    every one of the top_k nearest banner rows expands to its courses, as in
+    the BigQuery search.
+
+    :param queries: list of query strings
+    :param top_k: number of nearest banner rows per query
+    :return: dict of query to a list of {crn, full_info, score}, where score is
+        the cosine distance
+    """
+    matrix, courses = load_course_index()
+    results = {query: [] for query in queries}
+    if not queries or matrix.shape[0] == 0:
+        return results
+
+    stats = similarity_stats(embed_search_queries(queries), matrix, top_k=top_k)
+    for query, neighbors, similarities in zip(queries, stats['neighbors'], stats['neighbor_similarities']):
+        for row, similarity in zip(neighbors, similarities):
+            for course in courses[row]:
+                results[query].append({**course, 'score': 1 - float(similarity)})
+    return results
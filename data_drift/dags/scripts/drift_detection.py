@@ -1,139 +1,736 @@
 
 from datetime import datetime, timedelta
-from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
-from sklearn.metrics.pairwise import cosine_similarity
+import hashlib
+from vertexai.language_models import TextEmbeddingModel
 import numpy as np
 import logging
-from scripts.backoff import exponential_backoff
-from scripts.bigquery_utils_data_drift import insert_drift_history_into_table, fetch_drift_history
-from airflow.models import Variable
+from scripts.similarity_engine import similarity_stats, DEFAULT_MEMORY_LIMIT_MB
+from scripts.threshold_calibration import calibrate_thresholds, EXACT_MAX_N, SAMPLE_PAIRS
+from scripts.embedding_cache import EmbeddingCache, embed_with_cache, embedding_key, embedding_identity, normalize_text
+from scripts.centroid_summary import CentroidSummary, refresh_summary, DEFAULT_N_CENTROIDS
+from scripts.lexical_prescreen import MinHasher, LSHIndex, JACCARD_THRESHOLD
+from scripts.embedding_client import EmbeddingClient, pack_batches
+from scripts.artifact_utils import save_array, load_array, load_state, save_state, load_state_arrays, save_state_arrays
+from scripts.constants_data_drift import EMBEDDING_MODEL_NAME, EMBEDDING_TASK
+from scripts.bigquery_utils_data_drift import insert_drift_history_into_table, fetch_drift_history, fetch_drift_history_aggregates, get_serving_embeddings
+from scripts.drift_history import DriftHistory, TIMESTAMP_FORMAT, RETENTION_DAYS
+from airflow.models import Variable, Pool
 
 logging.basicConfig(level=logging.INFO)
 
 
-@exponential_backoff()
-def get_embeddings(model, model_inputs):
-    embeddings = model.get_embeddings(model_inputs)
-    return embeddings
+def embed_texts(texts, task=EMBEDDING_TASK, requests_per_second=None):
+    """
+    Embed texts with the Vertex AI embedding model, packing them into as few
+    calls as the model limits allow and running the calls concurrently under
+    an adaptive rate limit.
 
+    :param requests_per_second: request rate, the embedding_requests_per_second
+        Variable if None
+    :return: tuple of the list of embeddings and the number of API calls made
+    """
+    if requests_per_second is None:
+        requests_per_second = float(Variable.get('embedding_requests_per_second', default_var=5))
+    client = EmbeddingClient(
+        TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME),
+        task=task,
+        max_workers=int(Variable.get('embedding_max_workers', default_var=4)),
+        requests_per_second=requests_per_second,
+    )
+    return client.embed(texts)
 
-def get_train_embeddings(**context):
-    train_questions = context['ti'].xcom_pull(task_ids='get_train_questions', key='questions')
 
-    task = "CLUSTERING"
-    model = TextEmbeddingModel.from_pretrained("text-embedding-005")
-    batch_size = 4
-    embeddings = []
-    query_inputs = [TextEmbeddingInput(question, task) for question in train_questions]
-    logging.info("Getting train embeddings")
-    for i in range(0, len(query_inputs), batch_size):
-        query_embeddings = get_embeddings(model, query_inputs[i:i+batch_size])
-        embeddings.extend([embedding.values for embedding in query_embeddings])
-    logging.info(f"Got train embeddings {len(query_embeddings)}")
-    logging.info(f"Sample embeddings: {embeddings[0]}")
-    context['ti'].xcom_push(key='train_embeddings', value=embeddings)
-    return embeddings
+def embed_questions(questions, label, cache=None, requests_per_second=None, save=True):
+    """
+    Embed questions through the persistent embedding cache, so that only
+    questions not embedded in earlier runs are sent to Vertex AI.
+
+    :param cache: loaded EmbeddingCache, or None to load it from the Variables
+    :param save: write new embeddings back to the cache
+    :return: tuple of the (n, dim) embedding matrix and the cache stats
+    """
+    logging.info(f"Getting {label} embeddings")
+    embed_fn = lambda texts: embed_texts(texts, requests_per_second=requests_per_second)
+    embeddings, stats = embed_with_cache(questions, EMBEDDING_MODEL_NAME, EMBEDDING_TASK, embed_fn, cache, save)
+    stats['api_calls_saved'] = len(pack_batches(questions)) - stats['api_calls']
+    logging.info(f"Got {len(embeddings)} {label} embeddings: hit rate {stats['hit_rate']:.1%}, "
+                 f"{stats['api_calls']} API calls made, {stats['api_calls_saved']} saved")
+    return embeddings, stats
+
+
+# task and key of the questions each branch embeds
+QUESTION_SOURCES = {
+    'train': ('get_train_questions', 'questions'),
+    'test': ('prescreen_test_questions', 'questions'),
+}
+EMBEDDING_SHARD_SIZE = 5000
+MAX_EMBEDDING_SHARDS = 16
+MAX_ACTIVE_SHARDS = 4
+# pool shared by the shard tasks of both branches, so that the embedding
+# request quota is split between all shards that can run at the same time
+EMBEDDING_POOL = 'embedding_shards'
+
+
+def embedding_pool_slots():
+    """
+    Number of shard tasks of both branches that can run at the same time: the
+    slots of EMBEDDING_POOL, or MAX_ACTIVE_SHARDS per branch without the pool.
+    """
+    pool = Pool.get_pool(EMBEDDING_POOL)
+    return pool.slots if pool is not None else 2 * MAX_ACTIVE_SHARDS
+
+
+def plan_embedding_shards(label, **context):
+    """
+    Split the questions of a branch into the shards embedded by the mapped
+    embed_<label>_shard tasks.
+
+    Shards hold embedding_shard_size questions, or more when that would make
+    more than MAX_EMBEDDING_SHARDS of them. The embedding request rate is split
+    between the shards of both branches that can run at the same time, the
+    slots of EMBEDDING_POOL, so the branches together stay within it. For the test branch,
+    the query embeddings stored by the backend are saved with the positions
+    of their questions to the run-scoped serving_embeddings artifacts, which
+    the shards read instead of embedding those questions. They are kept out
+    of the persistent cache, which only holds embeddings computed by the
+    pipeline itself.
+
+    :param label: 'train' or 'test'
+    :return: list of op_kwargs of the shard tasks
+    """
+    task_id, key = QUESTION_SOURCES[label]
+    questions = context['ti'].xcom_pull(task_ids=task_id, key=key) or []
+
+    if label == 'test' and questions:
+        # the backend already embedded most user queries for the course search
+        serving_embeddings = get_serving_embeddings(**context)
+        positions = [i for i, question in enumerate(questions) if question in serving_embeddings]
+        if positions:
+            context['ti'].xcom_push(key='serving_embeddings', value={
+                'positions': save_array(np.array(positions, dtype=np.int64), context, 'serving_positions'),
+                'embeddings': save_array(np.array([serving_embeddings[questions[i]] for i in positions],
+                                                  dtype=np.float32), context, 'serving_embeddings'),
+            })
+        context['ti'].xcom_push(key='serving_embeddings_reused', value=len(positions))
+
+    shard_size = max(int(Variable.get('embedding_shard_size', default_var=EMBEDDING_SHARD_SIZE)),
+                     -(-len(questions) // MAX_EMBEDDING_SHARDS), 1)
+    bounds = [(start, min(start + shard_size, len(questions))) for start in range(0, len(questions), shard_size)]
+    requests_per_second = float(Variable.get('embedding_requests_per_second', default_var=5))
+    shard_rate = requests_per_second / max(embedding_pool_slots(), 1)
+
+    logging.info(f"Embedding {len(questions)} {label} questions in {len(bounds)} shards of up to {shard_size}")
+    return [{'label': label, 'shard': shard, 'start': start, 'stop': stop, 'requests_per_second': shard_rate}
+            for shard, (start, stop) in enumerate(bounds)]
+
+
+def embed_question_shard(label, shard, start, stop, requests_per_second, **context):
+    """
+    Embed one shard of the questions of a branch into a run-scoped artifact.
+
+    Test questions with a serving embedding (see plan_embedding_shards) take
+    it as is, the others are embedded through the cache. The cache is only
+    read here: concurrent shards would overwrite each other's uploads, so new
+    embeddings are written back once by gather_embeddings.
+
+    :return: dict with the artifact reference of the shard and its cache stats
+    """
+    task_id, key = QUESTION_SOURCES[label]
+    questions = context['ti'].xcom_pull(task_ids=task_id, key=key)[start:stop]
+
+    served, vectors = serving_embeddings_of(label, start, stop, **context)
+    pending = np.setdiff1d(np.arange(len(questions)), served)
+    embedded, stats = embed_questions([questions[i] for i in pending], f"{label} shard {shard}",
+                                      requests_per_second=requests_per_second, save=False)
+    stats['served'] = len(served)
+
+    dim = embedded.shape[1] if len(pending) else vectors.shape[1] if len(served) else 0
+    embeddings = np.empty((len(questions), dim), dtype=np.float32)
+    if len(pending):
+        embeddings[pending] = embedded
+    if len(served):
+        embeddings[served] = vectors
+    ref = save_array(embeddings, context, f"{label}_embeddings_{shard}")
+    return {'shard': shard, 'embeddings': ref, 'stats': stats}
+
+
+def serving_embeddings_of(label, start, stop, **context):
+    """
+    Serving embeddings of the questions start to stop of a branch, saved by
+    plan_embedding_shards.
+
+    :return: tuple of the positions of the questions relative to start and
+        the (n, dim) matrix of their embeddings
+    """
+    serving = context['ti'].xcom_pull(task_ids=f'plan_{label}_shards', key='serving_embeddings') if label == 'test' else None
+    if not serving:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    positions = load_array(serving['positions'])
+    selected = (positions >= start) & (positions < stop)
+    return positions[selected] - start, np.asarray(load_array(serving['embeddings'])[selected])
+
+
+def gather_embeddings(label, **context):
+    """
+    Concatenate the shard artifacts of a branch into the <label>_embeddings
+    artifact, in question order, and write the embeddings computed by the
+    pipeline to the cache. Serving embeddings are not written to it.
+    """
+    task_id, key = QUESTION_SOURCES[label]
+    questions = context['ti'].xcom_pull(task_ids=task_id, key=key) or []
+    shards = context['ti'].xcom_pull(task_ids=f'embed_{label}_shard') or []
+    shards = sorted((shard for shard in shards if shard), key=lambda shard: shard['shard'])
+
+    arrays = [load_array(shard['embeddings']) for shard in shards]
+    arrays = [array for array in arrays if array.shape[0]]
+    embeddings = np.concatenate(arrays) if arrays else np.empty((0, 0), dtype=np.float32)
+    if embeddings.shape[0] != len(questions):
+        raise ValueError(f"Got {embeddings.shape[0]} {label} embeddings from {len(shards)} shards for {len(questions)} questions")
+
+    stats = {name: sum(shard['stats'][name] for shard in shards)
+             for name in ('texts', 'hits', 'misses', 'api_calls', 'api_calls_saved')}
+    stats['hit_rate'] = stats['hits'] / stats['texts'] if stats['texts'] else 0.0
+    if label == 'test':
+        stats['serving_embeddings_reused'] = sum(shard['stats'].get('served', 0) for shard in shards)
+    if stats['misses']:
+        served, _ = serving_embeddings_of(label, 0, len(questions), **context)
+        embedded = np.setdiff1d(np.arange(len(questions)), served)
+        cache = EmbeddingCache.from_variables().load()
+        cache.put_many([embedding_key(EMBEDDING_MODEL_NAME, EMBEDDING_TASK, questions[i]) for i in embedded],
+                       embeddings[embedded])
+        cache.save()
+
+    # XCom only carries a reference, the matrix itself goes to a run-scoped artifact
+    embeddings_ref = save_array(embeddings, context, f'{label}_embeddings')
+    context['ti'].xcom_push(key=f'{label}_embeddings', value=embeddings_ref)
+    context['ti'].xcom_push(key='embedding_cache_stats', value=stats)
+    return embeddings_ref
 
-def get_test_embeddings(**context):
+
+def load_train_signatures(train_questions, hasher):
+    """
+    MinHash signatures of the train questions, computing only those of the
+    questions added since the previous run.
+    """
+    keys = row_keys(train_questions)
+    state = load_state_arrays('prescreen_signatures')
+    signatures = np.empty((len(keys), hasher.num_perm), dtype=np.uint32)
+    missing = np.ones(len(keys), dtype=bool)
+    if state is not None and state['signatures'].shape[1] == hasher.num_perm:
+        order = np.argsort(state['keys'])
+        positions = np.clip(np.searchsorted(state['keys'], keys, sorter=order), 0, max(len(order) - 1, 0))
+        if len(order):
+            found = state['keys'][order[positions]] == keys
+            signatures[found] = state['signatures'][order[positions[found]]]
+            missing = ~found
+
+    if missing.any():
+        signatures[missing] = hasher.signatures([train_questions[i] for i in np.flatnonzero(missing)])
+        save_state_arrays('prescreen_signatures', {'keys': keys, 'signatures': signatures})
+    logging.info(f"Computed MinHash signatures of {missing.sum()} of {len(keys)} train questions")
+    return signatures
+
+
+def audit_sample(question, fraction):
+    """
+    Deterministic sample of the prescreened questions that still go through
+    embedding and full scoring, to measure the agreement of the prescreen.
+    """
+    return int.from_bytes(hashlib.sha256(question.encode('utf-8')).digest()[:4], 'big') < fraction * 2 ** 32
+
+
+def prescreen_test_questions(**context):
+    """
+    Mark test questions that are near-copies of a train question as
+    in-distribution without embedding them.
+
+    Each test question is matched to the train questions by MinHash/LSH over
+    character 3-grams. Those whose best match reaches the
+    prescreen_jaccard_threshold Variable are left out of embedding and
+    scoring, except for the audit sample drawn with prescreen_audit_fraction,
+    whose full scores detect_data_drift compares with the prescreen. The
+    train question each skipped question matched is saved to the run-scoped
+    prescreen_matches artifact, in test question order, so that
+    compute_distribution_shift can stand in its embedding.
+    """
     test_questions = context['ti'].xcom_pull(task_ids='get_test_questions', key='questions')
+    train_questions = context['ti'].xcom_pull(task_ids='get_train_questions', key='questions')
 
-    task = "CLUSTERING"
-    model = TextEmbeddingModel.from_pretrained("text-embedding-005")
-    batch_size = 4
-    query_inputs = [TextEmbeddingInput(question, task) for question in test_questions]
-    embeddings = []
-    logging.info("Getting test embeddings")
-    for i in range(0, len(query_inputs), batch_size):
-        query_embeddings = get_embeddings(model, query_inputs[i:i+batch_size])
-        embeddings.extend([embedding.values for embedding in query_embeddings])
-    logging.info(f"Got test embeddings {len(query_embeddings)}")
-    logging.info(f"Sample embeddings: {embeddings[0]}")
-    context['ti'].xcom_push(key='test_embeddings', value=embeddings)
-    return embeddings
+    screened, matched = [], {}
+    if Variable.get('lexical_prescreen', default_var='true').lower() == 'true' and test_questions and train_questions:
+        threshold = float(Variable.get('prescreen_jaccard_threshold', default_var=JACCARD_THRESHOLD))
+        hasher = MinHasher()
+        index = LSHIndex(load_train_signatures(train_questions, hasher))
+        matches, similarities = index.best_matches(hasher.signatures(test_questions))
+        for question, match, similarity in zip(test_questions, matches, similarities):
+            if similarity >= threshold:
+                screened.append(question)
+                matched[question] = int(match)
 
+    audit_fraction = float(Variable.get('prescreen_audit_fraction', default_var=0.05))
+    audit_questions = [question for question in screened if audit_sample(question, audit_fraction)]
+    skipped = set(screened) - set(audit_questions)
+    questions = [question for question in test_questions if question not in skipped]
+    skipped_matches = [matched[question] for question in test_questions if question in skipped]
 
-def get_thresholds(**context):
-    train_embeddings = context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings')
+    report = {
+        'test_questions': len(test_questions),
+        'screened': len(screened),
+        'audited': len(audit_questions),
+        'embeddings_avoided': len(skipped),
+        'api_calls_avoided': len(pack_batches(list(skipped))),
+    }
+    logging.info(f"Prescreen marked {len(screened)} of {len(test_questions)} test questions as in-distribution, "
+                 f"{len(skipped)} embeddings avoided, {len(audit_questions)} audited")
 
-    ## batched cosine similarity
-    batch_size = 4
-    minimum_sim = np.inf
-    for i in range(0, len(train_embeddings), batch_size):
-        cosine_similarities = cosine_similarity(train_embeddings[i:i+batch_size])
-        min_cosine_sim = cosine_similarities.min()
-        minimum_sim = min(minimum_sim, min_cosine_sim)
+    context['ti'].xcom_push(key='questions', value=questions)
+    context['ti'].xcom_push(key='prescreen_matches',
+                            value=save_array(np.array(skipped_matches, dtype=np.int64), context, 'prescreen_matches'))
+    context['ti'].xcom_push(key='audit_questions', value=audit_questions)
+    context['ti'].xcom_push(key='prescreen_report', value=report)
+    return questions
 
-    upper_threshold = minimum_sim - (minimum_sim * 0.1)
-    lower_threshold = minimum_sim - (minimum_sim * 0.6)
+
+def get_thresholds(**context):
+    train_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings'))
+
+    calibration = calibrate_thresholds(
+        train_embeddings,
+        method=Variable.get('drift_threshold_method', default_var='min'),
+        upper_percentile=float(Variable.get('drift_upper_percentile', default_var=5)),
+        lower_percentile=float(Variable.get('drift_lower_percentile', default_var=0.1)),
+        exact_max_n=int(Variable.get('drift_threshold_exact_max_n', default_var=EXACT_MAX_N)),
+        n_sample_pairs=int(Variable.get('drift_threshold_sample_pairs', default_var=SAMPLE_PAIRS)),
+        memory_limit_mb=int(Variable.get('drift_memory_limit_mb', default_var=DEFAULT_MEMORY_LIMIT_MB)),
+    )
+    upper_threshold = calibration['upper_threshold']
+    lower_threshold = calibration['lower_threshold']
 
     context['ti'].xcom_push(key='upper_threshold', value=upper_threshold)
     context['ti'].xcom_push(key='lower_threshold', value=lower_threshold)
+    context['ti'].xcom_push(key='calibration_report', value={
+        'method': calibration['method'],
+        'mode': calibration['stats']['mode'],
+        'n_pairs': calibration['stats']['n_pairs'],
+        'min': calibration['stats']['min'],
+        'mean': calibration['stats']['mean'],
+        'percentiles': {str(p): v for p, v in calibration['stats']['percentiles'].items()},
+        'elapsed_seconds': calibration['elapsed_seconds'],
+        'peak_memory_mb': calibration['peak_memory_mb'],
+    })
 
     return (upper_threshold, lower_threshold)
 
+def row_keys(questions):
+    """
+    64-bit content hashes of the train questions, identifying the rows a
+    centroid summary has already seen.
+    """
+    return np.array([int.from_bytes(hashlib.sha256(normalize_text(q).encode('utf-8')).digest()[:8], 'big')
+                     for q in questions], dtype=np.uint64)
+
+
+def centroid_similarity_stats(test_embeddings, train_embeddings, train_questions):
+    """
+    Score test queries against the centroid summary of the train set instead
+    of every train embedding.
+
+    The summary persisted by the previous run is updated with the train rows it
+    has not seen, or refitted, and saved back before scoring.
+
+    :return: dict with 'min', 'max' and 'min_lower_bound' similarity per query
+    """
+    return load_centroid_summary(train_embeddings, train_questions).score(test_embeddings)
+
+
+def load_centroid_summary(train_embeddings, train_questions):
+    """
+    Load the centroid summary persisted by the previous run, update it with the
+    train rows it has not seen, or refit it, and save it back if it changed.
+
+    :return: CentroidSummary of the current train set
+    """
+    arrays = load_state_arrays('centroid_summary')
+    summary = CentroidSummary.from_arrays(arrays) if arrays is not None else None
+    n_centroids = int(Variable.get('drift_centroids', default_var=DEFAULT_N_CENTROIDS))
+
+    summary, changed = refresh_summary(summary, train_embeddings, row_keys(train_questions), n_centroids)
+    if changed:
+        save_state_arrays('centroid_summary', summary.to_arrays())
+    return summary
+
+
+# test queries the monitor summary is checked against the exact method on
+MONITOR_AUDIT_SIZE = 500
+
+
+def export_monitor_summary(**context):
+    """
+    Export the compact train summary the serving backend scores live queries
+    against (see backend/app/services/drift_monitor_service.py).
+
+    It holds the boundary points of the centroid summary together with the
+    thresholds of this run, so the backend flags queries like the centroid
+    scoring method of detect_data_drift, with O(k) work per query. The lowest
+    similarity to the boundary points only estimates the lowest similarity to
+    the train set, from above, so the flags are checked against the exact
+    method on up to MONITOR_AUDIT_SIZE test queries of this run. Their
+    agreement, precision and recall are stored with the summary and pushed to
+    XCom as 'monitor_summary_audit'.
+
+    The summary is stamped with the identity of the train embeddings (see
+    embedding_cache.embedding_identity), which the backend compares with the
+    model its query embeddings come from. It is saved as the
+    drift_monitor_summary state.
+    """
+    train_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings'))
+    test_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_test_embeddings', key='test_embeddings'))
+    train_questions = context['ti'].xcom_pull(task_ids='get_train_questions', key='questions')
+    upper_threshold = context['ti'].xcom_pull(task_ids='get_thresholds', key='upper_threshold')
+    lower_threshold = context['ti'].xcom_pull(task_ids='get_thresholds', key='lower_threshold')
+
+    summary = load_centroid_summary(train_embeddings, train_questions)
+
+    audit = {'queries': 0, 'agreement': None, 'precision': None, 'recall': None}
+    if test_embeddings.shape[0]:
+        sample = test_embeddings[np.linspace(0, test_embeddings.shape[0] - 1,
+                                             min(MONITOR_AUDIT_SIZE, test_embeddings.shape[0])).astype(int)]
+        memory_limit_mb = int(Variable.get('drift_memory_limit_mb', default_var=DEFAULT_MEMORY_LIMIT_MB))
+        estimated = summary.score(sample)['min']
+        exact = similarity_stats(sample, train_embeddings, memory_limit_mb=memory_limit_mb)['min']
+        flagged = (estimated < upper_threshold) & (estimated > lower_threshold)
+        expected = (exact < upper_threshold) & (exact > lower_threshold)
+        hits = int((flagged & expected).sum())
+        audit = {
+            'queries': len(sample),
+            'agreement': float((flagged == expected).mean()),
+            'precision': hits / int(flagged.sum()) if flagged.any() else None,
+            'recall': hits / int(expected.sum()) if expected.any() else None,
+        }
+
+    save_state_arrays('drift_monitor_summary', {
+        'boundary': summary.boundary.astype(np.float32),
+        'upper_threshold': np.array(upper_threshold, dtype=np.float32),
+        'lower_threshold': np.array(lower_threshold, dtype=np.float32),
+        'embedding_model': np.array(embedding_identity(EMBEDDING_MODEL_NAME, EMBEDDING_TASK)),
+        'n_train': np.array(len(train_questions)),
+        'created_at': np.array(datetime.now().timestamp()),
+        # NaN where the audit found no flagged query
+        **{f'audit_{name}': np.array(np.nan if value is None else value) for name, value in audit.items()},
+    })
+    context['ti'].xcom_push(key='monitor_summary_audit', value=audit)
+    logging.info(f"Exported drift monitor summary of {len(summary.boundary)} boundary points for "
+                 f"{len(train_questions)} train queries, audit against the exact method: {audit}")
+
+
 def detect_data_drift(**context):
-    test_embeddings = context['ti'].xcom_pull(task_ids='get_test_embeddings', key='test_embeddings')
-    train_embeddings = context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings')
-    test_questions = context['ti'].xcom_pull(task_ids='get_test_questions', key='questions')
+    test_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_test_embeddings', key='test_embeddings'))
+    train_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings'))
+    test_questions = context['ti'].xcom_pull(task_ids='prescreen_test_questions', key='questions')
+    train_questions = context['ti'].xcom_pull(task_ids='get_train_questions', key='questions')
 
     upper_threshold = context['ti'].xcom_pull(task_ids='get_thresholds', key='upper_threshold')
     lower_threshold = context['ti'].xcom_pull(task_ids='get_thresholds', key='lower_threshold')
 
     data_drift = False
-    drift_queries = []
     detected_drift_queries = []
 
-    ## batched cosine similarity
-    batch_size = 4
-    
-    # Iterate through test embeddings
-    for i in range(0, len(test_embeddings), batch_size):
-        batch_test_embeddings = test_embeddings[i:i+batch_size]
-        batch_test_questions = test_questions[i:i+batch_size]
-        
-        for j, test_embedding in enumerate(batch_test_embeddings):
-            # Check similarity with all train embeddings
-            similarities = cosine_similarity([test_embedding], train_embeddings)[0]
-            min_similarity = similarities.min()
-            
-            # If similarity is below upper threshold but above lower threshold
-            if (min_similarity < upper_threshold) and (min_similarity > lower_threshold):
-                data_drift = True
-                detected_drift_queries.append({
-                    'query': batch_test_questions[j],
-                    'similarity': min_similarity
-                })
+    scoring_method = Variable.get('drift_scoring_method', default_var='exact')
+    if scoring_method == 'centroid':
+        stats = centroid_similarity_stats(test_embeddings, train_embeddings, train_questions)
+    else:
+        memory_limit_mb = int(Variable.get('drift_memory_limit_mb', default_var=DEFAULT_MEMORY_LIMIT_MB))
+        stats = similarity_stats(test_embeddings, train_embeddings, top_k=1, memory_limit_mb=memory_limit_mb)
+    logging.info(f"Scored {len(test_questions)} test queries with the {scoring_method} method")
+
+    for question, min_similarity, nearest_similarity in zip(test_questions, stats['min'], stats['max']):
+        # If similarity is below upper threshold but above lower threshold
+        if (min_similarity < upper_threshold) and (min_similarity > lower_threshold):
+            data_drift = True
+            detected_drift_queries.append({
+                'query': question,
+                'similarity': float(min_similarity),
+                'nearest_similarity': float(nearest_similarity)
+            })
 
     # Log detailed results
     if data_drift:
         logging.info(f"Data drift detected in {len(detected_drift_queries)} specific queries")
         for drift_info in detected_drift_queries:
-            logging.info(f"Drift Query: '{drift_info['query']}' (Max Similarity: {drift_info['similarity']:.4f})")
-        insert_drift_history_into_table(detected_drift_queries)
+            logging.info(f"Drift Query: '{drift_info['query']}' (Min Similarity: {drift_info['similarity']:.4f}, Nearest Similarity: {drift_info['nearest_similarity']:.4f})")
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+        # loaded before the insert, so a history rebuilt from the table does not count this run twice
+        history = load_drift_history()
+        if insert_drift_history_into_table(detected_drift_queries, timestamp):
+            history.add(timestamp, [drift_info['similarity'] for drift_info in detected_drift_queries])
+            save_state('drift_history', history.to_state())
     else:
         logging.info("No data drift detected")
     
+    # the full method should not flag the near-copies the prescreen let through for audit
+    audit_questions = set(context['ti'].xcom_pull(task_ids='prescreen_test_questions', key='audit_questions') or [])
+    if audit_questions:
+        report = context['ti'].xcom_pull(task_ids='prescreen_test_questions', key='prescreen_report')
+        flagged = {drift_info['query'] for drift_info in detected_drift_queries}
+        report['audit_agreement'] = 1 - len(audit_questions & flagged) / len(audit_questions)
+        logging.info(f"Prescreen agreed with the {scoring_method} method on {report['audit_agreement']:.1%} "
+                     f"of {len(audit_questions)} audited questions")
+        context['ti'].xcom_push(key='prescreen_report', value=report)
+
     context['ti'].xcom_push(key='data_drift', value=data_drift)
     context['ti'].xcom_push(key='detected_drift_queries', value=detected_drift_queries)
 
     return data_drift
 
+STREAM_CHUNK_SIZE = 4096
+N_PROJECTIONS = 32
+PROJECTION_BINS = 64
+RESERVOIR_SIZE = 1000
+SHIFT_HISTORY_LENGTH = 365
+
+
+class DriftSketch:
+    """
+    Constant-memory streaming summary of a set of embeddings.
+
+    Embeddings are folded in chunk by chunk, in one pass, into:
+
+    - a running mean and covariance (batched Welford / Chan updates),
+    - histograms of the embeddings projected on n_projections random unit
+      directions, fixed by the seed so that sketches built with the same seed
+      are comparable,
+    - a uniform reservoir sample of reservoir_size embeddings.
+
+    Memory is O(dim^2 + n_projections * bins + reservoir_size * dim),
+    whatever the number of embeddings.
+
+    :param dim: embedding dimension
+    :param seed: seed of the projections and the reservoir
+    """
+
+    def __init__(self, dim, n_projections=N_PROJECTIONS, bins=PROJECTION_BINS, reservoir_size=RESERVOIR_SIZE, seed=0):
+        rng = np.random.default_rng(seed)
+        projections = rng.standard_normal((n_projections, dim))
+        self.projections = (projections / np.linalg.norm(projections, axis=1, keepdims=True)).astype(np.float32)
+        self.bins = bins
+        self.count = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros((dim, dim), dtype=np.float64)
+        self.histograms = np.zeros((n_projections, bins), dtype=np.int64)
+        self.reservoir = np.empty((0, dim), dtype=np.float32)
+        self.reservoir_size = reservoir_size
+        self._rng = np.random.default_rng(seed + 1)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if chunk.shape[0] == 0:
+            return
+        chunk = chunk / np.maximum(np.linalg.norm(chunk, axis=1, keepdims=True), 1e-12)
+        n = chunk.shape[0]
+
+        # Chan et al. parallel update of the mean and the sum of squared deviations
+        chunk_mean = chunk.mean(axis=0, dtype=np.float64)
+        centred = chunk - chunk_mean
+        delta = chunk_mean - self.mean
+        total = self.count + n
+        self.m2 += centred.T.astype(np.float64) @ centred + np.outer(delta, delta) * self.count * n / total
+        self.mean += delta * n / total
+
+        # projections of unit vectors lie in [-1, 1]
+        projected = chunk @ self.projections.T
+        bins = np.clip(((projected + 1) * self.bins / 2).astype(np.int64), 0, self.bins - 1)
+        for i in range(self.projections.shape[0]):
+            self.histograms[i] += np.bincount(bins[:, i], minlength=self.bins)
+
+        # reservoir sampling (algorithm R), a chunk at a time
+        space = self.reservoir_size - self.reservoir.shape[0]
+        if space > 0:
+            self.reservoir = np.concatenate([self.reservoir, chunk[:space]])
+        positions = self.count + np.arange(min(space, n) if space > 0 else 0, n)
+        if positions.size:
+            slots = (self._rng.random(positions.size) * (positions + 1)).astype(np.int64)
+            accepted = slots < self.reservoir_size
+            rows = np.flatnonzero(accepted) + (n - positions.size)
+            self.reservoir[slots[accepted]] = chunk[rows]
+
+        self.count = total
+
+    def covariance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+
+def build_drift_sketch(embeddings, seed=0):
+    """
+    Build a DriftSketch in one pass over (possibly memory-mapped) embeddings.
+    """
+    sketch = DriftSketch(np.shape(embeddings)[1], seed=seed)
+    for start in range(0, len(embeddings), STREAM_CHUNK_SIZE):
+        sketch.update(embeddings[start:start + STREAM_CHUNK_SIZE])
+    return sketch
+
+
+def _mmd_squared(x, y):
+    """
+    Unbiased MMD^2 estimate with an RBF kernel, bandwidth by the median
+    heuristic on the pooled samples.
+    """
+    pooled = np.concatenate([x, y])
+    sq_norms = np.einsum('ij,ij->i', pooled, pooled)
+    distances = np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * pooled @ pooled.T, 0)
+    bandwidth = np.median(distances[np.triu_indices(len(pooled), 1)]) or 1.0
+    kernel = np.exp(-distances / bandwidth)
+    n, m = len(x), len(y)
+    k_xx, k_yy, k_xy = kernel[:n, :n], kernel[n:, n:], kernel[:n, n:]
+    return float((k_xx.sum() - np.trace(k_xx)) / (n * (n - 1))
+                 + (k_yy.sum() - np.trace(k_yy)) / (m * (m - 1))
+                 - 2 * k_xy.mean())
+
+
+def distribution_shift_scores(reference, current):
+    """
+    Aggregate shift of the current sketch from the reference sketch.
+
+    :param reference: DriftSketch of the train embeddings
+    :param current: DriftSketch of the test embeddings, built with the same seed
+    :return: dict with
+        - mean_shift: L2 distance between the means,
+        - mean_shift_z: mean shift in units of the reference standard deviation
+          per dimension (root mean square over dimensions),
+        - covariance_shift: relative Frobenius distance of the covariances,
+        - projection_wasserstein_mean / _max: 1-d Wasserstein distance of the
+          projection histograms, averaged and worst over the projections,
+        - mmd: unbiased MMD^2 between the reservoirs
+    """
+    if reference.count < 2 or current.count < 2:
+        return {'n_reference': reference.count, 'n_current': current.count}
+
+    delta = current.mean - reference.mean
+    reference_cov, current_cov = reference.covariance(), current.covariance()
+    variance = np.maximum(np.diag(reference_cov), 1e-12)
+
+    bin_width = 2 / reference.bins
+    reference_cdf = np.cumsum(reference.histograms, axis=1) / reference.count
+    current_cdf = np.cumsum(current.histograms, axis=1) / current.count
+    wasserstein = np.abs(reference_cdf - current_cdf).sum(axis=1) * bin_width
+
+    return {
+        'n_reference': reference.count,
+        'n_current': current.count,
+        'mean_shift': float(np.linalg.norm(delta)),
+        'mean_shift_z': float(np.sqrt(np.mean(delta ** 2 / variance))),
+        'covariance_shift': float(np.linalg.norm(current_cov - reference_cov) / max(np.linalg.norm(reference_cov), 1e-12)),
+        'projection_wasserstein_mean': float(wasserstein.mean()),
+        'projection_wasserstein_max': float(wasserstein.max()),
+        'mmd': _mmd_squared(reference.reservoir, current.reservoir),
+    }
+
+
+def prescreened_embeddings(prescreened, train_embeddings, **context):
+    """
+    Embeddings of the test questions left out by the prescreen, from the
+    embedding cache or else their matched train question, without API calls.
+
+    :param prescreened: the left-out questions, in test question order
+    :return: (len(prescreened), dim) float32 matrix
+    """
+    matches = load_array(context['ti'].xcom_pull(task_ids='prescreen_test_questions', key='prescreen_matches'))
+    embeddings = np.asarray(train_embeddings[matches], dtype=np.float32)
+
+    keys = [embedding_key(EMBEDDING_MODEL_NAME, EMBEDDING_TASK, question) for question in prescreened]
+    cached = EmbeddingCache.from_variables().load().get_many(keys)
+    for i, key in enumerate(keys):
+        if key in cached:
+            embeddings[i] = cached[key]
+
+    hits = sum(key in cached for key in keys)
+    stats = {'texts': len(prescreened), 'cache_hits': hits, 'matched_train': len(prescreened) - hits, 'api_calls': 0}
+    logging.info(f"Prescreened test embeddings for the distribution sketch: {stats}")
+    context['ti'].xcom_push(key='prescreened_embedding_stats', value=stats)
+    return embeddings
+
+
+def compute_distribution_shift(**context):
+    """
+    Compute aggregate distribution shift scores of the test embeddings against
+    the train embeddings with streaming sketches, and append them to the
+    per-run history kept in the drift_statistics state document.
+
+    The sketch covers the full test set, as leaving out the near-copies that
+    prescreen_test_questions kept out of get_test_embeddings would overstate
+    the shift. They are not embedded: each one takes its cached embedding if
+    an earlier run computed it, and otherwise the embedding of the train
+    question it matched, which it shares at least prescreen_jaccard_threshold
+    of its character 3-grams with. The counts are pushed to XCom as
+    'prescreened_embedding_stats'; no API calls are made.
+    """
+    train_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_train_embeddings', key='train_embeddings'))
+    test_embeddings = load_array(context['ti'].xcom_pull(task_ids='get_test_embeddings', key='test_embeddings'))
+
+    test_questions = context['ti'].xcom_pull(task_ids='get_test_questions', key='questions') or []
+    embedded = set(context['ti'].xcom_pull(task_ids='prescreen_test_questions', key='questions') or [])
+    prescreened = [question for question in test_questions if question not in embedded]
+    if prescreened and train_embeddings.shape[0]:
+        test_embeddings = np.concatenate([array for array in (
+            test_embeddings, prescreened_embeddings(prescreened, train_embeddings, **context)) if array.shape[0]])
+
+    if train_embeddings.shape[0] == 0 or test_embeddings.shape[0] == 0:
+        logging.info("No embeddings to compare. Skipping distribution shift")
+        return None
+
+    scores = distribution_shift_scores(build_drift_sketch(train_embeddings), build_drift_sketch(test_embeddings))
+    logging.info(f"Distribution shift: {scores}")
+
+    history = load_state('drift_statistics') or {'runs': []}
+    history['runs'].append({'run_id': context['run_id'], 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), **scores})
+    history['runs'] = history['runs'][-SHIFT_HISTORY_LENGTH:]
+    save_state('drift_statistics', history)
+
+    context['ti'].xcom_push(key='distribution_shift', value=scores)
+    return scores
+
+
+def load_drift_history():
+    """
+    Load the rolling drift history aggregate, rebuilding it from the drift
+    table when it was never saved or keeps less than the trend window.
+
+    :return: DriftHistory
+    """
+    window_days = int(Variable.get('drift_trend_window_days', default_var=RETENTION_DAYS))
+    state = load_state('drift_history')
+    if state is not None and state['retention_days'] >= window_days:
+        return DriftHistory.from_state(state)
+    since = (datetime.now() - timedelta(days=window_days)).strftime(TIMESTAMP_FORMAT)
+    return DriftHistory.from_aggregates(fetch_drift_history_aggregates(since), window_days)
+
+
 def check_drift_trend(**context):
-    drift_last_detected_at = Variable.get('drift_last_detected_at')
-    # Set drift window for max of date 7 days ago or last detected drift
-    date_seven_days_ago = datetime.now() - timedelta(days=7)
-    date_seven_days_ago = date_seven_days_ago.strftime("%Y-%m-%d %H:%M:%S")
+    """
+    Decide whether drift persisted since the last retraining.
+
+    The drift queries recorded after the later of drift_last_detected_at and
+    the start of the trend window are counted in the rolling drift history
+    aggregate, without reading the drift table. Only when they reach
+    drift_trend_min_queries are the queries themselves read, with a
+    parameterized query over the partitions of the window.
 
-    query_condition = drift_last_detected_at
-    if drift_last_detected_at < date_seven_days_ago:
-        query_condition = date_seven_days_ago
+    :return: 'bq_similarity_search' if a drift trend was detected, else 'dummy_task'
+    """
+    drift_last_detected_at = Variable.get('drift_last_detected_at')
+    window_days = int(Variable.get('drift_trend_window_days', default_var=RETENTION_DAYS))
+    min_queries = int(Variable.get('drift_trend_min_queries', default_var=2))
+    # Set drift window for max of the window start or last detected drift
+    window_start = (datetime.now() - timedelta(days=window_days)).strftime(TIMESTAMP_FORMAT)
+    since = max(drift_last_detected_at, window_start)
 
-    detected_drift_queries = fetch_drift_history(query_condition)
-    logging.info(f"Detected drift queries: {len(detected_drift_queries)}")
+    stats = load_drift_history().window(since)
+    logging.info(f"Detected drift queries since {since}: {stats['count']} in {stats['runs']} runs, "
+                 f"mean distance {stats['mean_distance']}")
+    context['ti'].xcom_push(key='drift_trend_stats', value=stats)
 
-    if len(detected_drift_queries) >= 2:
+    if stats['count'] >= min_queries:
         logging.info("Data drift trend detected. Triggering train_data_dag")
-        drift_queries = [query['query'] for query in detected_drift_queries]
+        drift_queries = [query['query'] for query in fetch_drift_history(since)]
         context['ti'].xcom_push(key='drift_queries', value=drift_queries)
         return 'bq_similarity_search'
     else:
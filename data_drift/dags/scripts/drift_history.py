@@ -0,0 +1,123 @@
+import math
+import logging
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+logging.basicConfig(level=logging.INFO)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+RETENTION_DAYS = 7
+
+
+class DriftHistory:
+    """
+    Rolling aggregate of the drift history, one entry per DAG run that
+    detected drift.
+
+    Every entry holds the run timestamp, the count of drift queries and the
+    sum, sum of squares, minimum and maximum of their distances. Entries are
+    kept in timestamp order with running totals of the count, sum and sum of
+    squares, so the count, mean and spread of a window are the difference of
+    two running totals, found by bisection; only the minimum and maximum look
+    at the entries of the window. Entries older than the retention window are
+    dropped on every update, so the aggregate stays small however long the
+    drift table grows.
+
+    :param entries: list of entry dicts in timestamp order, as saved by to_state
+    :param retention_days: age after which entries are dropped
+    """
+
+    def __init__(self, entries=None, retention_days=RETENTION_DAYS):
+        self.entries = entries or []
+        self.retention_days = retention_days
+
+    def add(self, timestamp, distances):
+        """
+        Record the drift queries of one run.
+
+        :param timestamp: run timestamp as a TIMESTAMP_FORMAT string
+        :param distances: distances of the drift queries of the run
+        """
+        if not distances:
+            return
+        last = self.entries[-1] if self.entries else {'total_count': 0, 'total_sum': 0.0, 'total_squares': 0.0}
+        if self.entries and timestamp < last['timestamp']:
+            raise ValueError(f"Drift history entry {timestamp} is older than the last entry {last['timestamp']}")
+        entry = {
+            'timestamp': timestamp,
+            'count': len(distances),
+            'sum': float(sum(distances)),
+            'squares': float(sum(distance * distance for distance in distances)),
+            'min': float(min(distances)),
+            'max': float(max(distances)),
+        }
+        entry['total_count'] = last['total_count'] + entry['count']
+        entry['total_sum'] = last['total_sum'] + entry['sum']
+        entry['total_squares'] = last['total_squares'] + entry['squares']
+        self.entries.append(entry)
+        self.prune(datetime.strptime(timestamp, TIMESTAMP_FORMAT))
+
+    def prune(self, now):
+        """
+        Drop the entries older than the retention window. Running totals of
+        the kept entries stay valid, since windows only take differences.
+        """
+        cutoff = (now - timedelta(days=self.retention_days)).strftime(TIMESTAMP_FORMAT)
+        start = bisect_right([entry['timestamp'] for entry in self.entries], cutoff)
+        if start:
+            self.entries = self.entries[start:]
+
+    def window(self, since):
+        """
+        Statistics of the drift queries recorded after a timestamp.
+
+        :param since: TIMESTAMP_FORMAT string, exclusive
+        :return: dict with the number of runs and drift queries and the mean,
+            standard deviation, minimum and maximum distance
+        """
+        timestamps = [entry['timestamp'] for entry in self.entries]
+        start = bisect_right(timestamps, since)
+        stats = {'runs': len(self.entries) - start, 'count': 0, 'mean_distance': None, 'std_distance': None,
+                 'min_distance': None, 'max_distance': None}
+        if start == len(self.entries):
+            return stats
+
+        # running totals just before the first entry of the window; they include pruned entries
+        first, last = self.entries[start], self.entries[-1]
+        count = last['total_count'] - first['total_count'] + first['count']
+        mean = (last['total_sum'] - first['total_sum'] + first['sum']) / count
+        variance = (last['total_squares'] - first['total_squares'] + first['squares']) / count - mean * mean
+        stats.update({
+            'count': count,
+            'mean_distance': mean,
+            'std_distance': math.sqrt(max(variance, 0.0)),
+            'min_distance': min(entry['min'] for entry in self.entries[start:]),
+            'max_distance': max(entry['max'] for entry in self.entries[start:]),
+        })
+        return stats
+
+    def to_state(self):
+        return {'retention_days': self.retention_days, 'entries': self.entries}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['entries'], state['retention_days'])
+
+    @classmethod
+    def from_aggregates(cls, rows, retention_days=RETENTION_DAYS):
+        """
+        Rebuild the history from per-run aggregates of the drift table.
+
+        :param rows: dicts with timestamp, count, sum, squares, min and max,
+            in timestamp order
+        """
+        history = cls(retention_days=retention_days)
+        total_count, total_sum, total_squares = 0, 0.0, 0.0
+        for row in rows:
+            total_count += row['count']
+            total_sum += row['sum']
+            total_squares += row['squares']
+            history.entries.append({**row, 'total_count': total_count, 'total_sum': total_sum,
+                                    'total_squares': total_squares})
+        logging.info(f"Rebuilt drift history from {len(history.entries)} runs")
+        return history
@@ -0,0 +1,224 @@
+import os
+import time
+import fcntl
+import random
+import hashlib
+import logging
+import unicodedata
+import numpy as np
+from airflow.models import Variable
+from airflow.providers.google.cloud.hooks.gcs import GCSHook
+from google.api_core.exceptions import PreconditionFailed
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_CACHE_DIR = '/tmp/embedding_cache'
+CACHE_FILENAME = 'embeddings.npz'
+# attempts at uploading the cache before another task's upload is given up on
+SAVE_ATTEMPTS = 10
+
+
+def normalize_text(text):
+    """
+    Normalize text before hashing so that unicode and whitespace variants of
+    the same question share a cache entry.
+    """
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def embedding_key(model_name, task, text):
+    """
+    Content hash of an embedding request.
+
+    :param model_name: embedding model, e.g. text-embedding-005
+    :param task: embedding task type, e.g. CLUSTERING
+    :param text: text to embed
+    :return: hex encoded SHA-256 digest
+    """
+    payload = '\x1f'.join([model_name, task, normalize_text(text)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def embedding_identity(model_name, task):
+    """
+    Identity of the embedding space of a model and task type, e.g.
+    text-embedding-005/CLUSTERING. The backend computes the same string
+    for the remote BigQuery model its query embeddings come from, so
+    embeddings and summaries are only compared within one space.
+    """
+    return f"{model_name}/{task}"
+
+
+def _split_gcs_uri(uri):
+    bucket, _, object_name = uri[len('gs://'):].partition('/')
+    return bucket, object_name
+
+
+class EmbeddingCache:
+    """
+    Persistent store of embeddings keyed by embedding_key.
+
+    The store is a single NPZ file with a 'keys' array and a float32 'vectors'
+    matrix. It lives in a local directory and, when gcs_uri is set, is
+    downloaded from and uploaded to that object so that it survives worker
+    restarts. Saving merges with the file on disk under a lock, so tasks on
+    one worker do not drop each other's entries. Tasks on different workers
+    merge with the GCS object instead, and upload only if it was not replaced
+    since they read it (a generation-match precondition), merging and
+    retrying otherwise.
+
+    :param cache_dir: local directory of the cache file
+    :param gcs_uri: optional gs://bucket/path of the cache file
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, gcs_uri=None):
+        self.cache_dir = cache_dir
+        self.gcs_uri = gcs_uri
+        self.path = os.path.join(cache_dir, CACHE_FILENAME)
+        self._index = {}
+        self._vectors = []
+        self._new_keys = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_variables(cls):
+        return cls(
+            cache_dir=Variable.get('embedding_cache_dir', default_var=DEFAULT_CACHE_DIR),
+            gcs_uri=Variable.get('embedding_cache_gcs_uri', default_var=None),
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+    def _read_file(self, path=None):
+        path = path or self.path
+        if not os.path.exists(path):
+            return [], np.empty((0, 0), dtype=np.float32)
+        with np.load(path) as data:
+            return list(data['keys']), data['vectors'].astype(np.float32, copy=False)
+
+    def _merge(self, keys, vectors):
+        # entries written by other tasks since this cache was loaded
+        for key, vector in zip(keys, vectors):
+            if key not in self._index:
+                self._index[key] = len(self._vectors)
+                self._vectors.append(vector)
+
+    def _write_file(self):
+        keys = np.array(list(self._index.keys()))
+        vectors = np.stack([self._vectors[i] for i in self._index.values()])
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(tmp_path, keys=keys, vectors=vectors)
+        os.replace(tmp_path, self.path)
+        return len(keys)
+
+    def _upload(self):
+        """
+        Merge with the GCS object and replace it, retrying when another task
+        replaced it between the download and the upload.
+        """
+        bucket_name, object_name = _split_gcs_uri(self.gcs_uri)
+        bucket = GCSHook().get_conn().bucket(bucket_name)
+        remote_path = f"{self.path}.remote.npz"
+        for attempt in range(1, SAVE_ATTEMPTS + 1):
+            blob = bucket.get_blob(object_name)
+            # generation 0 only matches an object that does not exist yet
+            generation = blob.generation if blob is not None else 0
+            try:
+                if blob is not None:
+                    blob.download_to_filename(remote_path, if_generation_match=generation)
+                    self._merge(*self._read_file(remote_path))
+                total = self._write_file()
+                bucket.blob(object_name).upload_from_filename(self.path, if_generation_match=generation)
+                return total
+            except PreconditionFailed:
+                if attempt == SAVE_ATTEMPTS:
+                    raise
+                logging.info(f"{self.gcs_uri} was replaced by another task, merging again (attempt {attempt})")
+                time.sleep(random.uniform(0.5, 1.5) * min(2 ** (attempt - 1), 16))
+            finally:
+                if os.path.exists(remote_path):
+                    os.remove(remote_path)
+
+    def load(self):
+        if self.gcs_uri:
+            bucket, object_name = _split_gcs_uri(self.gcs_uri)
+            gcs_hook = GCSHook()
+            if gcs_hook.exists(bucket_name=bucket, object_name=object_name):
+                gcs_hook.download(bucket_name=bucket, object_name=object_name, filename=self.path)
+
+        keys, vectors = self._read_file()
+        self._index = {key: i for i, key in enumerate(keys)}
+        self._vectors = list(vectors)
+        self._new_keys = []
+        logging.info(f"Loaded {len(keys)} cached embeddings from {self.path}")
+        return self
+
+    def get_many(self, keys):
+        """
+        :return: dict of key to vector for the keys present in the cache
+        """
+        return {key: self._vectors[self._index[key]] for key in keys if key in self._index}
+
+    def put_many(self, keys, vectors):
+        for key, vector in zip(keys, vectors):
+            if key in self._index:
+                continue
+            self._index[key] = len(self._vectors)
+            self._vectors.append(np.asarray(vector, dtype=np.float32))
+            self._new_keys.append(key)
+
+    def save(self):
+        if not self._new_keys:
+            return
+
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._merge(*self._read_file())
+            total = self._upload() if self.gcs_uri else self._write_file()
+
+        logging.info(f"Saved {len(self._new_keys)} new embeddings, {total} in total, to {self.gcs_uri or self.path}")
+        self._new_keys = []
+
+
+def embed_with_cache(texts, model_name, task, embed_fn, cache=None, save=True):
+    """
+    Embed texts, sending only the texts missing from the cache to embed_fn.
+
+    :param texts: texts to embed
+    :param model_name: embedding model name, part of the cache key
+    :param task: embedding task type, part of the cache key
+    :param embed_fn: callable taking a list of texts and returning a tuple of
+        their embeddings and the number of API calls made
+    :param cache: EmbeddingCache, loaded from the Airflow Variables if None
+    :param save: save the cache after adding the new embeddings
+    :return: tuple of the (len(texts), dim) float32 matrix and a stats dict
+    """
+    if cache is None:
+        cache = EmbeddingCache.from_variables().load()
+
+    keys = [embedding_key(model_name, task, text) for text in texts]
+    hits = cache.get_many(keys)
+
+    missing = {}
+    for text, key in zip(texts, keys):
+        if key not in hits:
+            missing.setdefault(key, text)
+
+    api_calls = 0
+    if missing:
+        vectors, api_calls = embed_fn(list(missing.values()))
+        cache.put_many(list(missing.keys()), vectors)
+        if save:
+            cache.save()
+
+    found = cache.get_many(keys)
+    matrix = np.stack([found[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+    stats = {
+        'texts': len(texts),
+        'hits': len(texts) - sum(1 for key in keys if key in missing),
+        'misses': len(missing),
+        'api_calls': api_calls,
+    }
+    stats['hit_rate'] = stats['hits'] / len(texts) if texts else 0.0
+    return matrix, stats
@@ -0,0 +1,190 @@
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+import numpy as np
+from scripts.quota_scheduler import QuotaScheduler, is_throttling_error, BATCH
+
+logging.basicConfig(level=logging.INFO)
+
+# Per-call limits of text-embedding-005
+MAX_INSTANCES_PER_CALL = 250
+MAX_TOKENS_PER_CALL = 20000
+MAX_TOKENS_PER_INSTANCE = 2048
+
+
+def estimate_tokens(text):
+    """
+    Conservative token estimate without calling the tokenizer: about three
+    UTF-8 bytes per token, capped at the per-instance truncation limit.
+    """
+    return min(MAX_TOKENS_PER_INSTANCE, len(text.encode('utf-8')) // 3 + 1)
+
+
+def pack_batches(texts, max_instances=MAX_INSTANCES_PER_CALL, max_tokens=MAX_TOKENS_PER_CALL):
+    """
+    Greedily pack texts, in order, into batches that respect the per-call
+    instance and token limits.
+
+    :return: list of lists of indices into texts
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_instances or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_size_error(error):
+    message = str(error).lower()
+    return 'token' in message and ('limit' in message or 'exceed' in message) and not is_throttling_error(error)
+
+
+class EmbeddingClient:
+    """
+    Concurrent embedding client for Vertex AI text embedding models.
+
+    Texts are packed into as few calls as the model's instance and token
+    limits allow, and the calls run on a thread pool. Every call first takes
+    a batch token from a QuotaScheduler, which halves the request rate on
+    429 responses and slowly raises it again on success. Throttled calls are
+    retried with jittered backoff, and a batch rejected for its size is split
+    in half.
+
+    :param model: object with get_embeddings(inputs) returning objects with
+        .values, e.g. TextEmbeddingModel or FakeEmbeddingModel
+    :param task: embedding task type
+    :param max_workers: number of calls in flight
+    :param requests_per_second: starting and maximum request rate
+    :param max_retries: retries per call before giving up
+    :param quota: QuotaScheduler the calls take their tokens from, by default
+        one of requests_per_second kept by this client
+    """
+
+    def __init__(self, model, task='CLUSTERING', max_workers=4, requests_per_second=5.0,
+                 max_instances=MAX_INSTANCES_PER_CALL, max_tokens=MAX_TOKENS_PER_CALL, max_retries=10,
+                 input_factory=None, quota=None):
+        self.model = model
+        self.task = task
+        self.max_workers = max_workers
+        self.max_instances = max_instances
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.quota = quota or QuotaScheduler('local', 'embeddings', requests_per_second, capacity=max_workers)
+        self.input_factory = input_factory or _vertex_input
+        self.stats = {'api_calls': 0, 'throttled': 0, 'splits': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _call(self, texts):
+        retries = 0
+        while True:
+            try:
+                # the slot reports the outcome to the quota, slowing down on 429s
+                with self.quota.slot(BATCH):
+                    self._count('api_calls')
+                    result = self.model.get_embeddings([self.input_factory(text, self.task) for text in texts])
+                return [embedding.values for embedding in result]
+            except Exception as e:
+                if _is_size_error(e) and len(texts) > 1:
+                    self._count('splits')
+                    middle = len(texts) // 2
+                    return self._call(texts[:middle]) + self._call(texts[middle:])
+
+                retries += 1
+                if retries > self.max_retries:
+                    logging.error(f"Max retries ({self.max_retries}) exceeded. Last error: {str(e)}")
+                    raise
+                if is_throttling_error(e):
+                    self._count('throttled')
+                delay = min(2 ** (retries - 1), 32) * uniform(0.5, 1.5)
+                logging.warning(f"Attempt {retries}/{self.max_retries} failed: {str(e)}. Retrying in {delay:.2f} seconds...")
+                time.sleep(delay)
+
+    def embed(self, texts):
+        """
+        Embed texts concurrently.
+
+        :return: tuple of the list of embeddings, in the order of texts, and
+            the number of API calls made
+        """
+        calls_before = self.stats['api_calls']
+        batches = pack_batches(texts, self.max_instances, self.max_tokens)
+        logging.info(f"Embedding {len(texts)} texts in {len(batches)} calls on {self.max_workers} threads")
+
+        embeddings = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda batch: self._call([texts[i] for i in batch]), batches)
+            for batch, vectors in zip(batches, results):
+                for i, vector in zip(batch, vectors):
+                    embeddings[i] = vector
+
+        return embeddings, self.stats['api_calls'] - calls_before
+
+
+def _vertex_input(text, task):
+    from vertexai.language_models import TextEmbeddingInput
+    return TextEmbeddingInput(text, task)
+
+
+class _FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """
+    Local stand-in for TextEmbeddingModel for tests and benchmarks.
+
+    Returns deterministic unit vectors derived from the text, enforces the
+    per-call limits and answers with a 429 error when called more often than
+    quota_per_second.
+
+    :param dim: embedding dimension
+    :param quota_per_second: calls allowed per second, None for unlimited
+    :param latency: simulated seconds per call
+    """
+
+    def __init__(self, dim=768, quota_per_second=None, latency=0.0,
+                 max_instances=MAX_INSTANCES_PER_CALL, max_tokens=MAX_TOKENS_PER_CALL):
+        self.dim = dim
+        self.quota_per_second = quota_per_second
+        self.latency = latency
+        self.max_instances = max_instances
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.rejected = 0
+        self._window = []
+        self._lock = threading.Lock()
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def get_embeddings(self, inputs):
+        texts = [getattr(item, 'text', item) for item in inputs]
+        with self._lock:
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if self.quota_per_second is not None and len(self._window) >= self.quota_per_second:
+                self.rejected += 1
+                raise Exception("429 Quota exceeded for aiplatform.googleapis.com/online_prediction_requests_per_base_model")
+            self._window.append(now)
+            self.calls += 1
+        if len(texts) > self.max_instances or sum(estimate_tokens(t) for t in texts) > self.max_tokens:
+            raise Exception("400 Unable to submit request because the input token count exceeds the limit")
+        time.sleep(self.latency)
+        return [_FakeEmbedding(self._vector(text)) for text in texts]
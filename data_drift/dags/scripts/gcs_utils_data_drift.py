@@ -1,18 +1,55 @@
 from airflow.models import Variable
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from airflow.providers.google.cloud.hooks.gcs import GCSHook
 from google.cloud import storage
+from scripts.artifact_utils import run_scope
+
+TRAIN_DATA_GCS_PREFIX = 'processed_trace_data'
+UPLOAD_MAX_WORKERS = 8
+# resumable uploads in 8 MiB chunks, so a failed chunk is retried alone
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def upload_files_parallel(bucket_name, files, max_workers=UPLOAD_MAX_WORKERS, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Upload local files to GCS concurrently, each as a chunked resumable upload.
+
+    Parameters
+    ----------
+    bucket_name : str
+        Destination bucket.
+    files : dict
+        Local path to object name.
+    max_workers : int
+        Number of uploads in flight.
+    chunk_size : int
+        Upload chunk size in bytes, a multiple of 256 KiB.
+    """
+    def upload(item):
+        local_path, object_name = item
+        # a hook, and storage client, per upload rather than one shared between threads
+        GCSHook().upload(bucket_name=bucket_name, object_name=object_name, filename=local_path,
+                         chunk_size=chunk_size)
+        logging.info(f"Uploaded {local_path} to gs://{bucket_name}/{object_name}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() re-raises the first failed upload
+        list(executor.map(upload, files.items()))
+
 
 def upload_train_data_to_gcs(**context):
     """
-    Upload the Parquet file with the generated LLM training data to GCS.
+    Upload the Parquet shards with the generated LLM training data to GCS.
 
-    This function checks if the file exists locally and if so, tries to upload it
-    to the specified GCS bucket and path. If the upload is successful, it returns
-    the string 'generate_samples' to trigger the next task in the DAG. If the
-    file does not exist, it logs a warning. If there is an error during the upload
-    process, it logs an error and stops the DAG.
+    The shards written by generate_llm_response are uploaded in parallel under the run-scoped
+    prefix processed_trace_data/<dag_id>/<run_id>/, so concurrent runs do not overwrite each
+    other. The prefix is pushed to XCom as 'train_data_gcs_prefix' for the deferrable
+    upload_gcs_to_bq load. The task short-circuits: a falsy return skips the load and the
+    retraining trigger, which only happens when no drift was detected or no rows were generated.
+    A missing bucket name, a shard missing locally or a failed upload raises, so the task fails
+    and the user table archival does not commit the watermark over rows whose train data was lost.
 
     Parameters
     ----------
@@ -23,41 +60,34 @@ def upload_train_data_to_gcs(**context):
 
     Returns
     -------
-    str or None
-        Either the string 'generate_samples' to trigger the next task in the DAG
-        or None if the file does not exist.
+    bool
+        True if the shards were uploaded, False if no drift was detected or no rows were
+        generated.
     """
     drift_status = context['ti'].xcom_pull(task_ids='data_drift_detection', key='data_drift')
     logging.info(f"task_status: {drift_status}")
     if drift_status == False:
         return False
+    shards = context['ti'].xcom_pull(task_ids='generate_llm_response', key='train_data_shards') or []
+    if not shards:
+        logging.warning("No train data rows were generated, nothing to upload")
+        return False
     try:
         bucket_name = Variable.get('default_bucket_name')
-        output_path = '/tmp'
-        filename = 'llm_train_data_drift.pq'
-        local_path = f"{output_path}/{filename}"
-        gcs_path = f"processed_trace_data/{filename}"
-        
+        gcs_prefix = f"{TRAIN_DATA_GCS_PREFIX}/{run_scope(context)}"
+
         # Verify bucket name
         if not bucket_name:
-            logging.error("Bucket name is not set in Airflow variables.")
-            return
-
-        # Initialize GCS Hook
-        gcs_hook = GCSHook()
-
-        # Check if file exists
-        if os.path.exists(local_path):
-            # Try uploading the file
-            gcs_hook.upload(
-                bucket_name=bucket_name,
-                object_name=gcs_path,
-                filename=local_path
-            )
-            logging.info(f"Uploaded {filename} to GCS at {gcs_path}")
-
-            return True
-        else:
-            logging.warning(f"File {local_path} does not exist.")
+            raise ValueError("Bucket name is not set in Airflow variables.")
+
+        missing = [path for path in shards if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Train data shards missing locally: {missing}")
+
+        upload_files_parallel(bucket_name, {path: f"{gcs_prefix}/{os.path.basename(path)}" for path in shards})
+        logging.info(f"Uploaded {len(shards)} shards to GCS at {gcs_prefix}")
+        context['ti'].xcom_push(key='train_data_gcs_prefix', value=gcs_prefix)
+        return True
     except Exception as e:
-        logging.error(f"Failed to upload file to GCS: {str(e)}")
\ No newline at end of file
+        logging.error(f"Failed to upload file to GCS: {str(e)}")
+        raise
@@ -0,0 +1,87 @@
+import time
+import hashlib
+import logging
+from scripts.artifact_utils import load_state, save_state
+from scripts.embedding_cache import normalize_text
+
+logging.basicConfig(level=logging.INFO)
+
+MAX_ENTRIES = 50000
+
+
+def template_version(template):
+    """
+    Version of a prompt template, derived from its text so that editing the
+    template invalidates the answers generated with the old one.
+    """
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()[:12]
+
+
+def generation_key(template_version, query, crns, model_name):
+    """
+    Content hash of a generation request.
+
+    :param template_version: version of the prompt template
+    :param query: user query
+    :param crns: CRNs of the retrieved courses, in any order
+    :param model_name: generative model
+    :return: hex encoded SHA-256 digest
+    """
+    payload = '\x1f'.join([template_version, normalize_text(query), ','.join(sorted(set(map(str, crns)))), model_name])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class GenerationCache:
+    """
+    Answers generated in earlier DAG runs, keyed by generation_key.
+
+    The cache is a JSON state document next to the run artifacts. save merges
+    with the stored document, so concurrent runs only lose entries on a
+    simultaneous write, and keeps the newest max_entries answers.
+
+    :param name: state name of the cache
+    :param max_entries: maximum number of answers kept
+    """
+
+    def __init__(self, name='generation_cache', max_entries=MAX_ENTRIES):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = {}
+        self._new_entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        self._entries = (load_state(self.name) or {}).get('entries', {})
+        self._new_entries = {}
+        logging.info(f"Loaded {len(self._entries)} cached generations")
+        return self
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['response']
+
+    def put(self, key, response):
+        entry = {'response': response, 'created_at': time.time()}
+        self._entries[key] = entry
+        self._new_entries[key] = entry
+
+    def save(self):
+        if not self._new_entries:
+            return
+        entries = (load_state(self.name) or {}).get('entries', {})
+        entries.update(self._new_entries)
+        if len(entries) > self.max_entries:
+            newest = sorted(entries.items(), key=lambda item: item[1]['created_at'], reverse=True)
+            entries = dict(newest[:self.max_entries])
+        save_state(self.name, {'entries': entries})
+        logging.info(f"Saved {len(self._new_entries)} new generations, {len(entries)} in total")
+        self._entries = entries
+        self._new_entries = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'generations_avoided': self.hits}
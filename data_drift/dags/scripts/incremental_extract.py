@@ -0,0 +1,147 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+
+logging.basicConfig(level=logging.INFO)
+
+PAGE_SIZE = 10000
+
+
+def encode_watermark(value):
+    """
+    Encode a watermark value as a JSON serializable dict that remembers its
+    BigQuery type, so it can be stored in an Airflow Variable or state file.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return {'type': 'TIMESTAMP', 'value': value.isoformat()}
+    if isinstance(value, int):
+        return {'type': 'INT64', 'value': value}
+    return {'type': 'STRING', 'value': str(value)}
+
+
+def decode_watermark(watermark):
+    value = watermark['value']
+    if watermark['type'] == 'TIMESTAMP':
+        value = datetime.fromisoformat(value)
+    return value
+
+
+def watermark_parameter(watermark, name='watermark'):
+    return bigquery.ScalarQueryParameter(name, watermark['type'], decode_watermark(watermark))
+
+
+def lagged_watermark(field_type, lag_seconds, now=None):
+    """
+    Encoded watermark lag_seconds before now, for a watermark column of the
+    given type.
+
+    The backend stamps a row with the time its request started but only
+    writes it when the request ends, so a row can land below a watermark
+    taken while it was in flight. With lag_seconds longer than the longest
+    request, every row at or below the lagged watermark is written.
+
+    :param field_type: BigQuery type of the watermark column, INT64 epoch
+        seconds or TIMESTAMP
+    :param lag_seconds: lag behind now
+    :param now: aware datetime, defaults to the current time
+    :return: encoded watermark
+    """
+    lagged = (now or datetime.now(timezone.utc)) - timedelta(seconds=lag_seconds)
+    if field_type in ('INT64', 'INTEGER'):
+        return encode_watermark(int(lagged.timestamp()))
+    if field_type == 'TIMESTAMP':
+        return encode_watermark(lagged.astimezone(timezone.utc))
+    raise ValueError(f"Cannot lag a {field_type} watermark column, use INT64 epoch seconds or a TIMESTAMP")
+
+
+def later_watermark(watermark, other):
+    """
+    The later of two encoded watermarks of the same column, either may be None.
+    """
+    if watermark is None or other is None:
+        return watermark or other
+    return watermark if decode_watermark(watermark) >= decode_watermark(other) else other
+
+
+def new_values_query(table_name, value_column, watermark_column=None, watermark=None, upper=None):
+    """
+    Query of the distinct values of a column from the rows added since a
+    watermark, and up to an upper watermark if one is given.
+
+    BigQuery deduplicates the values and the result is read page by page (see
+    read_new_values), so neither the query nor the task grows with rows read in
+    earlier runs. Without a watermark column every distinct value of the table
+    is read.
+
+    :param table_name: fully qualified table name
+    :param value_column: column to read, e.g. query or question
+    :param watermark_column: monotonically increasing column, e.g. an INT64
+        epoch or TIMESTAMP of insertion, or None
+    :param watermark: encoded watermark of the previous run, or None to read
+        the whole table
+    :param upper: encoded watermark of the last rows to read, or None
+    :return: tuple of the query and its list of query parameters
+    """
+    query_params = []
+    if watermark_column is None:
+        return f"SELECT DISTINCT {value_column} AS value FROM `{table_name}`", query_params
+
+    conditions = []
+    if watermark is not None:
+        conditions.append(f"{watermark_column} > @watermark")
+        query_params.append(watermark_parameter(watermark))
+    if upper is not None:
+        conditions.append(f"{watermark_column} <= @upper")
+        query_params.append(watermark_parameter(upper, 'upper'))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f"""
+        SELECT {value_column} AS value, MAX({watermark_column}) AS watermark
+        FROM `{table_name}`
+        {where}
+        GROUP BY {value_column}"""
+    return query, query_params
+
+
+def query_job_configuration(query, query_params=()):
+    """
+    Job configuration of a standard SQL query, in the REST form taken by
+    BigQueryInsertJobOperator. It is JSON serializable, so a task can build it
+    and pass it to the operator through XCom.
+
+    :param query: standard SQL query or script
+    :param query_params: list of bigquery query parameters
+    """
+    return {
+        'query': {
+            'query': query,
+            'useLegacySql': False,
+            'parameterMode': 'NAMED',
+            'queryParameters': [param.to_api_repr() for param in query_params],
+        }
+    }
+
+
+def read_new_values(rows, table_name, watermark_column=None, watermark=None):
+    """
+    Read the result of a new_values_query page by page.
+
+    :param rows: RowIterator of the query result
+    :param table_name: table name, for logging
+    :param watermark_column: watermark column of the query, or None
+    :param watermark: encoded watermark the query started from
+    :return: tuple of the list of distinct values and the encoded watermark
+        after them (the previous watermark if no rows were added)
+    """
+    values = []
+    new_watermark = None
+    for page_number, page in enumerate(rows.pages, start=1):
+        for row in page:
+            values.append(row['value'])
+            if watermark_column is not None and (new_watermark is None or row['watermark'] > new_watermark):
+                new_watermark = row['watermark']
+        logging.info(f"Read page {page_number} of {table_name}: {len(values)} values so far")
+
+    return values, encode_watermark(new_watermark) or watermark
+
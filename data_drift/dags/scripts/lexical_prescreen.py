@@ -0,0 +1,132 @@
+import re
+import zlib
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+BANDS = 16
+JACCARD_THRESHOLD = 0.7
+CHUNK_SIZE = 1024
+# Mersenne prime 2^31 - 1: with multipliers below it, a * hash + b fits in uint64
+_PRIME = np.uint64((1 << 31) - 1)
+_EMPTY = np.iinfo(np.uint32).max
+
+
+def shingle_hashes(text, shingle_size=SHINGLE_SIZE):
+    """
+    CRC32 hashes of the character n-grams of a lower-cased text with
+    punctuation removed and whitespace collapsed.
+
+    :return: uint64 array of the distinct shingle hashes
+    """
+    text = ' '.join(re.sub(r'[^\w\s]', '', text.lower()).split())
+    if not text:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {text[i:i + shingle_size] for i in range(max(len(text) - shingle_size + 1, 1))}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64)
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts over their character shingles.
+
+    The fraction of equal signature positions of two texts estimates the
+    Jaccard similarity of their shingle sets. Hash functions are fixed by the
+    seed, so signatures of different runs are comparable.
+
+    :param num_perm: number of hash functions
+    :param seed: seed of the hash functions
+    """
+
+    def __init__(self, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, int(_PRIME), num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(_PRIME), num_perm, dtype=np.uint64)
+
+    def signatures(self, texts):
+        """
+        :return: (len(texts), num_perm) uint32 signatures; texts without any
+            shingle get a signature that matches nothing
+        """
+        signatures = np.full((len(texts), self.num_perm), _EMPTY, dtype=np.uint32)
+        for start in range(0, len(texts), CHUNK_SIZE):
+            hashes = [shingle_hashes(text, self.shingle_size) for text in texts[start:start + CHUNK_SIZE]]
+            sizes = np.array([h.size for h in hashes])
+            rows = start + np.flatnonzero(sizes)
+            if rows.size == 0:
+                continue
+            # all shingles of the chunk at once, reduced to a minimum per text
+            flat = np.concatenate(hashes) % _PRIME
+            permuted = (self.a[:, None] * flat[None, :] + self.b[:, None]) % _PRIME
+            offsets = np.concatenate([[0], np.cumsum(sizes[sizes > 0])[:-1]])
+            signatures[rows] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return signatures
+
+
+class LSHIndex:
+    """
+    Banded locality-sensitive hashing index of MinHash signatures.
+
+    Signatures are cut into bands of num_perm / bands positions. Two texts
+    become candidates when they agree on a whole band, which happens with
+    probability 1 - (1 - J^r)^b for Jaccard similarity J, r rows per band and
+    b bands, an S-curve rising around (1 / b)^(1 / r). Candidates are then
+    verified on their full signatures.
+
+    :param signatures: (n, num_perm) signatures of the indexed texts
+    :param bands: number of bands
+    """
+
+    def __init__(self, signatures, bands=BANDS):
+        if signatures.shape[1] % bands:
+            raise ValueError(f"{signatures.shape[1]} signature positions cannot be cut into {bands} bands")
+        self.signatures = signatures
+        self.bands = bands
+        self.rows = signatures.shape[1] // bands
+        band_hashes = self._band_hashes(signatures)
+        self._order = np.argsort(band_hashes, axis=0, kind='stable')
+        self._sorted = np.take_along_axis(band_hashes, self._order, axis=0)
+
+    def _band_hashes(self, signatures):
+        # one uint64 per band, wrapping arithmetic; collisions are removed by verification
+        multipliers = np.random.default_rng(1).integers(1, 1 << 62, self.rows, dtype=np.uint64)
+        bands = signatures.astype(np.uint64).reshape(signatures.shape[0], self.bands, self.rows)
+        return (bands * multipliers).sum(axis=2)
+
+    def best_matches(self, signatures):
+        """
+        Most similar indexed text of every query signature.
+
+        :param signatures: (m, num_perm) query signatures
+        :return: tuple of the index of the best candidate per query (-1 if
+            there was none) and its estimated Jaccard similarity
+        """
+        matches = np.full(signatures.shape[0], -1, dtype=np.int64)
+        similarities = np.zeros(signatures.shape[0], dtype=np.float32)
+        if signatures.shape[0] == 0 or self.signatures.shape[0] == 0:
+            return matches, similarities
+
+        band_hashes = self._band_hashes(signatures)
+        starts = np.empty_like(band_hashes, dtype=np.int64)
+        ends = np.empty_like(band_hashes, dtype=np.int64)
+        for band in range(self.bands):
+            starts[:, band] = np.searchsorted(self._sorted[:, band], band_hashes[:, band], side='left')
+            ends[:, band] = np.searchsorted(self._sorted[:, band], band_hashes[:, band], side='right')
+
+        for query in np.flatnonzero((ends > starts).any(axis=1)):
+            if signatures[query, 0] == _EMPTY:
+                continue
+            candidates = np.unique(np.concatenate([
+                self._order[start:end, band]
+                for band, (start, end) in enumerate(zip(starts[query], ends[query])) if end > start
+            ]))
+            agreement = (self.signatures[candidates] == signatures[query]).mean(axis=1)
+            best = agreement.argmax()
+            matches[query] = candidates[best]
+            similarities[query] = agreement[best]
+        return matches, similarities
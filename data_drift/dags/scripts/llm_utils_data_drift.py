@@ -3,28 +3,43 @@ import ast
 import logging
 from vertexai.generative_models import HarmCategory, HarmBlockThreshold, GenerationConfig
 from scripts.backoff import exponential_backoff
-from scripts.constants_data_drift import CLIENT_MODEL, QUERY_GENERATION_PROMPT, GENERATED_SAMPLE_COUNT
+from scripts.constants_data_drift import CLIENT_MODEL, LLM_MODEL_NAME, QUERY_GENERATION_PROMPT, GENERATED_SAMPLE_COUNT, LLM_PROMPT_TEMPLATE, TRAIN_DATA_PREFIX, PROJECT_ID
+from scripts.rate_limiter import TokenBucket
+from scripts.quota_scheduler import QuotaScheduler, FileQuotaStore, BATCH
+from scripts.artifact_utils import RunCheckpoint, run_scope
+from scripts.parquet_shards import ShardedParquetWriter
+from scripts.generation_cache import GenerationCache, generation_key, template_version
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from airflow.models import Variable
 import os
-import pandas as pd
+import pyarrow as pa
+
+TRAIN_DATA_DIR = '/tmp/llm_train_data'
+TRAIN_DATA_SCHEMA = pa.schema([('question', pa.string()), ('context', pa.string()), ('response', pa.string())])
 
 @exponential_backoff()
-def get_llm_response(input_prompt: str) -> str:
+def get_llm_response(input_prompt: str, quota=None) -> str:
     """
     Get response from LLM with exponential backoff retry logic.
+
+    With a QuotaScheduler, every attempt takes a batch token of the Gemini
+    quota shared with the backend and reports quota errors back to it.
     """
-    res = CLIENT_MODEL.generate_content(
-        input_prompt,
-        safety_settings={
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        },
-        generation_config=GenerationConfig(
-            max_output_tokens=1024,
-            temperature=0.7,
-        ),
-    ).text
+    with quota.slot(BATCH) if quota is not None else nullcontext():
+        res = CLIENT_MODEL.generate_content(
+            input_prompt,
+            safety_settings={
+                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+            },
+            generation_config=GenerationConfig(
+                max_output_tokens=1024,
+                temperature=0.7,
+            ),
+        ).text
     return res
 
 def llm_response_parser(llm_response):
@@ -45,60 +60,158 @@ def llm_response_parser(llm_response):
         return None
 
 
+def generate_samples(query_responses, target_count, sink, max_workers=4, requests_per_second=2.0, checkpoint=None,
+                     cache=None, quota=None):
+    """
+    Generate answers for the drift queries concurrently.
+
+    Prompts run on a thread pool, each after taking a token from a rate
+    limiter and, with a quota scheduler, a batch token of the shared Gemini
+    quota, which yields to the backend's interactive requests. A new prompt is only dispatched while the finished and in-flight
+    generations are short of target_count, so no call is paid for beyond the
+    target. Every finished row is appended to the checkpoint, and queries
+    already in the checkpoint are not generated again. Answers found in the
+    generation cache are reused without a call and count toward the target.
+
+    Rows are handed to sink as they finish, checkpointed rows first, instead
+    of being kept, so memory does not grow with the number of samples.
+
+    :param query_responses: dict of query to its similarity search result
+    :param target_count: number of samples to generate
+    :param sink: callable taking each {question, context, response} row
+    :param max_workers: number of generations in flight
+    :param requests_per_second: generation request rate
+    :param checkpoint: RunCheckpoint of the task, or None
+    :param cache: loaded GenerationCache, or None
+    :param quota: QuotaScheduler of the Gemini quota, or None
+    :return: number of rows handed to sink
+    """
+    rows = checkpoint.load() if checkpoint is not None else []
+    done = {row['question'] for row in rows}
+    if rows:
+        logging.info(f"Resuming from {len(rows)} checkpointed samples")
+    for row in rows:
+        sink(row)
+    produced = len(rows)
+    del rows
+
+    pending = iter([(query, response) for query, response in query_responses.items() if query not in done])
+    limiter = TokenBucket(requests_per_second, capacity=max_workers)
+    version = template_version(LLM_PROMPT_TEMPLATE)
+
+    def cache_key(query, response):
+        return generation_key(version, query, response.get('crns', []), LLM_MODEL_NAME)
+
+    def add_row(row):
+        nonlocal produced
+        sink(row)
+        produced += 1
+        if checkpoint is not None:
+            checkpoint.append(row)
+
+    def generate(query, response):
+        limiter.acquire()
+        llm_context = response['final_content']
+        llm_res = get_llm_response(LLM_PROMPT_TEMPLATE.format(query=query, content=llm_context), quota)
+        if cache is not None:
+            cache.put(cache_key(query, response), llm_res)
+        return {'question': query, 'context': llm_context, 'response': llm_res}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        error = None
+        while True:
+            while error is None and len(in_flight) < max_workers and produced + len(in_flight) < target_count:
+                item = next(pending, None)
+                if item is None:
+                    break
+                cached_response = cache.get(cache_key(*item)) if cache is not None else None
+                if cached_response is not None:
+                    query, response = item
+                    add_row({'question': query, 'context': response['final_content'], 'response': cached_response})
+                    continue
+                in_flight.add(executor.submit(generate, *item))
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    row = future.result()
+                except Exception as e:
+                    # stop dispatching, keep what finished, and fail the task so that a retry resumes
+                    error = error or e
+                    continue
+                add_row(row)
+            logging.info(f'Generated {produced} samples')
+
+    if checkpoint is not None:
+        checkpoint.sync()
+    if cache is not None:
+        cache.save()
+    if error is not None:
+        raise error
+    return produced
+
+
+def load_llm_quota():
+    """
+    The scheduler of the Gemini quota, shared with the backend through the
+    file named by the llm_quota_store_path Variable. Without it, the quota is
+    only shared within the task.
+    """
+    store_path = Variable.get('llm_quota_store_path', default_var=None)
+    return QuotaScheduler(
+        PROJECT_ID,
+        LLM_MODEL_NAME,
+        float(Variable.get('llm_quota_requests_per_second', default_var=5)),
+        batch_share=float(Variable.get('llm_quota_batch_share', default_var=0.5)),
+        store=FileQuotaStore(store_path) if store_path else None,
+    )
+
+
 def generate_llm_response(**context):
     """
     This function is responsible for generating LLM responses based on the similarity search results from BigQuery.
-    It takes the task instance context as input and returns a string "generate_samples" if successful.
+    It takes the task instance context as input and returns True if successful.
 
-    The function first checks the task status from the previous task, and if it is "stop_task", it returns "stop_task".
-    Otherwise, it retrieves the similarity search results from the previous task and generates LLM responses based on the results.
-    The generated responses are then saved to a Parquet file named "llm_train_data.pq" in the /tmp directory.
+    The function first checks the drift status from the previous task, and if no drift was detected, it returns False.
+    Otherwise, it retrieves the similarity search results from the previous task and generates up to
+    GENERATED_SAMPLE_COUNT LLM responses concurrently, reusing answers cached by earlier runs for the same
+    (prompt template, query, CRNs, model) and checkpointing every response to a run-scoped JSONL file.
+    The responses are streamed as zstd-compressed row groups into run-scoped Parquet shards
+    /tmp/llm_train_data/<dag_id>/<run_id>/llm_train_data_drift-NNNNN.parquet, whose paths are pushed to XCom
+    as 'train_data_shards'.
 
     :param context: task instance context
-    :return: string "generate_samples" if successful
+    :return: True if successful
     """
     drift_status = context['ti'].xcom_pull(task_ids='data_drift_detection', key='data_drift')
     logging.info(f"drift_status: {drift_status}")
     if drift_status == False:
         logging.info("No data drift detected. Not generating LLM responses")
         return False
-    
-
 
     query_responses = context['ti'].xcom_pull(task_ids='bq_similarity_search', key='similarity_results')
 
-    prompt = """          
-            Given the user question and the relevant information from the database, craft a concise and informative response:
-            User Question:
-            {query}
-            Context:
-            {content}
-            The response should:
-            1. Highlight the main topics and unique aspects of the course content.
-            2. Summarize the instructor’s teaching style and notable strengths or weaknesses.
-            3. Clearly address potential benefits and challenges of the course, providing a straightforward recommendation as needed.
-            Ensure the answer is direct, informative, and relevant to the user’s question.
-            """
-
-    train_data_df = pd.DataFrame(columns=['question', 'context', 'response'])
-    for query, response in query_responses.items():
-        llm_context = response['final_content']
-        input_prompt = prompt.format(query=query, content=llm_context)
-        llm_res = get_llm_response(input_prompt)
-        train_data_df = pd.concat([train_data_df, pd.DataFrame({'question': [query], 'context': [llm_context], 'response': [llm_res]})], ignore_index=True)
-        logging.info(f'Generated {len(train_data_df)} samples')
-        if len(train_data_df) > GENERATED_SAMPLE_COUNT:
-            break
-
-    logging.info(f'Generated {len(train_data_df)} samples')
-    logging.info(f'Size of train_data_df: {train_data_df.memory_usage(deep=True).sum() / 1024**2} MB')
-    context['ti'].xcom_push(key='generated_samples_count', value=len(train_data_df))
-
-    if os.path.exists('/tmp/llm_train_data_drift.pq'):
-        logging.info("llm_train_data_drift.pq exists, removing...")
-        os.remove('/tmp/llm_train_data_drift.pq')
-    if not os.path.exists('/tmp/llm_train_data_drift.pq'):
-        logging.info("Successfully removed llm_train_data_drift.pq")
-    train_data_df.to_parquet('/tmp/llm_train_data_drift.pq', index=False)
-    logging.info(f"llm_train_data_drift.pq exists: {os.path.exists('/tmp/llm_train_data_drift.pq')}")
+    cache = GenerationCache().load()
+    writer = ShardedParquetWriter(os.path.join(TRAIN_DATA_DIR, run_scope(context)), TRAIN_DATA_PREFIX,
+                                  TRAIN_DATA_SCHEMA)
+    with writer:
+        sample_count = generate_samples(
+            query_responses,
+            GENERATED_SAMPLE_COUNT,
+            writer.write,
+            max_workers=int(Variable.get('llm_max_workers', default_var=4)),
+            requests_per_second=float(Variable.get('llm_requests_per_second', default_var=2)),
+            checkpoint=RunCheckpoint(context, 'generated_samples'),
+            cache=cache,
+            quota=load_llm_quota(),
+        )
+    logging.info(f"Generation cache: {cache.hits} generations avoided, {cache.misses} misses")
+    context['ti'].xcom_push(key='generation_cache_stats', value=cache.stats())
+
+    logging.info(f'Generated {sample_count} samples')
+    context['ti'].xcom_push(key='generated_samples_count', value=sample_count)
+    context['ti'].xcom_push(key='train_data_shards', value=writer.paths)
     return True
@@ -0,0 +1,100 @@
+import os
+import glob
+import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logging.basicConfig(level=logging.INFO)
+
+ROW_GROUP_ROWS = 500
+SHARD_ROWS = 10000
+COMPRESSION = 'zstd'
+
+
+class ShardedParquetWriter:
+    """
+    Write rows incrementally to a sequence of compressed Parquet shards.
+
+    Rows are buffered column by column and flushed as one row group every
+    row_group_rows rows, and a new shard file is started every shard_rows
+    rows, so memory holds at most one row group whatever the number of rows.
+    Shards are named <prefix>-00000.parquet, <prefix>-00001.parquet, ... in
+    directory, which can be matched by a <prefix>-*.parquet wildcard.
+
+    :param directory: local directory of the shards, emptied of earlier shards
+        with the same prefix
+    :param prefix: shard file name prefix
+    :param schema: pyarrow.Schema of the rows
+    :param row_group_rows: rows per row group
+    :param shard_rows: rows per shard file
+    """
+
+    def __init__(self, directory, prefix, schema, row_group_rows=ROW_GROUP_ROWS, shard_rows=SHARD_ROWS,
+                 compression=COMPRESSION):
+        self.directory = directory
+        self.prefix = prefix
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.shard_rows = shard_rows
+        self.compression = compression
+        self.paths = []
+        self.rows = 0
+        self._writer = None
+        self._shard_rows = 0
+        self._buffer = {name: [] for name in schema.names}
+        self._buffered = 0
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, f'{prefix}-*.parquet')):
+            os.remove(path)
+
+    def write(self, row):
+        """
+        :param row: dict with a value for every column of the schema
+        """
+        for name, values in self._buffer.items():
+            values.append(row[name])
+        self._buffered += 1
+        self.rows += 1
+        if self._buffered >= self.row_group_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        if self._writer is None:
+            path = os.path.join(self.directory, f'{self.prefix}-{len(self.paths):05d}.parquet')
+            self._writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            self.paths.append(path)
+        self._writer.write_table(pa.Table.from_pydict(self._buffer, schema=self.schema))
+        self._shard_rows += self._buffered
+        self._buffer = {name: [] for name in self.schema.names}
+        self._buffered = 0
+        if self._shard_rows >= self.shard_rows:
+            self._close_shard()
+
+    def _close_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._shard_rows = 0
+
+    def close(self):
+        """
+        Flush the buffered rows and close the open shard.
+
+        :return: list of the shard paths
+        """
+        self._flush()
+        self._close_shard()
+        size = sum(os.path.getsize(path) for path in self.paths)
+        logging.info(f"Wrote {self.rows} rows to {len(self.paths)} Parquet shards ({size / 1024 ** 2:.1f} MB)")
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_shard()
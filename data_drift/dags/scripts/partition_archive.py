@@ -0,0 +1,264 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+from scripts.incremental_extract import query_job_configuration
+
+logging.basicConfig(level=logging.INFO)
+
+# partition id format of every time partitioning type
+TIME_PARTITION_FORMATS = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+
+
+def partitioning_spec(table):
+    """
+    Partitioning of a table as a comparable tuple.
+
+    :param table: bigquery.Table
+    :return: ('time', type, field), ('range', field, start, end, interval) or
+        None for an unpartitioned table
+    """
+    if table.time_partitioning is not None:
+        return ('time', table.time_partitioning.type_, table.time_partitioning.field)
+    if table.range_partitioning is not None:
+        partition_range = table.range_partitioning.range_
+        return ('range', table.range_partitioning.field, partition_range.start, partition_range.end,
+                partition_range.interval)
+    return None
+
+
+def is_sealed(partition_id, spec, watermark):
+    """
+    Whether a partition only holds rows strictly below the watermark.
+
+    The watermark lags behind the longest request (see
+    incremental_extract.lagged_watermark), so such a partition receives no
+    more rows, and all of its rows were read by runs up to the watermark.
+    The partition holding the watermark is never sealed. Pseudo partitions
+    (__NULL__, __UNPARTITIONED__) are never sealed.
+
+    :param partition_id: partition id from INFORMATION_SCHEMA.PARTITIONS
+    :param spec: partitioning_spec of the table
+    :param watermark: encoded watermark (see incremental_extract)
+    """
+    if not partition_id.isdigit():
+        return False
+    if spec[0] == 'time':
+        value = datetime.fromisoformat(watermark['value'])
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        # ids of one partitioning type have the same length, so they sort chronologically
+        return partition_id < value.strftime(TIME_PARTITION_FORMATS[spec[1]])
+    interval = spec[4]
+    return int(partition_id) + interval <= int(watermark['value'])
+
+
+def supports_partition_archival(source, destination, watermark_column, watermark):
+    """
+    Whether sealed partitions of the source can be copied to the destination:
+    both tables are partitioned the same way on the watermark column, by time
+    for a TIMESTAMP watermark or by integer range for an INT64 one.
+
+    :param source: bigquery.Table
+    :param destination: bigquery.Table
+    """
+    spec = partitioning_spec(source)
+    if spec is None or spec != partitioning_spec(destination):
+        return False
+    if spec[0] == 'time':
+        return spec[2] == watermark_column and watermark['type'] == 'TIMESTAMP'
+    return spec[1] == watermark_column and watermark['type'] == 'INT64'
+
+
+def list_partitions(client, table):
+    """
+    List the partitions of a table from INFORMATION_SCHEMA.PARTITIONS, a
+    metadata query that does not scan the table.
+
+    :param client: bigquery.Client
+    :param table: bigquery.Table
+    :return: list of (partition_id, total_rows, last_modified_time) in
+        partition order
+    """
+    query = f"""
+        SELECT partition_id, total_rows, last_modified_time
+        FROM `{table.project}.{table.dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+        WHERE table_name = @table_name
+        ORDER BY partition_id"""
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter('table_name', 'STRING', table.table_id)]
+    )
+    return [
+        (row['partition_id'], row['total_rows'], row['last_modified_time'])
+        for row in client.query(query, job_config=job_config).result()
+    ]
+
+
+def sealed_partitions(client, table, watermark):
+    """
+    List the sealed partitions of a table.
+
+    :param watermark: encoded watermark
+    :return: list of (partition_id, total_rows, last_modified_time) in
+        partition order
+    """
+    spec = partitioning_spec(table)
+    return [partition for partition in list_partitions(client, table) if is_sealed(partition[0], spec, watermark)]
+
+
+def partition_column(spec):
+    """
+    Column a table is partitioned on, from its partitioning_spec.
+    """
+    return spec[2] if spec[0] == 'time' else spec[1]
+
+
+def partition_range_parameters(partition_id, spec):
+    """
+    Query parameters @lower and @upper bounding the rows of one partition:
+    lower <= column < upper.
+
+    :param partition_id: partition id from INFORMATION_SCHEMA.PARTITIONS
+    :param spec: partitioning_spec of the table
+    :return: list of two bigquery.ScalarQueryParameter
+    """
+    if spec[0] == 'range':
+        lower = int(partition_id)
+        return [bigquery.ScalarQueryParameter('lower', 'INT64', lower),
+                bigquery.ScalarQueryParameter('upper', 'INT64', lower + spec[4])]
+    lower = datetime.strptime(partition_id, TIME_PARTITION_FORMATS[spec[1]]).replace(tzinfo=timezone.utc)
+    if spec[1] == 'HOUR':
+        upper = lower + timedelta(hours=1)
+    elif spec[1] == 'DAY':
+        upper = lower + timedelta(days=1)
+    elif spec[1] == 'MONTH':
+        upper = lower.replace(year=lower.year + lower.month // 12, month=lower.month % 12 + 1)
+    else:
+        upper = lower.replace(year=lower.year + 1)
+    return [bigquery.ScalarQueryParameter('lower', 'TIMESTAMP', lower),
+            bigquery.ScalarQueryParameter('upper', 'TIMESTAMP', upper)]
+
+
+def staging_table_name(destination_table_ref, partition_id):
+    """
+    Staging table a partition is copied to before it leaves the source.
+    """
+    return f"{destination_table_ref}_archive_{partition_id}"
+
+
+def copy_job_configuration(client, source_table_ref, destination_table_ref, write_disposition):
+    """
+    Job configuration of a table copy, in the REST form taken by
+    BigQueryInsertJobOperator. Copy jobs read no bytes.
+
+    :param client: bigquery.Client, whose project qualifies partial names
+    :param source_table_ref: table name, with a partition decorator or not
+    :param destination_table_ref: table name, with a partition decorator or not
+    :param write_disposition: WRITE_TRUNCATE or WRITE_APPEND
+    """
+    return {
+        'copy': {
+            'sourceTable': bigquery.TableReference.from_string(
+                source_table_ref, default_project=client.project).to_api_repr(),
+            'destinationTable': bigquery.TableReference.from_string(
+                destination_table_ref, default_project=client.project).to_api_repr(),
+            'writeDisposition': write_disposition,
+        }
+    }
+
+
+def archive_partition_script(source_table_ref, staging_table_ref, column, key_columns=(), updatable_columns=()):
+    """
+    Script that removes one partition, bounded by @lower and @upper, from the
+    source once it has been copied to a staging table. It returns one row:
+    the number of rows it removed as archived_rows, and error, the message of
+    the error that rolled it back, if any.
+
+    The rows are removed with a single partition-scoped DELETE guarded by the
+    row count of the copy: rows added to the partition since the copy make it
+    a no-op, so they are never lost, and the partition is archived by a later
+    run. Updates of updatable_columns since the copy, like the backend's
+    feedback, are expected: they are carried over to the staging copy, matched
+    on key_columns, in the same transaction as the DELETE. A transaction
+    aborted by a concurrent write is rolled back and removes nothing.
+
+    :param source_table_ref: fully qualified source table name
+    :param staging_table_ref: fully qualified name of the staging copy
+    :param column: partitioning column
+    :param key_columns: columns identifying a row, for carrying updates
+    :param updatable_columns: columns that may be updated after the copy
+    """
+    partition = f"{column} >= @lower AND {column} < @upper"
+    carry = ''
+    if updatable_columns:
+        carry = f"""
+        UPDATE `{staging_table_ref}` AS archived
+        SET {', '.join(f'{name} = current.{name}' for name in updatable_columns)}
+        FROM (
+            SELECT {', '.join(list(key_columns) + list(updatable_columns))}
+            FROM `{source_table_ref}`
+            WHERE {partition}
+        ) AS current
+        WHERE {' AND '.join(f'archived.{name} = current.{name}' for name in key_columns)}
+            AND ({' OR '.join(f'archived.{name} IS DISTINCT FROM current.{name}' for name in updatable_columns)});
+"""
+    return f"""
+    DECLARE archived_rows INT64 DEFAULT 0;
+    DECLARE error STRING;
+
+    BEGIN
+        BEGIN TRANSACTION;
+        {carry}
+        DELETE FROM `{source_table_ref}`
+        WHERE {partition}
+            AND (SELECT COUNT(*) FROM `{source_table_ref}` WHERE {partition}) = (SELECT COUNT(*) FROM `{staging_table_ref}`);
+        SET archived_rows = @@row_count;
+
+        COMMIT TRANSACTION;
+    EXCEPTION WHEN ERROR THEN
+        ROLLBACK TRANSACTION;
+        SET archived_rows = 0;
+        SET error = @@error.message;
+    END;
+
+    SELECT archived_rows, error;
+    """
+
+
+def plan_partition_archival(client, source_table_ref, destination_table_ref, watermark, key_columns=(),
+                            updatable_columns=()):
+    """
+    Plan the move of the sealed partitions of a table into an archive table
+    with the same partitioning, as jobs for BigQueryInsertJobOperator.
+
+    Every sealed partition is first copied into its staging table next to the
+    destination. Once all copies are done, archive_partition_script removes
+    it from the source. Only partitions it removed are then appended from
+    their staging table to the same partition of the destination; the others
+    keep their rows in the source, and are archived by a later run. Rows of
+    the open partitions stay in the source until their partition is sealed.
+
+    :param client: bigquery.Client
+    :param source_table_ref: fully qualified source table name
+    :param destination_table_ref: fully qualified destination table name
+    :param watermark: encoded watermark of the rows read so far
+    :param key_columns: columns identifying a row, for carrying updates
+    :param updatable_columns: columns that may be updated after the copy
+    :return: tuple of the sealed partition ids, their copy job configurations
+        and their archive job configurations, in partition order
+    """
+    source_table = client.get_table(source_table_ref)
+    spec = partitioning_spec(source_table)
+    partition_ids = [partition_id for partition_id, _, _ in sealed_partitions(client, source_table, watermark)]
+    copy_jobs = [
+        copy_job_configuration(client, f"{source_table_ref}${partition_id}",
+                               staging_table_name(destination_table_ref, partition_id), 'WRITE_TRUNCATE')
+        for partition_id in partition_ids
+    ]
+    archive_jobs = [
+        query_job_configuration(
+            archive_partition_script(source_table_ref, staging_table_name(destination_table_ref, partition_id),
+                                     partition_column(spec), key_columns, updatable_columns),
+            partition_range_parameters(partition_id, spec))
+        for partition_id in partition_ids
+    ]
+    return partition_ids, copy_jobs, archive_jobs
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+# Shared by the backend and the drift DAG, which must use the same store and key to share a quota.
+# data_drift/dags/scripts/quota_scheduler.py is a vendored copy of this file, kept identical by
+# data_drift/check_vendored.py: edit this file and copy it over. It only imports the standard library.
+
+# Priority classes, highest first
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# How long a request keeps its class marked as active after asking for a token
+DEMAND_HOLD = 2.0
+# How long lower classes hold off after a throttled call
+THROTTLE_COOLDOWN = 5.0
+# Longest sleep between two looks at the shared state, so priorities are re-checked
+MAX_POLL = 0.5
+
+
+def is_throttling_error(error):
+    """
+    Whether an exception from a Google API call is a quota / rate limit error.
+    """
+    if getattr(error, "code", None) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error)
+    return "429" in message or "Quota exceeded" in message or "RESOURCE_EXHAUSTED" in message
+
+
+def model_quota_key(model_name):
+    """
+    Quota key of the model GenerativeModel(model_name) calls.
+
+    Publisher models are keyed by their short name, so "gemini-1.5-flash-002" and its full resource name
+    share one quota; endpoints of tuned models are keyed by their endpoint ID.
+
+    Args:
+        model_name: Model name or resource name passed to GenerativeModel.
+
+    Returns:
+        The quota key of the model.
+    """
+    name = model_name.strip().rstrip("/")
+    if "/models/" in name:
+        return name.rsplit("/models/", 1)[1]
+    if "/endpoints/" in name:
+        return "endpoints/" + name.rsplit("/endpoints/", 1)[1]
+    return name
+
+
+class InMemoryQuotaStore:
+    """
+    In-memory stand-in for the shared quota store.
+
+    One instance shared between several QuotaScheduler objects behaves like a shared store, which is what
+    a single process and tests use.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self, key):
+        with self._lock:
+            state = self._states.setdefault(key, {})
+            yield state
+
+
+class FileQuotaStore:
+    """
+    Quota store kept in a JSON file under an exclusive flock, shared by every process on the host
+    (e.g. the backend workers and an Airflow worker mounting the same directory).
+
+    Args:
+        path: Path of the state file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def transaction(self, key):
+        # a file object per transaction: flock excludes other threads as well as other processes
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                states = json.loads(content) if content else {}
+                state = states.setdefault(key, {})
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(states))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class QuotaScheduler:
+    """
+    Token bucket per (project, model) kept in a shared store, with priority classes and 429 feedback.
+
+    Every process calling the model takes its tokens from the same bucket, so together they stay under
+    the quota. The bucket refills at an adaptive rate: a throttled call halves it and every successful
+    call raises it by a small step, back up to requests_per_second.
+
+    A class asking for a token marks itself active for DEMAND_HOLD seconds. While a higher class is
+    active, lower classes only take tokens above a reserve of (1 - batch_share) of the bucket, and after
+    a throttled call they hold off for THROTTLE_COOLDOWN seconds, so interactive requests find tokens
+    while batch jobs run. Without interactive traffic a batch job can use the whole quota.
+
+    Args:
+        project: Google Cloud project of the quota.
+        model: Model GenerativeModel is called with, keyed by model_quota_key.
+        requests_per_second: Quota of the model in requests per second.
+        capacity: Largest burst, defaults to one second of quota.
+        batch_share: Share of the bucket lower classes may use while a higher class is active.
+        store: InMemoryQuotaStore or FileQuotaStore shared by the schedulers of the quota.
+    """
+
+    def __init__(self, project, model, requests_per_second, capacity=None, batch_share=0.5, store=None):
+        self.key = f"{project}/{model_quota_key(model)}"
+        self.max_rate = float(requests_per_second)
+        self.min_rate = self.max_rate / 32
+        self.increase_step = self.max_rate / 50
+        self.capacity = float(capacity if capacity is not None else max(self.max_rate, 1))
+        self.reserve = max(1.0, self.capacity * (1 - batch_share))
+        self.store = store if store is not None else InMemoryQuotaStore()
+
+    def _refill(self, state, now):
+        rate = min(state.get("rate", self.max_rate), self.max_rate)
+        tokens = state.get("tokens", self.capacity)
+        state["tokens"] = min(self.capacity, tokens + max(now - state.get("updated", now), 0) * rate)
+        state["rate"] = rate
+        state["updated"] = now
+
+    def _try_acquire(self, priority):
+        """
+        Takes a token if the priority class may have one now.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds to wait before trying again.
+        """
+        rank = PRIORITIES.index(priority)
+        with self.store.transaction(self.key) as state:
+            now = time.time()
+            self._refill(state, now)
+            demand = state.setdefault("demand", {})
+            demand[priority] = now + DEMAND_HOLD
+
+            floor = 0.0
+            if any(demand.get(higher, 0) > now for higher in PRIORITIES[:rank]):
+                floor = self.reserve
+            if rank > 0 and state.get("throttled_until", 0) > now:
+                return min(state["throttled_until"] - now, MAX_POLL)
+            if state["tokens"] - 1 >= floor:
+                state["tokens"] -= 1
+                return 0
+            return min((floor + 1 - state["tokens"]) / state["rate"], MAX_POLL)
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """
+        Blocks until the priority class may make one call.
+
+        Args:
+            priority: INTERACTIVE or BATCH.
+            timeout: Longest wait in seconds, or None to wait as long as needed.
+
+        Returns:
+            True if a token was taken, False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_acquire(priority)
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.store.transaction(self.key) as state:
+            self._refill(state, time.time())
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase_step)
+
+    def on_throttle(self):
+        with self.store.transaction(self.key) as state:
+            now = time.time()
+            self._refill(state, now)
+            state["rate"] = max(self.min_rate, state["rate"] / 2)
+            # drop the burst allowance so the slowdown takes effect immediately
+            state["tokens"] = min(state["tokens"], 0)
+            state["throttled_until"] = now + THROTTLE_COOLDOWN
+            rate = state["rate"]
+        logging.warning(f"Quota {self.key} throttled, reducing request rate to {rate:.2f}/s")
+
+    @contextmanager
+    def slot(self, priority=INTERACTIVE, timeout=None):
+        """
+        Takes a token for one call and reports its outcome: a quota error slows every client of the
+        quota down, a success lets the rate recover.
+
+        Interactive calls go ahead when no token is available within the timeout, relying on the
+        caller's retries, rather than failing the request.
+        """
+        if not self.acquire(priority, timeout):
+            logging.warning(f"No {priority} token for quota {self.key} within {timeout} s, calling anyway")
+        try:
+            yield
+        except Exception as e:
+            if is_throttling_error(e):
+                self.on_throttle()
+            raise
+        self.on_success()
+
+    def status(self):
+        """
+        Returns the shared state of the quota.
+        """
+        with self.store.transaction(self.key) as state:
+            now = time.time()
+            self._refill(state, now)
+            return {
+                "key": self.key,
+                "rate": state["rate"],
+                "max_rate": self.max_rate,
+                "tokens": state["tokens"],
+                "active_classes": [priority for priority, until in state.get("demand", {}).items() if until > now],
+                "throttled": state.get("throttled_until", 0) > now,
+            }
+
@@ -0,0 +1,41 @@
+import time
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens refill continuously at `rate` per second up to `capacity`. acquire
+    blocks until the requested tokens are available. The rate is fixed; the
+    adaptive, shared rate limits are QuotaScheduler's (quota_scheduler.py).
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens held, i.e. the allowed burst
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
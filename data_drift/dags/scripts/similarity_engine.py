@@ -0,0 +1,125 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_MEMORY_LIMIT_MB = 512
+
+
+def to_normalized_matrix(embeddings, dtype=np.float32):
+    """
+    Convert embeddings to a contiguous matrix with L2 normalized rows.
+
+    With normalized rows, cosine similarity reduces to a dot product, so the
+    similarity of two sets is a single matrix multiply.
+
+    Arrays that are already normalized, contiguous and of the right dtype are
+    returned as is, so memory-mapped matrices are not copied.
+
+    :param embeddings: list of embedding vectors or 2-d array
+    :param dtype: dtype of the returned matrix
+    :return: C-contiguous (n, dim) array
+    """
+    if (isinstance(embeddings, np.ndarray) and embeddings.ndim == 2 and embeddings.dtype == dtype
+            and embeddings.flags['C_CONTIGUOUS'] and embeddings.shape[0] > 0
+            and np.allclose(np.einsum('ij,ij->i', embeddings, embeddings), 1, atol=1e-3)):
+        return embeddings
+
+    matrix = np.array(embeddings, dtype=dtype, copy=True, ndmin=2)
+    if matrix.size == 0:
+        return matrix.reshape(0, matrix.shape[-1] if matrix.ndim == 2 else 0)
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, None]
+    norms[norms == 0] = 1
+    matrix /= norms
+    return np.ascontiguousarray(matrix)
+
+
+def _block_sizes(n_test, n_train, memory_limit_mb, n_jobs, itemsize):
+    """
+    Pick test and train block sizes so that the similarity tiles of all
+    workers together stay below the memory limit.
+    """
+    budget = max(memory_limit_mb * 1024 ** 2 // max(n_jobs, 1), 1024 ** 2)
+    # a tile holds the similarities plus a partition copy and its int64 indices
+    tile_items = budget // (2 * itemsize + 8)
+    train_block = int(min(n_train, max(tile_items // 256, 1)))
+    test_block = int(min(n_test, max(tile_items // train_block, 1)))
+    return test_block, train_block
+
+
+def _score_block(test_block, train, train_block, top_k):
+    n = test_block.shape[0]
+    min_sims = np.full(n, np.inf, dtype=np.float32)
+    max_sims = np.full(n, -np.inf, dtype=np.float32)
+    top_sims = np.full((n, top_k), -np.inf, dtype=np.float32)
+    top_idx = np.full((n, top_k), -1, dtype=np.int64)
+    rows = np.arange(n)[:, None]
+
+    for start in range(0, train.shape[0], train_block):
+        sims = test_block @ train[start:start + train_block].T
+        np.minimum(min_sims, sims.min(axis=1), out=min_sims)
+        np.maximum(max_sims, sims.max(axis=1), out=max_sims)
+
+        # merge this tile's best candidates into the running top-k
+        k = min(top_k, sims.shape[1])
+        if k == 1:
+            candidates = sims.argmax(axis=1)[:, None]
+        else:
+            candidates = np.argpartition(sims, -k, axis=1)[:, -k:]
+        merged_sims = np.concatenate([top_sims, sims[rows, candidates]], axis=1)
+        merged_idx = np.concatenate([top_idx, candidates + start], axis=1)
+        keep = np.argpartition(merged_sims, -top_k, axis=1)[:, -top_k:]
+        top_sims = merged_sims[rows, keep]
+        top_idx = merged_idx[rows, keep]
+
+    order = np.argsort(-top_sims, axis=1)
+    return min_sims, max_sims, top_sims[rows, order], top_idx[rows, order]
+
+
+def similarity_stats(test_embeddings, train_embeddings, top_k=1, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, n_jobs=None):
+    """
+    Compute per-query cosine similarity statistics against a train set.
+
+    Both sets are normalized once into float32 matrices and compared with
+    blocked matrix multiplies. Blocks of test queries are scored on a thread
+    pool (numpy releases the GIL during the multiply) and every tile is sized
+    so that all workers together use at most memory_limit_mb.
+
+    :param test_embeddings: (n_test, dim) embeddings
+    :param train_embeddings: (n_train, dim) embeddings
+    :param top_k: number of nearest train neighbours to return per query
+    :param memory_limit_mb: ceiling for the similarity tiles held at once
+    :param n_jobs: number of worker threads, defaults to the number of cores
+    :return: dict with 'min' and 'max' similarity per query, 'neighbors' indices
+        of the top_k nearest train embeddings and their 'neighbor_similarities'
+    """
+    test = to_normalized_matrix(test_embeddings)
+    train = to_normalized_matrix(train_embeddings)
+    n_test, n_train = test.shape[0], train.shape[0]
+    top_k = max(1, min(top_k, n_train))
+
+    if n_test == 0 or n_train == 0:
+        return {
+            'min': np.empty(n_test, dtype=np.float32),
+            'max': np.empty(n_test, dtype=np.float32),
+            'neighbors': np.empty((n_test, 0), dtype=np.int64),
+            'neighbor_similarities': np.empty((n_test, 0), dtype=np.float32),
+        }
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    test_block, train_block = _block_sizes(n_test, n_train, memory_limit_mb, n_jobs, test.itemsize)
+    logging.info(f"Scoring {n_test} queries against {n_train} train embeddings in "
+                 f"{test_block}x{train_block} tiles on {n_jobs} threads")
+
+    starts = range(0, n_test, test_block)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(lambda s: _score_block(test[s:s + test_block], train, train_block, top_k), starts))
+
+    return {
+        'min': np.concatenate([r[0] for r in results]),
+        'max': np.concatenate([r[1] for r in results]),
+        'neighbor_similarities': np.concatenate([r[2] for r in results]),
+        'neighbors': np.concatenate([r[3] for r in results]),
+    }
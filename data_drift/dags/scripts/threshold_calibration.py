@@ -0,0 +1,194 @@
+import time
+import math
+import logging
+import tracemalloc
+import numpy as np
+from scripts.similarity_engine import to_normalized_matrix, DEFAULT_MEMORY_LIMIT_MB
+
+logging.basicConfig(level=logging.INFO)
+
+HISTOGRAM_BINS = 4000
+EXACT_MAX_N = 20000
+SAMPLE_PAIRS = 2000000
+SAMPLE_STRATA = 16
+CONFIDENCE_Z = 1.96
+
+
+def _histogram_percentile(histogram, percentile):
+    """
+    Percentile of the similarities summarized by a histogram over [-1, 1],
+    taken at the upper edge of the bin containing it.
+    """
+    cumulative = np.cumsum(histogram)
+    rank = percentile / 100 * cumulative[-1]
+    index = int(np.searchsorted(cumulative, rank, side='left'))
+    index = min(index, len(histogram) - 1)
+    return -1 + 2 * (index + 1) / len(histogram)
+
+
+def exact_pairwise_stats(train_embeddings, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, percentiles=(0.1, 1, 5, 50)):
+    """
+    Exact statistics of the cosine similarity over all distinct train pairs.
+
+    Only the blocks on and above the diagonal of the similarity matrix are
+    computed, one tile at a time, and summarized into a running min, max, sum
+    and a histogram with HISTOGRAM_BINS bins, from which percentiles are read
+    with a resolution of 2 / HISTOGRAM_BINS.
+
+    :param train_embeddings: (n, dim) train embeddings
+    :param memory_limit_mb: ceiling for a similarity tile
+    :param percentiles: percentiles to report
+    :return: dict with n_pairs, min, max, mean and percentiles
+    """
+    train = to_normalized_matrix(train_embeddings)
+    n = train.shape[0]
+    # per similarity: the tile, its scaled copy and the int64 histogram bin
+    block = int(max(1, min(n, math.isqrt(memory_limit_mb * 1024 ** 2 // (2 * train.itemsize + 16)))))
+
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    minimum, maximum, total, n_pairs = np.inf, -np.inf, 0.0, 0
+    for i in range(0, n, block):
+        for j in range(i, n, block):
+            sims = train[i:i + block] @ train[j:j + block].T
+            if i == j:
+                rows = np.arange(sims.shape[0])
+                sims = sims[rows[:, None] < rows[None, :]]
+            else:
+                sims = sims.ravel()
+            if sims.size == 0:
+                continue
+            minimum = min(minimum, float(sims.min()))
+            maximum = max(maximum, float(sims.max()))
+            total += float(sims.sum(dtype=np.float64))
+            n_pairs += sims.size
+            scaled = sims + 1
+            scaled *= HISTOGRAM_BINS / 2
+            bins = scaled.astype(np.intp)
+            del scaled
+            np.clip(bins, 0, HISTOGRAM_BINS - 1, out=bins)
+            histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+    if n_pairs == 0:
+        raise ValueError("At least two train embeddings are needed to calibrate thresholds")
+
+    return {
+        'mode': 'exact',
+        'n_pairs': n_pairs,
+        'min': minimum,
+        'max': maximum,
+        'mean': total / n_pairs,
+        'percentiles': {p: _histogram_percentile(histogram, p) for p in percentiles},
+    }
+
+
+def sampled_pairwise_stats(train_embeddings, n_pairs=SAMPLE_PAIRS, percentiles=(0.1, 1, 5, 50), seed=0):
+    """
+    Estimate statistics of the cosine similarity over all distinct train pairs
+    from a stratified sample of pairs.
+
+    The rows are split into SAMPLE_STRATA equal strata and every stratum
+    contributes the same number of pairs, each pairing one of its rows with a
+    uniformly chosen other row, so every region of the table is represented
+    regardless of its order. Percentiles come with distribution-free
+    confidence bounds from the binomial distribution of order statistics. The
+    sample minimum is only an upper bound of the true minimum.
+
+    :param train_embeddings: (n, dim) train embeddings
+    :param n_pairs: number of pairs to sample
+    :param percentiles: percentiles to report
+    :param seed: random seed
+    :return: dict with n_pairs, min, max, mean, percentiles and percentile_bounds
+    """
+    train = to_normalized_matrix(train_embeddings)
+    n = train.shape[0]
+    if n < 2:
+        raise ValueError("At least two train embeddings are needed to calibrate thresholds")
+
+    rng = np.random.default_rng(seed)
+    strata = np.array_split(np.arange(n), min(SAMPLE_STRATA, n))
+    per_stratum = max(1, n_pairs // len(strata))
+
+    samples = []
+    for stratum in strata:
+        left = rng.choice(stratum, per_stratum)
+        # offset in [1, n) so that a row is never paired with itself
+        right = (left + rng.integers(1, n, per_stratum)) % n
+        for start in range(0, per_stratum, 8192):
+            a, b = left[start:start + 8192], right[start:start + 8192]
+            samples.append(np.einsum('ij,ij->i', train[a], train[b]))
+    sims = np.sort(np.concatenate(samples))
+    m = sims.size
+
+    bounds = {}
+    for p in percentiles:
+        q = p / 100
+        spread = CONFIDENCE_Z * math.sqrt(m * q * (1 - q))
+        low = int(max(0, math.floor(m * q - spread)))
+        high = int(min(m - 1, math.ceil(m * q + spread)))
+        bounds[p] = (float(sims[low]), float(sims[high]))
+
+    return {
+        'mode': 'sampled',
+        'n_pairs': m,
+        'min': float(sims[0]),
+        'max': float(sims[-1]),
+        'mean': float(sims.mean(dtype=np.float64)),
+        'percentiles': {p: float(np.quantile(sims, p / 100)) for p in percentiles},
+        'percentile_bounds': bounds,
+    }
+
+
+def calibrate_thresholds(train_embeddings, method='min', upper_percentile=5, lower_percentile=0.1,
+                         exact_max_n=EXACT_MAX_N, n_sample_pairs=SAMPLE_PAIRS, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+    """
+    Calibrate the upper and lower drift thresholds from the train embeddings.
+
+    Pairwise statistics are exact for up to exact_max_n embeddings and
+    estimated from a stratified sample of pairs above that.
+
+    - method 'min': upper = 0.9 * min and lower = 0.4 * min of the pairwise
+      similarity, as before.
+    - method 'percentile': upper and lower are the upper_percentile and
+      lower_percentile of the pairwise similarity, which are stable under
+      sampling, unlike the minimum.
+
+    :return: dict with upper_threshold, lower_threshold, the pairwise stats,
+        elapsed_seconds and peak_memory_mb
+    """
+    n = len(train_embeddings)
+    percentiles = sorted({0.1, 1, 5, 50, upper_percentile, lower_percentile})
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if n <= exact_max_n:
+        stats = exact_pairwise_stats(train_embeddings, memory_limit_mb, percentiles)
+    else:
+        stats = sampled_pairwise_stats(train_embeddings, n_sample_pairs, percentiles)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if method == 'percentile':
+        upper_threshold = stats['percentiles'][upper_percentile]
+        lower_threshold = stats['percentiles'][lower_percentile]
+    elif method == 'min':
+        if stats['mode'] == 'sampled':
+            logging.warning("Minimum similarity is estimated from a sample and overestimates the true minimum, "
+                            "consider drift_threshold_method=percentile")
+        upper_threshold = stats['min'] - (stats['min'] * 0.1)
+        lower_threshold = stats['min'] - (stats['min'] * 0.6)
+    else:
+        raise ValueError(f"Unknown threshold method: {method}")
+
+    logging.info(f"Calibrated thresholds ({method}, {stats['mode']} over {stats['n_pairs']} pairs of {n} embeddings): "
+                 f"upper={upper_threshold:.4f} lower={lower_threshold:.4f} in {elapsed:.2f} s, "
+                 f"peak memory {peak / 1024 ** 2:.1f} MB")
+
+    return {
+        'upper_threshold': float(upper_threshold),
+        'lower_threshold': float(lower_threshold),
+        'method': method,
+        'stats': stats,
+        'elapsed_seconds': elapsed,
+        'peak_memory_mb': peak / 1024 ** 2,
+    }